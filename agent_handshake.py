@@ -1,14 +1,25 @@
 import os
 import json
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from google import genai
 from google.genai import types
 import tools
+import llm_backend
 
 load_dotenv()
 
-client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+AGENT_MODEL = "gemini-2.5-flash"
+
+# Speculative mode: run a local search_inventory for the raw query while the
+# Support Agent decides, and answer from it directly when the match is good enough.
+SPECULATIVE = os.environ.get("HANDSHAKE_SPECULATIVE", "1") == "1"
+# Top cosine similarity at which local results stand in for the Inventory Expert
+SPECULATION_MIN_SCORE = float(os.environ.get("HANDSHAKE_MIN_SCORE", "0.45"))
+SPECULATION_K = 5
+
+_speculation_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="speculate")
 
 # --- Agent 1: Support Agent ---
 def support_agent(user_query, expert_response=None):
@@ -46,16 +57,17 @@ def support_agent(user_query, expert_response=None):
     }
 
     try:
-        res = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[
+        res = llm_backend.generate_with_retries(
+            AGENT_MODEL,
+            [
                 types.Content(role="user", parts=[types.Part(text=system_prompt)]),
                 types.Content(role="user", parts=[types.Part(text=prompt)])
             ],
-            config=types.GenerateContentConfig(
+            types.GenerateContentConfig(
                 response_schema=schema,
                 response_mime_type="application/json"
-            )
+            ),
+            purpose="handshake"
         )
         return json.loads(res.text)
     except Exception as e:
@@ -76,13 +88,14 @@ def inventory_expert(request):
     # 1. Decide if tool is needed
     try:
         # Step 1: Tool Call
-        res = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=request, # Treat request as the user prompt for this agent
-            config=types.GenerateContentConfig(
+        res = llm_backend.generate_with_retries(
+            AGENT_MODEL,
+            request, # Treat request as the user prompt for this agent
+            types.GenerateContentConfig(
                 tools=[tools.search_inventory],
                 system_instruction=system_prompt
-            )
+            ),
+            purpose="handshake"
         )
         
         # Check for tool call
@@ -93,14 +106,15 @@ def inventory_expert(request):
                 tool_result = tools.search_inventory(**fc.args)
                 
                 # Step 2: Final Summary
-                res2 = client.models.generate_content(
-                    model="gemini-2.5-flash",
-                    contents=[
+                res2 = llm_backend.generate_with_retries(
+                    AGENT_MODEL,
+                    [
                         types.Content(role="user", parts=[types.Part(text=request)]),
                         types.Content(role="model", parts=[types.Part(function_call=fc)]),
-                        types.Content(role="user", parts=[types.Part(function_response=types.FunctionResponse(name=fc.name, response=tool_result))])
+                        types.Content(role="user", parts=[types.Part(function_response=types.FunctionResponse(name=fc.name, response=tools.tool_response(tool_result)))])
                     ],
-                    config=types.GenerateContentConfig(system_instruction=system_prompt)
+                    types.GenerateContentConfig(system_instruction=system_prompt),
+                    purpose="handshake"
                 )
                 return res2.text
         else:
@@ -109,34 +123,117 @@ def inventory_expert(request):
     except Exception as e:
         return f"Error in Expert: {e}"
 
+# --- Speculation ---
+class SpeculationStats:
+    """
+    How each speculative search ended up:
+    used (answered without the expert), insufficient (expert called anyway),
+    wasted (no expert needed), failed (search errored). A search still running
+    once the Support Agent has decided counts as insufficient.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {"used": 0, "insufficient": 0, "wasted": 0, "failed": 0}
+
+    def record(self, outcome):
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def summary(self):
+        with self._lock:
+            counts = dict(self.counts)
+        total = sum(counts.values())
+        counts["total"] = total
+        counts["hit_rate"] = round(counts["used"] / total, 3) if total else None
+        # Each used speculation skips both Inventory Expert round trips
+        counts["model_calls_saved"] = 2 * counts["used"]
+        return counts
+
+speculation_stats = SpeculationStats()
+
+def sufficient(results, min_score=SPECULATION_MIN_SCORE):
+    """Local results are good enough when the best match clears min_score."""
+    matches = [r for r in results if isinstance(r, dict)]
+    return bool(matches) and max(m.get('score', 0) for m in matches) >= min_score
+
+def summarize_matches(query, results):
+    """Expert-style context built straight from search results, no model call."""
+    lines = [f"- {m['name']} (ID: {m['id']}): ${m['price']}, stock {m.get('quantity', 'unknown')}"
+             for m in results if isinstance(m, dict)]
+    return f"Inventory search results for '{query}':\n" + "\n".join(lines)
+
+def handle_query(user_query, speculative=SPECULATIVE):
+    """
+    One user turn through the handshake. Returns (reply, route) where route is
+    'direct', 'speculative' (expert hop skipped) or 'expert'.
+    """
+    speculation = _speculation_pool.submit(tools.search_inventory, user_query, SPECULATION_K) if speculative else None
+
+    # 1. Send to Support Agent (the local search runs meanwhile)
+    agent_started = time.perf_counter()
+    action = support_agent(user_query)
+    agent_seconds = time.perf_counter() - agent_started
+
+    if action['target'] != 'EXPERT':
+        if speculation is not None:
+            speculation.cancel()
+            speculation_stats.record("wasted")
+        return action.get('message', 'Error'), 'direct'
+
+    if speculation is not None:
+        timed_out = False
+        try:
+            # The search was meant to hide behind the Support Agent call; give it
+            # at most that long again before falling back to the expert
+            results = speculation.result(timeout=agent_seconds)
+        except TimeoutError:
+            speculation.cancel()
+            results, timed_out = None, True
+        except Exception:
+            results = None
+        if timed_out:
+            speculation_stats.record("insufficient")
+        elif results is None or not any(isinstance(r, dict) for r in results):
+            speculation_stats.record("failed")
+        elif sufficient(results):
+            speculation_stats.record("used")
+            expert_reply = summarize_matches(user_query, results)
+            print(f"[⚡ Speculation] Local search answered for the Inventory Expert: \"{expert_reply.strip()[:100]}...\"")
+            final_action = support_agent(user_query, expert_response=expert_reply)
+            return final_action.get('message', 'Error'), 'speculative'
+        else:
+            speculation_stats.record("insufficient")
+
+    print(f"\n[🔄 Handshake] Support Agent -> Inventory Expert: \"{action['request']}\"")
+    
+    # 2. Call Expert
+    expert_reply = inventory_expert(action['request'])
+    
+    print(f"[✅ Handshake] Inventory Expert -> Support Agent: \"{expert_reply.strip()[:100]}...\"")
+    
+    # 3. Support Agent Final Reply
+    final_action = support_agent(user_query, expert_response=expert_reply)
+    return final_action.get('message', 'Error'), 'expert'
+
 # --- Main Orchestrator ---
 def main():
-    print("--- Agent System Online (Type 'quit' to exit) ---")
+    print("--- Agent System Online (Type 'quit' to exit, 'stats' for speculation stats) ---")
     print("Support Agent: Ready\nInventory Expert: Ready\n")
     
     while True:
         user_input = input("\nYou: ")
         if user_input.lower() in ['quit', 'exit']:
             break
-            
-        # 1. Send to Support Agent
-        action = support_agent(user_input)
-        
-        if action['target'] == 'EXPERT':
-            print(f"\n[🔄 Handshake] Support Agent -> Inventory Expert: \"{action['request']}\"")
-            
-            # 2. Call Expert
-            expert_reply = inventory_expert(action['request'])
-            
-            print(f"[✅ Handshake] Inventory Expert -> Support Agent: \"{expert_reply.strip()[:100]}...\"")
-            
-            # 3. Support Agent Final Reply
-            final_action = support_agent(user_input, expert_response=expert_reply)
-            print(f"\nSupport Agent: {final_action.get('message', 'Error')}")
-            
-        else:
-            # Direct reply
-            print(f"\nSupport Agent: {action.get('message', 'Error')}")
+        if user_input.lower() == 'stats':
+            print(json.dumps(speculation_stats.summary(), indent=2))
+            continue
+
+        reply, route = handle_query(user_input)
+        print(f"\nSupport Agent ({route}): {reply}")
+
+    if SPECULATIVE:
+        print(f"Speculation: {speculation_stats.summary()}")
 
 if __name__ == "__main__":
     main()
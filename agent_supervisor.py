@@ -1,17 +1,25 @@
 import os
 import json
 import time
+import asyncio
+import threading
 from dotenv import load_dotenv
-from google import genai
 from google.genai import types
 import tools
+import llm_backend
 
 load_dotenv()
 
-client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+AGENT_MODEL = "gemini-2.5-flash"
+# Tasks of one plan running at the same time
+MAX_PARALLEL_TASKS = int(os.environ.get("SUPERVISOR_MAX_PARALLEL", "4"))
+
+async def generate_async(contents, config=None, model=AGENT_MODEL):
+    """One call on the async client, paced by the shared rate limiter and retried on 429 like the chat path."""
+    return await llm_backend.agenerate_with_retries(model, contents, config, purpose="supervisor")
 
 # --- 1. The Supervisor (Planner) ---
-def supervisor_agent(user_query):
+async def supervisor_agent_async(user_query):
     """
     Analyzes the query and breaks it down into a list of tasks for specific agents.
     """
@@ -25,9 +33,12 @@ def supervisor_agent(user_query):
         f"RULES:\n"
         f"1. Return a JSON object with a 'plan' key, which is a LIST of tasks.\n"
         f"2. Each task must have:\n"
+        f"   - 'id': A short unique id such as 't1', 't2'.\n"
         f"   - 'agent': One of ['INVENTORY', 'SHIPPING', 'GENERAL']\n"
         f"   - 'instruction': Specific instructions for that agent.\n"
-        f"3. Order matters! If the user asks for 'price and shipping', checking inventory (price) should likely happen before shipping (cost depends on price).\n"
+        f"   - 'depends_on': The ids of the tasks whose results this task needs (empty if none).\n"
+        f"3. Independent tasks run in parallel, so only list real dependencies. If the user asks for 'price and shipping', "
+        f"the SHIPPING task depends on the INVENTORY task (cost depends on price). Lookups of different products do not depend on each other.\n"
         f"4. If 'GENERAL' is used, it should probably be the only task.\n"
         f"5. Return ONLY Raw JSON."
     )
@@ -42,17 +53,19 @@ def supervisor_agent(user_query):
                 "items": {
                     "type": "OBJECT",
                     "properties": {
+                        "id": {"type": "STRING"},
                         "agent": {"type": "STRING", "enum": ["INVENTORY", "SHIPPING", "GENERAL"]},
-                        "instruction": {"type": "STRING"}
-                    }
+                        "instruction": {"type": "STRING"},
+                        "depends_on": {"type": "ARRAY", "items": {"type": "STRING"}}
+                    },
+                    "required": ["id", "agent", "instruction", "depends_on"]
                 }
             }
         }
     }
 
     try:
-        res = client.models.generate_content(
-            model="gemini-2.5-flash",
+        res = await generate_async(
             contents=[
                 types.Content(role="user", parts=[types.Part(text=system_prompt)]),
                 types.Content(role="user", parts=[types.Part(text=prompt)])
@@ -66,8 +79,11 @@ def supervisor_agent(user_query):
     except Exception as e:
         return {"plan": [{"agent": "GENERAL", "instruction": f"Error planning: {e}"}]}
 
+def supervisor_agent(user_query):
+    return run_sync(supervisor_agent_async(user_query))
+
 # --- 2. Inventory Expert ---
-def inventory_expert(instruction):
+async def inventory_expert_async(instruction):
     system_prompt = (
         f"You are the Inventory Expert. You have access to `search_inventory`.\n"
         f"Use the tool to find product data requested in the instruction.\n"
@@ -76,8 +92,7 @@ def inventory_expert(instruction):
     
     try:
         # Tool Call Step
-        res = client.models.generate_content(
-            model="gemini-2.5-flash",
+        res = await generate_async(
             contents=instruction,
             config=types.GenerateContentConfig(
                 tools=[tools.search_inventory],
@@ -88,15 +103,15 @@ def inventory_expert(instruction):
         if res.function_calls:
             fc = res.function_calls[0]
             if fc.name == 'search_inventory':
-                tool_result = tools.search_inventory(**fc.args)
+                # The search is blocking (model + DB), so it runs off the event loop
+                tool_result = await asyncio.to_thread(tools.search_inventory, **fc.args)
                 
                 # Final Summary Step
-                res2 = client.models.generate_content(
-                    model="gemini-2.5-flash",
+                res2 = await generate_async(
                     contents=[
                         types.Content(role="user", parts=[types.Part(text=instruction)]),
                         types.Content(role="model", parts=[types.Part(function_call=fc)]),
-                        types.Content(role="user", parts=[types.Part(function_response=types.FunctionResponse(name=fc.name, response=tool_result))])
+                        types.Content(role="user", parts=[types.Part(function_response=types.FunctionResponse(name=fc.name, response=tools.tool_response(tool_result)))])
                     ],
                     config=types.GenerateContentConfig(system_instruction=system_prompt)
                 )
@@ -107,8 +122,11 @@ def inventory_expert(instruction):
     except Exception as e:
         return f"Inventory Error: {e}"
 
+def inventory_expert(instruction):
+    return run_sync(inventory_expert_async(instruction))
+
 # --- 3. Shipping Specialist ---
-def shipping_specialist(instruction, context=""):
+async def shipping_specialist_async(instruction, context=""):
     """
     Calculates shipping based on rules and context (like item price).
     """
@@ -125,8 +143,7 @@ def shipping_specialist(instruction, context=""):
     prompt = f"Context from other agents: {context}\n\nInstruction: {instruction}"
     
     try:
-        res = client.models.generate_content(
-            model="gemini-2.5-flash",
+        res = await generate_async(
             contents=[
                 types.Content(role="user", parts=[types.Part(text=system_prompt)]),
                 types.Content(role="user", parts=[types.Part(text=prompt)])
@@ -136,8 +153,11 @@ def shipping_specialist(instruction, context=""):
     except Exception as e:
         return f"Shipping Error: {e}"
 
+def shipping_specialist(instruction, context=""):
+    return run_sync(shipping_specialist_async(instruction, context))
+
 # --- 4. Supervisor Synthesis ---
-def synthesize_answer(user_query, research_results):
+async def synthesize_answer_async(user_query, research_results):
     """
     Combines all agent outputs into a final friendly response.
     """
@@ -145,8 +165,7 @@ def synthesize_answer(user_query, research_results):
     
     prompt = f"User Query: {user_query}\n\nAgent Reports:\n{research_results}"
     
-    res = client.models.generate_content(
-        model="gemini-2.5-flash",
+    res = await generate_async(
         contents=[
             types.Content(role="user", parts=[types.Part(text=system_prompt)]),
             types.Content(role="user", parts=[types.Part(text=prompt)])
@@ -154,6 +173,118 @@ def synthesize_answer(user_query, research_results):
     )
     return res.text
 
+def synthesize_answer(user_query, research_results):
+    return run_sync(synthesize_answer_async(user_query, research_results))
+
+# --- 5. Plan Execution (DAG) ---
+_loop = None
+_loop_lock = threading.Lock()
+
+def run_sync(coro):
+    """
+    Runs a coroutine on the module's background event loop and waits for it.
+    One long-lived loop (rather than asyncio.run per call) keeps the async
+    client's connections usable across calls from any thread.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="supervisor-loop", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result()
+
+def normalize_plan(plan):
+    """
+    Gives every task an id and a depends_on list, and returns the tasks in an order
+    where prerequisites come first. Plans without depends_on (older planner output)
+    keep the old meaning: SHIPPING waits for everything before it. Unknown ids are
+    dropped, and cycles are broken by ignoring the dependencies that close them.
+    """
+    tasks = []
+    has_dependencies = any('depends_on' in task for task in plan)
+    for i, task in enumerate(plan):
+        task = dict(task)
+        task['id'] = str(task.get('id') or f"t{i + 1}")
+        while task['id'] in {t['id'] for t in tasks}:
+            task['id'] += "'"
+        if not has_dependencies:
+            task['depends_on'] = [t['id'] for t in tasks] if task.get('agent') == 'SHIPPING' else []
+        tasks.append(task)
+
+    ids = {t['id'] for t in tasks}
+    for task in tasks:
+        task['depends_on'] = [d for d in dict.fromkeys(map(str, task.get('depends_on') or [])) if d in ids and d != task['id']]
+
+    ordered, placed = [], set()
+    remaining = list(tasks)
+    while remaining:
+        ready = [t for t in remaining if all(d in placed for d in t['depends_on'])]
+        if not ready:
+            # Cycle: run the first remaining task with only the prerequisites already placed
+            ready = [remaining[0]]
+            ready[0]['depends_on'] = [d for d in ready[0]['depends_on'] if d in placed]
+        for task in ready:
+            ordered.append(task)
+            placed.add(task['id'])
+            remaining.remove(task)
+    return ordered
+
+async def run_task(task, context):
+    agent = task['agent']
+    instruction = task['instruction']
+    if agent == 'INVENTORY':
+        return await inventory_expert_async(instruction)
+    elif agent == 'SHIPPING':
+        # Pass prerequisite reports as context (e.g. price found by inventory)
+        return await shipping_specialist_async(instruction, context=context)
+    return "General: I can help with that directly."
+
+async def execute_plan(plan, on_event=None, max_parallel=MAX_PARALLEL_TASKS):
+    """
+    Runs a normalized plan as a DAG: every task starts as soon as its own
+    prerequisites have finished, so independent tasks run concurrently (at most
+    max_parallel at a time). Returns one result per task, in plan order, with
+    its output and the seconds after the start at which it finished.
+    on_event(task, output, elapsed) is called as each task finishes.
+    """
+    semaphore = asyncio.Semaphore(max_parallel)
+    running = {}
+    outputs = {}
+    finished = {}
+    by_id = {t['id']: t for t in plan}
+    start = time.perf_counter()
+
+    async def run(task):
+        if task['depends_on']:
+            await asyncio.gather(*(running[d] for d in task['depends_on']))
+        context = "".join(f"[{by_id[d]['agent']} Report]: {outputs[d]}\n" for d in task['depends_on'])
+        async with semaphore:
+            output = await run_task(task, context) or ""
+        outputs[task['id']] = output
+        finished[task['id']] = round(time.perf_counter() - start, 3)
+        if on_event:
+            on_event(task, output, finished[task['id']])
+        return output
+
+    # Prerequisites come first in a normalized plan, so every awaited task exists
+    for task in plan:
+        running[task['id']] = asyncio.ensure_future(run(task))
+    await asyncio.gather(*running.values())
+    return [{**task, "output": outputs[task['id']], "finished_after": finished[task['id']]} for task in plan]
+
+async def answer_question_async(user_query, on_event=None):
+    """Plan, execute the plan as a DAG, and synthesize. Returns {plan, results, answer}."""
+    plan_data = await supervisor_agent_async(user_query)
+    plan = normalize_plan(plan_data.get('plan', []))
+    results = await execute_plan(plan, on_event=on_event)
+    reports = "\n".join(f"[{r['agent']}]: {r['output']}" for r in results)
+    answer = await synthesize_answer_async(user_query, reports)
+    return {"plan": plan, "results": results, "answer": answer}
+
+def answer_question(user_query, on_event=None):
+    """Blocking entry point for scripts and Flask routes."""
+    return run_sync(answer_question_async(user_query, on_event=on_event))
+
 # --- Main Orchestration Loop ---
 def main():
     print("--- 🧠 Supervisor Agent System Online (Type 'quit' to exit) ---")
@@ -163,40 +294,28 @@ def main():
         if user_input.lower() in ['quit', 'exit']:
             break
             
-        print("\n[1] Supervisor is Planning...")
-        plan_data = supervisor_agent(user_input)
-        plan = plan_data.get('plan', [])
-        
-        # Visualize the Plan
-        print("    📋 Task List:")
-        for i, task in enumerate(plan):
-            print(f"       {i+1}. [{task['agent']}] {task['instruction']}")
-            
-        # Execute Plan
-        results = []
-        context_accumulator = "" # Passed down to subsequent agents
-        
-        print("\n[2] Executing Tasks...")
-        for task in plan:
-            agent = task['agent']
-            instruction = task['instruction']
-            output = ""
-            
-            if agent == 'INVENTORY':
-                output = inventory_expert(instruction)
-            elif agent == 'SHIPPING':
-                # Pass accumulated context (e.g. price found by inventory)
-                output = shipping_specialist(instruction, context=context_accumulator)
-            elif agent == 'GENERAL':
-                output = "General: I can help with that directly."
-            
-            print(f"    ✅ {agent} Finished: \"{output.strip()[:60]}...\"")
-            context_accumulator += f"[{agent} Report]: {output}\n"
-            results.append(f"[{agent}]: {output}")
-            
-        # Synthesize
-        print("\n[3] Synthesizing Final Answer...")
-        final_response = synthesize_answer(user_input, "\n".join(results))
+        def report(task, output, elapsed):
+            print(f"    ✅ [{task['id']}] {task['agent']} Finished after {elapsed:.1f}s: \"{output.strip()[:60]}...\"")
+
+        async def run():
+            print("\n[1] Supervisor is Planning...")
+            plan = normalize_plan((await supervisor_agent_async(user_input)).get('plan', []))
+
+            # Visualize the Plan
+            print("    📋 Task List:")
+            for task in plan:
+                after = f" (after {', '.join(task['depends_on'])})" if task['depends_on'] else ""
+                print(f"       {task['id']}. [{task['agent']}] {task['instruction']}{after}")
+
+            # Execute Plan: independent tasks run concurrently
+            print("\n[2] Executing Tasks...")
+            results = await execute_plan(plan, on_event=report)
+
+            # Synthesize
+            print("\n[3] Synthesizing Final Answer...")
+            return await synthesize_answer_async(user_input, "\n".join(f"[{r['agent']}]: {r['output']}" for r in results))
+
+        final_response = run_sync(run())
         print(f"\n🤖 Supervisor: {final_response}")
 
 if __name__ == "__main__":
@@ -0,0 +1,223 @@
+import argparse
+import os
+import time
+import numpy as np
+
+# Approximate nearest-neighbour search over the inventory embeddings, in pure NumPy.
+# IVF (inverted file) index: k-means splits the unit-length embeddings into n_lists
+# clusters, and a query only scans the rows of its `nprobe` closest clusters.
+# Raising nprobe trades latency for recall; `python ann_index.py --report` measures it.
+ANN_PATH = "inventory_ivf.npz"
+
+# "auto" uses the IVF index whenever one has been built, "exact" never does
+BACKEND = os.environ.get("VECTOR_INDEX_BACKEND", "auto")
+# Default number of clusters scanned per query
+NPROBE = int(os.environ.get("ANN_NPROBE", "8"))
+# ingest_inventory only builds an IVF index for catalogs at least this big
+MIN_ROWS = int(os.environ.get("ANN_MIN_ROWS", "20000"))
+
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 256
+ASSIGN_BLOCK = 65536
+
+
+def default_n_lists(n_rows):
+    """About sqrt(n) clusters: 1M rows -> 1000 lists of ~1000 rows."""
+    return int(max(1, min(65536, round(np.sqrt(n_rows)))))
+
+def _top(scores, k):
+    """Indices of the k highest scores along the last axis, unordered."""
+    k = min(k, scores.shape[-1])
+    return np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+
+def assign(embeddings, centroids, block=ASSIGN_BLOCK):
+    """Nearest centroid (by dot product) for every row, computed in blocks."""
+    out = np.empty(len(embeddings), dtype=np.int32)
+    for start in range(0, len(embeddings), block):
+        out[start:start + block] = np.argmax(embeddings[start:start + block] @ centroids.T, axis=1)
+    return out
+
+def spherical_kmeans(embeddings, n_lists, n_iter=KMEANS_ITERATIONS, seed=0):
+    """
+    k-means on unit vectors (centroids re-normalised each step), trained on a
+    random sample of at most KMEANS_SAMPLE_PER_LIST rows per cluster.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = len(embeddings)
+    sample_size = min(n_rows, n_lists * KMEANS_SAMPLE_PER_LIST)
+    sample = np.asarray(embeddings[np.sort(rng.choice(n_rows, sample_size, replace=False))], dtype='float32')
+
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = assign(sample, centroids)
+        counts = np.bincount(labels, minlength=n_lists)
+        empty = counts == 0
+        # Per-cluster sums via one sort + reduceat (np.add.at is far slower)
+        order = np.argsort(labels, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.zeros_like(centroids)
+        sums[~empty] = np.add.reduceat(sample[order], starts[~empty], axis=0)
+        # Re-seed empty clusters with random sample rows
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = (sums / norms).astype('float32')
+    return centroids
+
+
+class IVFIndex:
+    """Coarse quantiser (centroids) plus each row's cluster, with inverted lists built at load."""
+
+    def __init__(self, centroids, assignments):
+        self.centroids = np.asarray(centroids, dtype='float32')
+        self.assignments = np.asarray(assignments, dtype=np.int32)
+        self.order = np.argsort(self.assignments, kind='stable')
+        self.offsets = np.searchsorted(self.assignments[self.order], np.arange(len(self.centroids) + 1))
+
+    @classmethod
+    def build(cls, embeddings, n_lists=None, seed=0):
+        n_lists = min(n_lists or default_n_lists(len(embeddings)), len(embeddings))
+        centroids = spherical_kmeans(embeddings, n_lists, seed=seed)
+        return cls(centroids, assign(embeddings, centroids))
+
+    @classmethod
+    def load(cls, path=None):
+        with np.load(path or ANN_PATH) as data:
+            return cls(data['centroids'], data['assignments'])
+
+    def save(self, path=None):
+        """Writes to a temporary file and swaps it in."""
+        path = path or ANN_PATH
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, centroids=self.centroids, assignments=self.assignments)
+        os.replace(tmp_path, path)
+
+    def candidates(self, query, nprobe):
+        """Rows in the nprobe clusters closest to the query."""
+        probe = _top(self.centroids @ query, nprobe)
+        return np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probe])
+
+    def search(self, embeddings, query, k, nprobe=None, live=None):
+        """
+        Approximate top-k as (row indices, scores), best first. Rows appended after
+        the index was built (beyond len(assignments)) are always scanned.
+        """
+        rows = self.candidates(query, nprobe or NPROBE)
+        if len(embeddings) > len(self.assignments):
+            rows = np.concatenate([rows, np.arange(len(self.assignments), len(embeddings))])
+        if live is not None:
+            rows = rows[live[rows]]
+        if len(rows) == 0:
+            return np.array([], dtype=int), np.array([], dtype='float32')
+        rows = np.sort(rows)  # sorted gathers read the memory map sequentially
+        scores = embeddings[rows] @ query
+        best = _top(scores, k)
+        best = best[np.argsort(-scores[best])]
+        return rows[best], scores[best]
+
+
+def update_assignments(rows, vectors, n_rows, path=None):
+    """
+    Keeps a saved IVF index in step with incremental updates: (re)assigns the given
+    rows to their nearest centroid and grows the assignment array to n_rows.
+    No-op when no IVF index has been built.
+    """
+    path = path or ANN_PATH
+    if not os.path.exists(path):
+        return
+    index = IVFIndex.load(path)
+    assignments = index.assignments
+    if len(assignments) < n_rows:
+        # New rows are among `rows`, so every slot added here is overwritten below
+        assignments = np.concatenate([assignments, np.zeros(n_rows - len(assignments), dtype=np.int32)])
+    if len(rows):
+        assignments[np.asarray(rows)] = assign(np.asarray(vectors, dtype='float32'), index.centroids)
+    IVFIndex(index.centroids, assignments).save(path)
+
+
+def compact(keep, embeddings, path=None):
+    """Drops tombstoned rows from a saved IVF index; `embeddings` is the pre-compaction matrix."""
+    path = path or ANN_PATH
+    if not os.path.exists(path):
+        return
+    index = IVFIndex.load(path)
+    assignments = index.assignments
+    if len(assignments) < len(embeddings):
+        tail = assign(np.asarray(embeddings[len(assignments):]), index.centroids)
+        assignments = np.concatenate([assignments, tail])
+    IVFIndex(index.centroids, assignments[keep]).save(path)
+
+def recall_report(embeddings, live=None, nprobes=(1, 2, 4, 8, 16, 32), n_queries=200, k=10, noise=0.05, seed=0):
+    """
+    Recall@k and latency of IVF search for each nprobe, against exact search.
+    Queries are catalog rows plus a little noise, so no model is needed.
+    """
+    import vector_store
+
+    rng = np.random.default_rng(seed)
+    index = IVFIndex.load() if os.path.exists(ANN_PATH) else IVFIndex.build(embeddings)
+    picks = rng.choice(len(embeddings), min(n_queries, len(embeddings)), replace=False)
+    queries = vector_store.normalize(
+        np.asarray(embeddings[picks]) + rng.normal(scale=noise, size=(len(picks), embeddings.shape[1])))
+
+    exact, exact_times = [], []
+    for q in queries:
+        t0 = time.perf_counter()
+        scores = embeddings @ q
+        if live is not None:
+            scores[~live] = -np.inf
+        exact.append(set(vector_store.top_k(scores, k).tolist()))
+        exact_times.append(time.perf_counter() - t0)
+
+    report = [{"backend": "exact", "nprobe": None, "recall": 1.0,
+               "p50_ms": 1000 * float(np.percentile(exact_times, 50)),
+               "p95_ms": 1000 * float(np.percentile(exact_times, 95)),
+               "scanned": 1.0}]
+    for nprobe in nprobes:
+        if nprobe > len(index.centroids):
+            break
+        hits, times, scanned = 0, [], 0
+        for q, truth in zip(queries, exact):
+            t0 = time.perf_counter()
+            rows, _ = index.search(embeddings, q, k, nprobe=nprobe, live=live)
+            times.append(time.perf_counter() - t0)
+            hits += len(truth & set(rows.tolist()))
+            scanned += len(index.candidates(q, nprobe))
+        report.append({"backend": "ivf", "nprobe": nprobe,
+                       "recall": hits / (k * len(queries)),
+                       "p50_ms": 1000 * float(np.percentile(times, 50)),
+                       "p95_ms": 1000 * float(np.percentile(times, 95)),
+                       "scanned": scanned / (len(queries) * len(embeddings))})
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the IVF index or compare it with exact search.")
+    parser.add_argument("--build", action="store_true", help="(Re)build the IVF index from the current embeddings")
+    parser.add_argument("--lists", type=int, default=None, help="Number of clusters (default: sqrt(rows))")
+    parser.add_argument("--report", action="store_true", help="Print recall vs latency for several nprobe values")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    import vector_store
+    snapshot = vector_store.get_resident_index()
+    if snapshot is None:
+        print("Inventory index not found. Please run vector_store.py first.")
+        return
+
+    if args.build:
+        print(f"Building IVF index over {len(snapshot.embeddings)} rows...")
+        IVFIndex.build(snapshot.embeddings, n_lists=args.lists).save()
+        print(f"Saved '{ANN_PATH}'")
+
+    if args.report:
+        print(f"{'backend':<8}{'nprobe':>8}{'recall@' + str(args.k):>12}{'p50 ms':>10}{'p95 ms':>10}{'scanned':>10}")
+        for r in recall_report(snapshot.embeddings, snapshot.live, args.nprobe, args.queries, args.k):
+            nprobe = '-' if r['nprobe'] is None else r['nprobe']
+            print(f"{r['backend']:<8}{nprobe:>8}{r['recall']:>12.3f}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['scanned']:>10.1%}")
+
+if __name__ == "__main__":
+    main()
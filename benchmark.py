@@ -0,0 +1,209 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+import numpy as np
+
+# Offline micro-benchmarks for the data and search hot paths. Each catalog size
+# gets a fresh database and vector index in a temporary directory (seeded by
+# generate_fake_data.py with synthetic vectors), so no network or API key is needed.
+#
+#   python benchmark.py --sizes 1k 100k 1m --save benchmarks/baseline.json
+#   python benchmark.py --sizes 1k 100k --compare benchmarks/baseline.json
+
+# main.py starts the index worker and a Gemini client on import
+os.environ.setdefault("VECTOR_INDEX_WORKER", "0")
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+import database
+import generate_fake_data
+import tools
+import vector_store
+
+DEFAULT_SIZES = ("1k", "100k")
+ITERATIONS = 200
+# Seconds per case; slow cases at large sizes stop early (after at least MIN_RUNS runs)
+TIME_BUDGET = 10.0
+MIN_RUNS = 5
+# A p50 or p95 this much slower than the baseline counts as a regression
+REGRESSION_THRESHOLD = 0.2
+# ...and at least this many milliseconds, so sub-millisecond jitter isn't flagged
+NOISE_FLOOR_MS = 0.1
+CHAT_SESSIONS = 1000
+
+QUERIES = ["wireless headphones", "cheap gaming mouse", "samsung monitor", "4k projector",
+           "portable ssd", "apple watch", "ergonomic keyboard", "waterproof drone"]
+
+
+class HashEncoder:
+    """Stand-in for the sentence transformer: a deterministic random unit vector per text."""
+
+    def encode(self, texts, batch_size=None):
+        return np.stack([np.random.default_rng(zlib.crc32(t.encode())).standard_normal(
+            generate_fake_data.EMBEDDING_DIM, dtype=np.float32) for t in texts])
+
+
+def parse_size(text):
+    """'1k' -> 1000, '1m' -> 1000000."""
+    text = text.lower()
+    scale = {"k": 1000, "m": 1000000}.get(text[-1])
+    return int(float(text[:-1]) * scale) if scale else int(text)
+
+def percentiles(samples):
+    ms = np.array(samples) * 1000
+    return {"runs": len(samples),
+            "p50_ms": round(float(np.percentile(ms, 50)), 4),
+            "p95_ms": round(float(np.percentile(ms, 95)), 4),
+            "p99_ms": round(float(np.percentile(ms, 99)), 4),
+            "mean_ms": round(float(ms.mean()), 4)}
+
+def process_peak_rss_mb():
+    """
+    Peak RSS of the whole benchmark process so far. ru_maxrss is a high-water
+    mark, so this only ever grows: a case shows the largest footprint of any
+    case (or seeding) before it, not its own.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def measure(fn, iterations=ITERATIONS, budget=TIME_BUDGET):
+    """Runs fn(i) once to warm up, then up to `iterations` times within `budget` seconds."""
+    fn(-1)
+    samples = []
+    deadline = time.perf_counter() + budget
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - t0)
+        if len(samples) >= MIN_RUNS and time.perf_counter() > deadline:
+            break
+    return samples
+
+
+def run_size(size, encoder, iterations, budget, seed=0):
+    """Seeds a catalog of `size` products in a temporary directory and times every case."""
+    import main
+
+    results = {}
+    original_pool, original_cwd = database._pool, os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        database._pool = database.ConnectionPool(os.path.join(tmp, "benchmark.db"))
+        # The vector index files live in the working directory
+        os.chdir(tmp)
+        try:
+            print(f"\n=== {size} products ===")
+            database.create_tables()
+            t0 = time.perf_counter()
+            first_id, last_id = generate_fake_data.generate_fake_data(size, seed=seed, embeddings=True)
+            generate_fake_data.generate_chat_history(CHAT_SESSIONS, seed=seed)
+            seed_seconds = time.perf_counter() - t0
+            client = main.app.test_client()
+            rng = np.random.default_rng(seed)
+            ids = rng.integers(first_id, last_id + 1, size=iterations + 1)
+
+            def case(name, fn, runs=iterations):
+                samples = measure(fn, runs, budget)
+                results[name] = dict(percentiles(samples), process_peak_rss_mb=process_peak_rss_mb())
+                r = results[name]
+                print(f"{name:<32}{r['runs']:>6}{r['p50_ms']:>12.3f}{r['p95_ms']:>12.3f}{r['p99_ms']:>12.3f}{r['process_peak_rss_mb']:>10.1f}")
+
+            print(f"{'case':<32}{'runs':>6}{'p50 ms':>12}{'p95 ms':>12}{'p99 ms':>12}{'peak MB':>10}")
+            case("get_products_page", lambda i: client.get(f"/products?limit=100&after_id={ids[i] - first_id}").get_data())
+            case("search_fts", lambda i: client.get(f"/search?q={QUERIES[i % len(QUERIES)]}").get_data())
+
+            # search_inventory end to end, then its phases separately
+            vector_store.query_cache.clear()
+            case("search_inventory", lambda i: tools.search_inventory(f"{QUERIES[i % len(QUERIES)]} {i}"))
+            case("search_inventory.load", lambda i: vector_store.ResidentIndex().get(), runs=min(iterations, 20))
+            case("search_inventory.encode", lambda i: vector_store.encode_queries([f"encode {i}"], model=encoder))
+            index = vector_store.get_resident_index()
+            query_vectors = vector_store.normalize(encoder.encode(QUERIES))
+            case("search_inventory.score", lambda i: index.search(query_vectors[i % len(QUERIES)], 3))
+
+            case("get_all_inventory_text", lambda i: database.get_all_inventory_text(), runs=min(iterations, 20))
+            case("update_product_price", lambda i: tools.update_product_price(int(ids[i]), 9.99))
+            case("delete_product", lambda i: tools.delete_product(int(ids[i])))
+            sessions = [f"synthetic-{seed}-{n}" for n in range(CHAT_SESSIONS)]
+            case("get_recent_history", lambda i: tools.get_recent_history(sessions[i % CHAT_SESSIONS]))
+        finally:
+            os.chdir(original_cwd)
+            database._pool.close_all()
+            database._pool = original_pool
+            vector_store._bump_version()
+    return {"seed_seconds": round(seed_seconds, 2), "cases": results}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(current, baseline, threshold=REGRESSION_THRESHOLD):
+    """Prints p50/p95 changes against a baseline. Returns the (size, case, metric) regressions."""
+    regressions = []
+    print(f"\nCompared with {baseline['meta'].get('commit') or 'baseline'} (regression: > {threshold:.0%} slower)")
+    for size, result in current["sizes"].items():
+        base_cases = baseline["sizes"].get(size, {}).get("cases", {})
+        for name, stats in result["cases"].items():
+            base = base_cases.get(name)
+            if not base:
+                continue
+            changes = []
+            for metric in ("p50_ms", "p95_ms"):
+                change = (stats[metric] - base[metric]) / base[metric] if base[metric] else 0.0
+                changes.append(f"{metric[:3]} {change:+.0%}")
+                if change > threshold and stats[metric] - base[metric] > NOISE_FLOOR_MS:
+                    regressions.append((size, name, metric))
+            flag = "  REGRESSION" if any(r[:2] == (size, name) for r in regressions) else ""
+            print(f"{size:>9} {name:<32}{'  '.join(changes)}{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the data and search hot paths")
+    parser.add_argument("--sizes", nargs="+", default=list(DEFAULT_SIZES), help="catalog sizes, e.g. 1k 100k 1m")
+    parser.add_argument("--iterations", type=int, default=ITERATIONS)
+    parser.add_argument("--budget", type=float, default=TIME_BUDGET, help="seconds per case")
+    parser.add_argument("--model", action="store_true",
+                        help="encode queries with the real embedding model instead of a hash stand-in")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON to compare against; exits 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.model:
+        encoder = vector_store.get_embedding_model()
+    else:
+        # search_inventory encodes through vector_store's lazily loaded model
+        encoder = vector_store._model = HashEncoder()
+    report = {
+        "meta": {"commit": git_commit(), "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                 "python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+                 "encoder": "model" if args.model else "hash", "iterations": args.iterations},
+        "sizes": {},
+    }
+    for size in args.sizes:
+        report["sizes"][size] = run_size(parse_size(size), encoder, args.iterations, args.budget)
+    report["meta"]["process_peak_rss_mb"] = process_peak_rss_mb()
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved '{args.save}'")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import csv
+import io
+import json
+import os
+import time
+import database
+
+# Rows per transaction. Larger batches mean fewer commits; each one holds the
+# write lock for longer.
+BULK_BATCH_SIZE = int(os.environ.get("BULK_BATCH_SIZE", "5000"))
+# Per-row errors returned in the response; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+
+def iter_csv(stream):
+    """Yields (line number, record dict) from a CSV byte stream with a name,price header."""
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8', newline=''))
+    for record in reader:
+        yield reader.line_num, record
+
+def iter_ndjson(stream):
+    """Yields (line number, record) from an NDJSON byte stream, skipping blank lines."""
+    for line_num, line in enumerate(io.TextIOWrapper(stream, encoding='utf-8'), start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_num, json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_num, ValueError(f"Invalid JSON: {e.msg}")
+
+def validate(record):
+    """Returns (name, price) for a valid product record, otherwise raises ValueError."""
+    if isinstance(record, Exception):
+        raise record
+    if not isinstance(record, dict):
+        raise ValueError("Expected an object with 'name' and 'price'")
+    name = record.get('name')
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError("'name' is required")
+    price = record.get('price')
+    if price is None or price == '' or isinstance(price, bool):
+        raise ValueError("'price' is required")
+    try:
+        price = float(price)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid price {price!r}")
+    if not price >= 0 or price == float('inf'):
+        raise ValueError(f"Invalid price {price!r}")
+    return name.strip(), price
+
+def ingest(records, batch_size=BULK_BATCH_SIZE):
+    """
+    Validates (line number, record) pairs as they arrive and inserts the valid
+    ones with database.insert_products_bulk, batch_size rows per transaction.
+    Returns a summary with counts, id range, per-row errors and throughput.
+    """
+    start = time.time()
+    inserted = failed = 0
+    first_id = last_id = None
+    errors = []
+    batch = []
+
+    def flush():
+        nonlocal inserted, first_id, last_id
+        ids = database.insert_products_bulk(batch)
+        if ids:
+            inserted += len(batch)
+            first_id = ids[0] if first_id is None else first_id
+            last_id = ids[1]
+        batch.clear()
+
+    for line_num, record in records:
+        try:
+            batch.append(validate(record))
+        except ValueError as e:
+            failed += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({"line": line_num, "error": str(e)})
+            continue
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    seconds = time.time() - start
+    return {
+        "inserted": inserted,
+        "failed": failed,
+        "first_id": first_id,
+        "last_id": last_id,
+        "errors": errors,
+        "errors_truncated": failed > len(errors),
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(inserted / seconds) if seconds > 0 else None,
+    }
@@ -0,0 +1,64 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import database
+from database import get_db_connection
+
+# Bounded chat memory. Each turn sends the model the session's rolling summary
+# plus its newest KEEP_RECENT messages. Once COMPACT_BATCH messages older than
+# those have piled up since the last summary, a background job folds them into
+# the summary, so prompt size stays flat however long a session runs. Messages
+# waiting for the next summary are left out of the prompt until it is written.
+KEEP_RECENT = int(os.environ.get("CHAT_KEEP_RECENT", "10"))
+COMPACT_BATCH = int(os.environ.get("CHAT_COMPACT_BATCH", "10"))
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-memory")
+_pending = set()
+_lock = threading.Lock()
+
+
+def unsummarized_messages(session_id, after_id):
+    database.chat_writer.flush(session_id)
+    conn = get_db_connection()
+    try:
+        return conn.execute(
+            'SELECT id, role, content FROM chat_history WHERE session_id = ? AND id > ? ORDER BY id',
+            (session_id, after_id)).fetchall()
+    finally:
+        conn.close()
+
+def compact_session(session_id, summarize):
+    """
+    Folds everything but the newest KEEP_RECENT unsummarized messages into the
+    session summary once at least COMPACT_BATCH of them have accumulated.
+    summarize(previous_summary or None, [(role, content), ...]) -> new summary text.
+    Returns True if the summary was updated.
+    """
+    summary, last_id = database.get_chat_summary(session_id)
+    rows = unsummarized_messages(session_id, last_id)
+    if len(rows) < KEEP_RECENT + COMPACT_BATCH:
+        return False
+    older = rows[:-KEEP_RECENT]
+    new_summary = summarize(summary, [(r['role'], r['content']) for r in older])
+    if not new_summary:
+        return False
+    database.save_chat_summary(session_id, new_summary, older[-1]['id'])
+    return True
+
+def _run(session_id, summarize):
+    try:
+        compact_session(session_id, summarize)
+    except Exception as e:
+        # Left for the next turn to retry; the prompt still carries only KEEP_RECENT messages
+        print(f"Chat summary for session {session_id} failed: {e}")
+    finally:
+        with _lock:
+            _pending.discard(session_id)
+
+def schedule_compaction(session_id, summarize):
+    """Queues compact_session on the background worker, at most once per session at a time."""
+    with _lock:
+        if session_id in _pending:
+            return None
+        _pending.add(session_id)
+    return _executor.submit(_run, session_id, summarize)
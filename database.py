@@ -1,15 +1,234 @@
+import atexit
 import sqlite3
 import os
+import re
+import threading
+import time
+import weakref
+import metrics
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.environ.get("INVENTORY_DB_PATH", os.path.join(BASE_DIR, 'inventory.db'))
+
+# Pool tuning. gunicorn runs with --threads 8, so one connection per thread by default.
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+HEALTH_CHECK_INTERVAL = float(os.environ.get("DB_HEALTH_CHECK_INTERVAL", "30"))
+
+# Applied once when a connection is opened, not on every checkout.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA mmap_size=268435456",  # 256 MB
+    "PRAGMA cache_size=-65536",    # 64 MB (negative = KiB)
+)
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    """Raised when no connection becomes free within POOL_TIMEOUT seconds."""
+
+
+class PooledConnection:
+    """
+    Thin proxy around a pooled sqlite3 connection.
+    Behaves like sqlite3.Connection, except close() hands the connection back
+    to the pool. Used as a context manager it commits (or rolls back) and releases.
+    A nested checkout (the thread already held the connection) leaves commit,
+    rollback and release to the outermost holder, so it never ends the caller's
+    transaction. An outermost checkout that is dropped without close() (an
+    exception skipped it) is rolled back and returned once it is garbage collected.
+    """
+
+    def __init__(self, pool, raw, owner, outermost=True):
+        self._pool = pool
+        self._raw = raw
+        self._owner = owner
+        self._outermost = outermost
+        self._released = False
+        self._finalizer = None
+        if outermost:
+            self._finalizer = weakref.finalize(self, pool._reclaim, raw, owner)
+            self._finalizer.atexit = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return self._raw.execute(sql, parameters)
+        finally:
+            metrics.db_query_duration.observe(time.perf_counter() - start, operation=metrics.sql_operation(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return self._raw.executemany(sql, seq_of_parameters)
+        finally:
+            metrics.db_query_duration.observe(time.perf_counter() - start, operation=metrics.sql_operation(sql))
+
+    def commit(self):
+        if self._outermost:
+            self._raw.commit()
+
+    def rollback(self):
+        if self._outermost:
+            self._raw.rollback()
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            if self._outermost:
+                self._finalizer.detach()
+                self._pool._release(self._raw, self._owner)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            self.close()
+        return False
+
+
+class ConnectionPool:
+    """
+    Thread-aware pool of tuned SQLite connections.
+
+    - A thread that already holds a connection gets the same one back on nested
+      calls (e.g. a tool called from inside a route), so it never waits on itself.
+    - At most `size` connections are open; extra callers wait up to `timeout`.
+    - Idle connections older than HEALTH_CHECK_INTERVAL are pinged before reuse.
+    """
+
+    def __init__(self, db_path, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._idle = []  # LIFO of (connection, last_used)
+        self._held = {}  # thread id -> connection of its outermost checkout
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _is_healthy(self, conn):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        # Connections must not be shared with a forked child (gunicorn workers).
+        if os.getpid() != self._pid:
+            self._reset()
+
+        owner = threading.get_ident()
+        with self._lock:
+            held = self._held.get(owner)
+        if held is not None:
+            return PooledConnection(self, held, owner, outermost=False)
+
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"No database connection available after {self.timeout}s")
+
+        try:
+            conn = None
+            with self._lock:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+            if conn is not None and time.monotonic() - last_used > HEALTH_CHECK_INTERVAL:
+                if not self._is_healthy(conn):
+                    self._discard(conn)
+                    conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._held[owner] = conn
+        return PooledConnection(self, conn, owner)
+
+    def _release(self, conn, owner):
+        # Keyed by the acquiring thread, so a release from another thread also
+        # clears the owner's reference and the connection is never handed out twice
+        with self._lock:
+            if self._held.get(owner) is not conn:
+                return
+            del self._held[owner]
+        self._return(conn)
+
+    def _reclaim(self, conn, owner):
+        """Finalizer of an outermost checkout that was never closed."""
+        print("Reclaiming a database connection that was not closed")
+        self._release(conn, owner)
+
+    def _return(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()  # never hand out a connection mid-transaction
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        except sqlite3.Error:
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close_all(self):
+        """Closes idle connections. Connections currently checked out are left alone."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._lock:
+            idle = len(self._idle)
+        return {"size": self.size, "idle": idle}
+
+
+_pool = ConnectionPool(DB_PATH)
 
 def get_db_connection():
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    db_path = os.path.join(base_dir, 'inventory.db')
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """
+    Returns a pooled connection. Call close() (or use it as a context manager)
+    to give it back to the pool.
+    """
+    return _pool.acquire()
 
 def create_tables():
     conn = get_db_connection()
+    try:
+        _create_schema(conn)
+        conn.commit()
+    finally:
+        conn.close()
+
+def _create_schema(conn):
     conn.execute('''
         CREATE TABLE IF NOT EXISTS products (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -26,14 +245,377 @@ def create_tables():
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    conn.commit()
-    conn.close()
+    # Per-session history lookups walk this index instead of scanning and sorting the table
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_chat_history_session ON chat_history (session_id, id)')
+    # Rolling summary of each session's older messages (see chat_memory.py)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            session_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Disk tier of the query embedding cache (see embedding_cache.py)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS query_embeddings (
+            query TEXT NOT NULL,
+            model TEXT NOT NULL,
+            embedding BLOB NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (query, model)
+        )
+    ''')
+    # Per-chunk results of /inventory-report, keyed by a hash of the chunk contents (see reports.py)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS report_chunks (
+            chunk_key TEXT PRIMARY KEY,
+            result TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Labelled queries for the local chat router (see router.py)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS router_examples (
+            query TEXT PRIMARY KEY,
+            label TEXT NOT NULL,
+            source TEXT NOT NULL DEFAULT 'llm',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Cross-worker single-flight of identical LLM calls (see singleflight.py)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS llm_inflight (
+            key TEXT PRIMARY KEY,
+            owner INTEGER NOT NULL,
+            started_at REAL NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS llm_results (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    create_search_index(conn)
+    create_change_log(conn)
+    create_description_cache(conn)
 
-def get_all_inventory_text():
+# --- Full-text search over product names ---
+# products_fts is an external-content FTS5 table: it stores only the index,
+# and the triggers below keep it in step with every write to products.
+SEARCH_INDEX_TRIGGERS = (
+    '''
+    CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, name) VALUES (new.id, new.name);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name) VALUES ('delete', old.id, old.name);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF name ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name) VALUES ('delete', old.id, old.name);
+        INSERT INTO products_fts(rowid, name) VALUES (new.id, new.name);
+    END
+    ''',
+)
+
+def create_search_index(conn):
+    """
+    Creates the FTS5 index and its sync triggers. Doubles as the migration for
+    existing databases: if the index is new, it is built from the current rows.
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'"
+    ).fetchone()
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            name,
+            content='products',
+            content_rowid='id',
+            prefix='2 3'
+        )
+    ''')
+    for trigger in SEARCH_INDEX_TRIGGERS:
+        conn.execute(trigger)
+    if not exists:
+        conn.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+
+def rebuild_search_index():
+    """Rebuilds the full-text index from the products table."""
+    conn = get_db_connection()
+    try:
+        create_search_index(conn)
+        conn.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+        conn.commit()
+    finally:
+        conn.close()
+
+def to_fts_query(text):
+    """
+    Turns free text into an FTS5 query: every word must match, and each word
+    also matches as a prefix ('pix' finds 'Pixel'). Returns '' if there are no words.
+    """
+    # Same word boundaries as the unicode61 tokenizer (underscore is a separator)
+    tokens = re.findall(r'[^\W_]+', text.lower())
+    return ' '.join(f'"{t}"*' for t in tokens)
+
+def search_products(query, limit=20):
+    """Full-text product search ranked by BM25 (best match first)."""
+    fts_query = to_fts_query(query)
+    if not fts_query:
+        return []
+
+    conn = get_db_connection()
+    try:
+        return conn.execute('''
+            SELECT p.*
+            FROM products_fts
+            JOIN products p ON p.id = products_fts.rowid
+            WHERE products_fts MATCH ?
+            ORDER BY bm25(products_fts)
+            LIMIT ?
+        ''', (fts_query, limit)).fetchall()
+    except sqlite3.OperationalError as e:
+        # Database not migrated yet (run init_db.py); fall back to a table scan.
+        print(f"Full-text search unavailable ({e}), falling back to LIKE")
+        return conn.execute(
+            'SELECT * FROM products WHERE lower(name) LIKE ? LIMIT ?',
+            ('%' + query.lower() + '%', limit)
+        ).fetchall()
+    finally:
+        conn.close()
+
+# --- Change log for the vector index ---
+# Every product write appends the product id here; vector_store applies the
+# queued ids to the embeddings incrementally and then trims the log.
+CHANGE_LOG_TRIGGERS = (
+    '''
+    CREATE TRIGGER IF NOT EXISTS product_changes_ai AFTER INSERT ON products BEGIN
+        INSERT INTO product_changes (product_id) VALUES (new.id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS product_changes_ad AFTER DELETE ON products BEGIN
+        INSERT INTO product_changes (product_id) VALUES (old.id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS product_changes_au AFTER UPDATE OF name, price ON products BEGIN
+        INSERT INTO product_changes (product_id) VALUES (new.id);
+    END
+    ''',
+)
+
+def create_change_log(conn):
+    """Creates the product_changes table and the triggers that fill it."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS product_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL
+        )
+    ''')
+    for trigger in CHANGE_LOG_TRIGGERS:
+        conn.execute(trigger)
+
+# --- Bulk inserts ---
+# The per-row insert triggers that maintain the full-text index and the change
+# log are suspended during a bulk insert; both are filled with one INSERT ...
+# SELECT over the new id range instead. Trigger DDL is transactional, so other
+# connections never see the triggers missing.
+BULK_SUSPENDED_TRIGGERS = ('products_fts_ai', 'product_changes_ai')
+
+def insert_products_bulk(rows):
+    """
+    Inserts [(name, price), ...] in one transaction and returns the new ids as
+    (first_id, last_id), or None if rows is empty. The vector index picks the
+    rows up from the change log like any other write.
+    """
+    rows = list(rows)
+    if not rows:
+        return None
+    conn = get_db_connection()
+    try:
+        # Take the write lock up front so the new ids are exactly those above the current max
+        conn.execute('BEGIN IMMEDIATE')
+        before = conn.execute('SELECT coalesce(max(id), 0) FROM products').fetchone()[0]
+        for name in BULK_SUSPENDED_TRIGGERS:
+            conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+        conn.executemany('INSERT INTO products (name, price) VALUES (?, ?)', rows)
+        first, last = conn.execute('SELECT min(id), max(id) FROM products WHERE id > ?', (before,)).fetchone()
+        conn.execute('INSERT INTO products_fts(rowid, name) SELECT id, name FROM products WHERE id > ?', (before,))
+        conn.execute('INSERT INTO product_changes (product_id) SELECT id FROM products WHERE id > ?', (before,))
+        create_search_index(conn)
+        create_change_log(conn)
+        conn.commit()
+        return first, last
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+# --- Cache of AI product descriptions ---
+# Keyed by product id plus a hash of the name and prompt; renaming or deleting
+# a product drops its entry.
+DESCRIPTION_CACHE_TRIGGERS = (
+    '''
+    CREATE TRIGGER IF NOT EXISTS product_descriptions_au AFTER UPDATE OF name ON products BEGIN
+        DELETE FROM product_descriptions WHERE product_id = old.id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS product_descriptions_ad AFTER DELETE ON products BEGIN
+        DELETE FROM product_descriptions WHERE product_id = old.id;
+    END
+    ''',
+)
+
+def create_description_cache(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS product_descriptions (
+            product_id INTEGER PRIMARY KEY,
+            cache_key TEXT NOT NULL,
+            description TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    for trigger in DESCRIPTION_CACHE_TRIGGERS:
+        conn.execute(trigger)
+
+def get_cached_description(product_id, cache_key):
+    """Returns the stored description if it was generated for this exact name and prompt."""
     conn = get_db_connection()
-    products = conn.execute('SELECT * FROM products').fetchall()
-    conn.close()
-    
+    try:
+        row = conn.execute(
+            'SELECT description FROM product_descriptions WHERE product_id = ? AND cache_key = ?',
+            (product_id, cache_key)).fetchone()
+        return row['description'] if row else None
+    finally:
+        conn.close()
+
+def save_description(product_id, cache_key, description):
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            'INSERT OR REPLACE INTO product_descriptions (product_id, cache_key, description) VALUES (?, ?, ?)',
+            (product_id, cache_key, description))
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_chat_summary(session_id):
+    """Returns (summary, id of the last message it covers), or (None, 0) if the session has none."""
+    conn = get_db_connection()
+    try:
+        row = conn.execute('SELECT summary, last_message_id FROM chat_summaries WHERE session_id = ?',
+                           (session_id,)).fetchone()
+        return (row['summary'], row['last_message_id']) if row else (None, 0)
+    finally:
+        conn.close()
+
+def save_chat_summary(session_id, summary, last_message_id):
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            'INSERT OR REPLACE INTO chat_summaries (session_id, summary, last_message_id, updated_at) '
+            'VALUES (?, ?, ?, CURRENT_TIMESTAMP)',
+            (session_id, summary, last_message_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+# --- Write-behind chat log ---
+# Chat messages are queued and written in batches (one transaction every
+# CHAT_FLUSH_INTERVAL seconds or CHAT_FLUSH_BATCH rows) by a background thread,
+# so chat requests don't pay for a commit or contend for the writer lock.
+CHAT_WRITE_BEHIND = os.environ.get("CHAT_WRITE_BEHIND", "1") == "1"
+CHAT_FLUSH_INTERVAL = float(os.environ.get("CHAT_FLUSH_INTERVAL", "0.01"))
+CHAT_FLUSH_BATCH = int(os.environ.get("CHAT_FLUSH_BATCH", "100"))
+
+
+class ChatWriter:
+    """
+    Batches chat_history inserts from all threads. Messages are written in the
+    order they were appended. flush(session_id) writes everything queued so far
+    when that session has unwritten messages, so readers see their own writes.
+    """
+
+    def __init__(self, interval=CHAT_FLUSH_INTERVAL, batch_size=CHAT_FLUSH_BATCH):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._cond = threading.Condition()
+        # Held from taking a batch until it is committed, so batches land in order
+        self._write_lock = threading.Lock()
+        self._buffer = []
+        self._pending = {}
+        self._thread = None
+        self.batches = 0
+        self.rows = 0
+
+    def append(self, session_id, role, content):
+        with self._cond:
+            self._buffer.append((session_id, role, content))
+            self._pending[session_id] = self._pending.get(session_id, 0) + 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="chat-writer", daemon=True)
+                self._thread.start()
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._buffer)
+                # Let a batch build up unless it is already full
+                self._cond.wait_for(lambda: len(self._buffer) >= self.batch_size, timeout=self.interval)
+            self._write_batch()
+
+    def _write_batch(self):
+        with self._write_lock:
+            with self._cond:
+                batch, self._buffer = self._buffer, []
+            if not batch:
+                return
+            try:
+                with get_db_connection() as conn:
+                    conn.executemany('INSERT INTO chat_history (session_id, role, content) VALUES (?, ?, ?)', batch)
+                self.batches += 1
+                self.rows += len(batch)
+            except Exception as e:
+                print(f"Error saving {len(batch)} chat messages: {e}")
+            finally:
+                with self._cond:
+                    for session_id, _, _ in batch:
+                        self._pending[session_id] -= 1
+                        if not self._pending[session_id]:
+                            del self._pending[session_id]
+
+    def flush(self, session_id=None):
+        """Writes queued messages now; with session_id, only if that session has any outstanding."""
+        if session_id is not None:
+            with self._cond:
+                if session_id not in self._pending:
+                    return
+        # Also waits out a batch the background thread has taken but not yet committed
+        self._write_batch()
+
+    def stats(self):
+        with self._cond:
+            queued = len(self._buffer)
+        return {"queued": queued, "batches": self.batches, "rows": self.rows}
+
+chat_writer = ChatWriter()
+atexit.register(chat_writer.flush)
+
+def get_all_inventory_text():
+    with get_db_connection() as conn:
+        products = conn.execute('SELECT * FROM products').fetchall()
+
     inventory_text = ", ".join(
         [f"Product {p['id']}: {p['name']} (${p['price']})" for p in products]
     )
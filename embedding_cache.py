@@ -0,0 +1,125 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from database import get_db_connection
+
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", "2048"))
+# Keep query embeddings in SQLite too, so hot queries survive restarts
+QUERY_CACHE_PERSIST = os.environ.get("QUERY_CACHE_PERSIST", "0") == "1"
+QUERY_CACHE_DISK_MAX = int(os.environ.get("QUERY_CACHE_DISK_MAX", "100000"))
+# Trim the disk tier back to QUERY_CACHE_DISK_MAX every this many writes
+DISK_PRUNE_EVERY = 500
+
+
+def cache_key(text):
+    """Case and whitespace insensitive key (the MiniLM tokenizer is uncased anyway)."""
+    return " ".join(text.lower().split())
+
+
+class QueryEmbeddingCache:
+    """
+    Bounded LRU of query text -> normalised embedding, with hit/miss counters.
+    With persist=True, misses in memory fall through to the query_embeddings
+    table and new embeddings are written there as well.
+    """
+
+    def __init__(self, model_name, max_size=QUERY_CACHE_SIZE, persist=QUERY_CACHE_PERSIST):
+        self.model_name = model_name
+        self.max_size = max_size
+        self.persist = persist
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._disk_writes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        """Returns {key: vector} for the keys that are cached; counts hits and misses."""
+        found = {}
+        with self._lock:
+            for key in keys:
+                vector = self._entries.get(key)
+                if vector is not None:
+                    self._entries.move_to_end(key)
+                    found[key] = vector
+            self.hits += len(found)
+
+        missing = [k for k in dict.fromkeys(keys) if k not in found]
+        if missing and self.persist:
+            from_disk = self._disk_get(missing)
+            if from_disk:
+                self._remember(from_disk)
+                found.update(from_disk)
+                with self._lock:
+                    self.disk_hits += len(from_disk)
+        with self._lock:
+            self.misses += len([k for k in missing if k not in found])
+        return found
+
+    def put_many(self, items):
+        """Stores {key: vector} in memory (and on disk when persisting)."""
+        self._remember(items)
+        if self.persist:
+            self._disk_put(items)
+
+    def _remember(self, items):
+        with self._lock:
+            for key, vector in items.items():
+                self._entries[key] = vector
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _disk_get(self, keys):
+        conn = get_db_connection()
+        try:
+            placeholders = ','.join('?' * len(keys))
+            rows = conn.execute(
+                f'SELECT query, embedding FROM query_embeddings WHERE model = ? AND query IN ({placeholders})',
+                [self.model_name, *keys]).fetchall()
+            return {r['query']: np.frombuffer(r['embedding'], dtype='float32') for r in rows}
+        except Exception as e:
+            print(f"Query cache disk read failed: {e}")
+            return {}
+        finally:
+            conn.close()
+
+    def _disk_put(self, items):
+        conn = get_db_connection()
+        try:
+            conn.executemany(
+                'INSERT OR REPLACE INTO query_embeddings (query, model, embedding) VALUES (?, ?, ?)',
+                [(k, self.model_name, np.asarray(v, dtype='float32').tobytes()) for k, v in items.items()])
+            self._disk_writes += len(items)
+            if self._disk_writes >= DISK_PRUNE_EVERY:
+                self._disk_writes = 0
+                conn.execute('''
+                    DELETE FROM query_embeddings WHERE rowid IN (
+                        SELECT rowid FROM query_embeddings ORDER BY created_at DESC LIMIT -1 OFFSET ?
+                    )
+                ''', (QUERY_CACHE_DISK_MAX,))
+            conn.commit()
+        except Exception as e:
+            print(f"Query cache disk write failed: {e}")
+        finally:
+            conn.close()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.disk_hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else None,
+                "persist": self.persist,
+            }
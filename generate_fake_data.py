@@ -1,34 +1,219 @@
-import sqlite3
-import random
+import argparse
+import json
+import os
+import time
+import numpy as np
+import database
+import vector_store
 from database import get_db_connection
 
-def generate_fake_data(num_items=1000):
-    print(f"Generating {num_items} fake products...")
-    
-    adjectives = ["Professional", "Ergonomic", "Wireless", "Smart", "4K", "Noise-Cancelling", "Portable", "Compact", "Gaming", "Vintage", "Waterproof", "Solar-Powered", "AI-Driven", "Heavy-Duty", "Lightweight", "Premium", "Budget", "Refurbished", "Limited Edition", "Ultra-Slim"]
-    brands = ["Logitech", "Sony", "Dell", "Samsung", "Apple", "Canon", "Nike", "Adidas", "Generic", "AmazonBasics", "Razer", "Corsair", "Asus", "HP", "Lenovo", "Microsoft", "Google", "Bose", "JBL", "Anker"]
-    nouns = ["Mouse", "Keyboard", "Monitor", "Headphones", "Camera", "Laptop", "Phone", "Charger", "Dock", "Speaker", "Microphone", "Tablet", "Watch", "Drone", "Router", "Hard Drive", "SSD", "Webcam", "Projector", "Backpack"]
-    
-    products = []
-    
-    for _ in range(num_items):
-        name = f"{random.choice(brands)} {random.choice(adjectives)} {random.choice(nouns)}"
-        # Add a random model number suffix sometimes
-        if random.random() > 0.5:
-            name += f" {random.randint(100, 9000)}{random.choice(['X', 'Pro', 'S', ' Plus', ' Ultra', ''])}"
-            
-        price = round(random.uniform(10.0, 5000.0), 2)
-        products.append((name, price))
-        
-    conn = get_db_connection()
-    try:
-        conn.executemany('INSERT INTO products (name, price) VALUES (?, ?)', products)
-        conn.commit()
-        print(f"Successfully inserted {num_items} products.")
-    except Exception as e:
-        print(f"Error inserting data: {e}")
-    finally:
-        conn.close()
+# Synthetic catalog for load testing. Names and prices are sampled with NumPy
+# a batch at a time and inserted with database.insert_products_bulk, so memory
+# stays flat and 10M rows take minutes. The same seed and batch size always
+# produce the same catalog.
+
+ADJECTIVES = ["Professional", "Ergonomic", "Wireless", "Smart", "4K", "Noise-Cancelling", "Portable", "Compact", "Gaming", "Vintage", "Waterproof", "Solar-Powered", "AI-Driven", "Heavy-Duty", "Lightweight", "Premium", "Budget", "Refurbished", "Limited Edition", "Ultra-Slim"]
+# Ordered by popularity: with brand skew s, brand k is picked with weight 1 / k^s
+BRANDS = ["Samsung", "Apple", "Sony", "Logitech", "Dell", "HP", "Lenovo", "Anker", "AmazonBasics", "Google", "Microsoft", "Asus", "Bose", "JBL", "Canon", "Razer", "Corsair", "Nike", "Adidas", "Generic"]
+# Noun -> typical (median) price, used by the lognormal price distribution
+NOUNS = {
+    "Mouse": 40, "Keyboard": 80, "Monitor": 300, "Headphones": 150, "Camera": 800,
+    "Laptop": 1200, "Phone": 800, "Charger": 30, "Dock": 150, "Speaker": 120,
+    "Microphone": 100, "Tablet": 500, "Watch": 300, "Drone": 700, "Router": 150,
+    "Hard Drive": 90, "SSD": 110, "Webcam": 70, "Projector": 600, "Backpack": 60,
+}
+MODEL_SUFFIXES = ["X", "Pro", "S", " Plus", " Ultra", ""]
+
+PRICE_DISTRIBUTIONS = ("lognormal", "uniform")
+MIN_PRICE, MAX_PRICE = 1.0, 20000.0
+BATCH_SIZE = 50000
+# Dimension of the synthetic vectors written by --embeddings (all-MiniLM-L6-v2)
+EMBEDDING_DIM = 384
+
+
+def brand_weights(skew):
+    """Zipf weights over BRANDS; skew=0 is uniform."""
+    weights = 1.0 / np.arange(1, len(BRANDS) + 1) ** skew
+    return weights / weights.sum()
+
+def sample_batch(rng, size, price_dist="lognormal", brand_skew=1.1, price_sigma=0.6):
+    """
+    Samples one batch of products. Returns (names, prices, (brand, adjective, noun) index arrays).
+    About half the names get a model number, as in real catalogs.
+    """
+    nouns = list(NOUNS)
+    brand_idx = rng.choice(len(BRANDS), size=size, p=brand_weights(brand_skew))
+    adj_idx = rng.integers(len(ADJECTIVES), size=size)
+    noun_idx = rng.integers(len(nouns), size=size)
+
+    names = np.char.add(np.char.add(np.array(BRANDS)[brand_idx], " "), np.array(ADJECTIVES)[adj_idx])
+    names = np.char.add(np.char.add(names, " "), np.array(nouns)[noun_idx])
+    model = np.char.add(np.char.mod(" %d", rng.integers(100, 9000, size=size)),
+                        np.array(MODEL_SUFFIXES)[rng.integers(len(MODEL_SUFFIXES), size=size)])
+    names = np.where(rng.random(size) < 0.5, np.char.add(names, model), names)
+
+    if price_dist == "lognormal":
+        medians = np.array([NOUNS[n] for n in nouns], dtype=float)[noun_idx]
+        prices = medians * np.exp(rng.normal(0.0, price_sigma, size=size))
+    elif price_dist == "uniform":
+        prices = rng.uniform(10.0, 5000.0, size=size)
+    else:
+        raise ValueError(f"Unknown price distribution '{price_dist}', expected one of {PRICE_DISTRIBUTIONS}")
+    prices = np.round(np.clip(prices, MIN_PRICE, MAX_PRICE), 2)
+    return names, prices, (brand_idx, adj_idx, noun_idx)
+
+def synthetic_embeddings(rng, indices, dim=EMBEDDING_DIM):
+    """
+    Unit vectors that cluster like real ones: a fixed random direction per noun,
+    brand and adjective (seeded by `rng`), mixed by weight plus per-row noise.
+    """
+    brand_idx, adj_idx, noun_idx = indices
+    return vector_store.normalize(
+        1.0 * _token_vectors(len(NOUNS), dim, 1)[noun_idx]
+        + 0.5 * _token_vectors(len(BRANDS), dim, 2)[brand_idx]
+        + 0.3 * _token_vectors(len(ADJECTIVES), dim, 3)[adj_idx]
+        + 0.2 * rng.standard_normal((len(noun_idx), dim), dtype=np.float32))
+
+def _token_vectors(count, dim, stream):
+    return np.random.default_rng([0, stream]).standard_normal((count, dim), dtype=np.float32)
+
+def generate_fake_data(num_items=1000, seed=0, batch_size=BATCH_SIZE, price_dist="lognormal",
+                       brand_skew=1.1, embeddings=False):
+    """
+    Inserts num_items synthetic products, one transaction per batch_size rows.
+    With embeddings=True also writes the vector index files for them (synthetic
+    vectors, no model needed); the products table must be empty beforehand.
+    Returns (first id, last id) of the new rows.
+    """
+    print(f"Generating {num_items} fake products (seed {seed}, {price_dist} prices, brand skew {brand_skew})...")
+    if embeddings and _product_count():
+        raise SystemExit("--embeddings needs an empty products table (use --reset)")
+
+    start = time.time()
+    first_id = last_id = None
+    embedding_file = metadata_file = None
+    if embeddings:
+        embedding_path = vector_store.EMBEDDINGS_PATH + ".tmp.npy"
+        embedding_file = np.lib.format.open_memmap(embedding_path, mode="w+", dtype=np.float32,
+                                                   shape=(num_items, EMBEDDING_DIM))
+        metadata_file = open(vector_store.METADATA_PATH + ".tmp", "w")
+        metadata_file.write("[")
+
+    done = 0
+    for batch_no, offset in enumerate(range(0, num_items, batch_size)):
+        size = min(batch_size, num_items - offset)
+        # Each batch has its own stream, so batches are independent of one another
+        rng = np.random.default_rng([seed, batch_no])
+        names, prices, indices = sample_batch(rng, size, price_dist, brand_skew)
+        names, prices = names.tolist(), prices.tolist()
+        ids = database.insert_products_bulk(zip(names, prices))
+        first_id = ids[0] if first_id is None else first_id
+        last_id = ids[1]
+
+        if embeddings:
+            embedding_file[offset:offset + size] = synthetic_embeddings(rng, indices)
+            metadata = [vector_store.product_metadata({"id": pid, "name": name, "price": price})
+                        for pid, name, price in zip(range(ids[0], ids[1] + 1), names, prices)]
+            chunk = json.dumps(metadata)[1:-1]
+            metadata_file.write(chunk if offset == 0 else "," + chunk)
+
+        done += size
+        elapsed = time.time() - start
+        print(f"  {done}/{num_items} rows ({round(done / elapsed) if elapsed else done} rows/s)")
+
+    if embeddings:
+        embedding_file.flush()
+        del embedding_file
+        metadata_file.write("]")
+        metadata_file.close()
+        _install_index(first_id, last_id)
+
+    print(f"Successfully inserted {num_items} products in {time.time() - start:.1f}s.")
+    return first_id, last_id
+
+def _product_count():
+    with get_db_connection() as conn:
+        return conn.execute('SELECT count(*) FROM products').fetchone()[0]
+
+def _install_index(first_id, last_id):
+    """Swaps in the fixture index files and drops their rows from the change log."""
+    os.replace(vector_store.METADATA_PATH + ".tmp", vector_store.METADATA_PATH)
+    os.replace(vector_store.EMBEDDINGS_PATH + ".tmp.npy", vector_store.EMBEDDINGS_PATH)
+    vector_store._build_ann(np.load(vector_store.EMBEDDINGS_PATH, mmap_mode="r"))
+    # Otherwise the index worker would re-embed every generated row with the real model
+    with get_db_connection() as conn:
+        conn.execute('DELETE FROM product_changes WHERE product_id BETWEEN ? AND ?', (first_id, last_id))
+    print(f"Saved '{vector_store.EMBEDDINGS_PATH}' and '{vector_store.METADATA_PATH}' (synthetic vectors)")
+
+CHAT_QUESTIONS = ["Do you have any {brand} {noun}?", "How much is the cheapest {noun}?",
+                  "Show me {adjective} {noun} options", "Is the {brand} {noun} in stock?",
+                  "Compare {brand} and {other} {noun} prices"]
+CHAT_ANSWERS = ["We have several {brand} {noun} models in stock.", "The cheapest {noun} is ${price}.",
+                "Here are our {adjective} {noun} options.", "Yes, the {brand} {noun} is available for ${price}.",
+                "{brand} {noun} prices start at ${price}."]
+
+def generate_chat_history(sessions, turns=10, seed=0, batch_size=BATCH_SIZE):
+    """
+    Inserts `sessions` chat sessions of `turns` user/model exchanges each, with
+    questions about the same brands and nouns as the catalog.
+    """
+    print(f"Generating {sessions} chat sessions with {turns} turns each...")
+    rng = np.random.default_rng([seed, 1 << 32])
+    nouns = list(NOUNS)
+    rows = []
+    for session in range(sessions):
+        session_id = f"synthetic-{seed}-{session}"
+        brand = rng.choice(len(BRANDS), size=turns * 2, p=brand_weights(1.1))
+        noun = rng.integers(len(nouns), size=turns)
+        adjective = rng.integers(len(ADJECTIVES), size=turns)
+        template = rng.integers(len(CHAT_QUESTIONS), size=turns)
+        for t in range(turns):
+            n = nouns[noun[t]]
+            fields = {"brand": BRANDS[brand[2 * t]], "other": BRANDS[brand[2 * t + 1]], "noun": n,
+                      "adjective": ADJECTIVES[adjective[t]], "price": NOUNS[n]}
+            rows.append((session_id, 'user', CHAT_QUESTIONS[template[t]].format(**fields)))
+            rows.append((session_id, 'model', CHAT_ANSWERS[template[t]].format(**fields)))
+        if len(rows) >= batch_size:
+            _insert_chat_rows(rows)
+            rows = []
+    _insert_chat_rows(rows)
+    print(f"Successfully inserted {sessions * turns * 2} chat messages.")
+
+def _insert_chat_rows(rows):
+    if rows:
+        with get_db_connection() as conn:
+            conn.executemany('INSERT INTO chat_history (session_id, role, content) VALUES (?, ?, ?)', rows)
+
+def reset():
+    """Empties products and chat history, with their indexes."""
+    with get_db_connection() as conn:
+        for table in ('products', 'product_descriptions', 'chat_history', 'chat_summaries'):
+            conn.execute(f'DELETE FROM {table}')
+    database.rebuild_search_index()
+    print("Cleared products and chat history.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the database with a synthetic catalog for load testing")
+    parser.add_argument("count", type=int, nargs="?", default=1000, help="products to generate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="rows per transaction")
+    parser.add_argument("--price-dist", choices=PRICE_DISTRIBUTIONS, default="lognormal")
+    parser.add_argument("--brand-skew", type=float, default=1.1, help="Zipf exponent for brand popularity (0 = uniform)")
+    parser.add_argument("--embeddings", action="store_true",
+                        help="also write the vector index with synthetic vectors (needs an empty table)")
+    parser.add_argument("--chat-sessions", type=int, default=0, help="chat sessions to generate")
+    parser.add_argument("--chat-turns", type=int, default=10, help="user/model exchanges per session")
+    parser.add_argument("--reset", action="store_true", help="delete existing products and chat history first")
+    args = parser.parse_args()
+
+    database.create_tables()
+    if args.reset:
+        reset()
+    if args.count:
+        generate_fake_data(args.count, seed=args.seed, batch_size=args.batch_size, price_dist=args.price_dist,
+                           brand_skew=args.brand_skew, embeddings=args.embeddings)
+    if args.chat_sessions:
+        generate_chat_history(args.chat_sessions, turns=args.chat_turns, seed=args.seed, batch_size=args.batch_size)
 
 if __name__ == "__main__":
-    generate_fake_data()
+    main()
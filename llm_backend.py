@@ -0,0 +1,397 @@
+import asyncio
+import collections
+import json
+import os
+import random
+import re
+import threading
+import time
+from google.genai import types
+import metrics
+import rate_limiter
+import singleflight
+
+# Every model call goes through `backend`, picked with LLM_BACKEND:
+#   gemini  the real API (default)
+#   fake    scripted responses after a configurable latency, no network
+#   record  the real API, with every exchange appended to LLM_RECORD_PATH
+#   replay  answers from LLM_RECORD_PATH only, no network
+# All of them return google.genai response objects, so callers can't tell the difference.
+BACKEND = os.environ.get("LLM_BACKEND", "gemini")
+RECORD_PATH = os.environ.get("LLM_RECORD_PATH", "llm_recordings.jsonl")
+# Fake backend: rules file, latency distribution, share of calls that fail with a 429
+FAKE_SCRIPT = os.environ.get("LLM_FAKE_SCRIPT")
+FAKE_LATENCY = os.environ.get("LLM_FAKE_LATENCY", "fixed:0")
+FAKE_ERROR_RATE = float(os.environ.get("LLM_FAKE_ERROR_RATE", "0"))
+FAKE_SEED = os.environ.get("LLM_FAKE_SEED")
+FAKE_STREAM_CHUNKS = 4
+# Recent calls a FakeBackend remembers for tests; long load runs must not grow it
+FAKE_CALL_HISTORY = 100
+
+
+class GeminiBackend:
+    """The google-genai client. Created on first use, so importing this module needs no API key."""
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from google import genai
+                    self._client = genai.Client(api_key=self.api_key or os.environ.get("GEMINI_API_KEY"))
+        return self._client
+
+    def generate(self, model, contents, config=None):
+        return self.client.models.generate_content(model=model, contents=contents, config=config)
+
+    def generate_stream(self, model, contents, config=None):
+        return self.client.models.generate_content_stream(model=model, contents=contents, config=config)
+
+    async def agenerate(self, model, contents, config=None):
+        return await self.client.aio.models.generate_content(model=model, contents=contents, config=config)
+
+
+# --- Fake backend ---
+class FakeAPIError(Exception):
+    """Raised for scripted errors. Messages look like the real API's, so 429 handling kicks in."""
+
+
+def parse_latency(spec):
+    """
+    Latency sampler in seconds from 'fixed:MS', 'uniform:LO_MS:HI_MS' or
+    'lognormal:MEDIAN_MS:SIGMA'. Raises ValueError on anything else.
+    """
+    kind, *args = spec.split(":")
+    try:
+        values = [float(a) for a in args]
+        if kind == "fixed" and len(values) == 1:
+            return lambda rng: values[0] / 1000
+        if kind == "uniform" and len(values) == 2:
+            return lambda rng: rng.uniform(*values) / 1000
+        if kind == "lognormal" and len(values) == 2:
+            return lambda rng: values[0] * rng.lognormvariate(0, values[1]) / 1000
+    except ValueError:
+        pass
+    raise ValueError(f"Invalid latency spec '{spec}' (use fixed:MS, uniform:LO:HI or lognormal:MEDIAN:SIGMA)")
+
+def last_turn_text(contents):
+    """Text of the newest message in a prompt (a string, a Content or a list of them)."""
+    if isinstance(contents, str):
+        return contents
+    if isinstance(contents, (list, tuple)):
+        return last_turn_text(contents[-1]) if contents else ""
+    parts = getattr(contents, "parts", None) or []
+    return " ".join(p.text for p in parts if getattr(p, "text", None))
+
+def sample_from_schema(schema):
+    """A minimal value matching a response schema (dict or types.Schema), for structured-output calls."""
+    if hasattr(schema, "model_dump"):
+        schema = schema.model_dump(mode="json", exclude_none=True)
+    kind = str(schema.get("type", "STRING")).upper()
+    if kind == "OBJECT":
+        return {name: sample_from_schema(prop) for name, prop in (schema.get("properties") or {}).items()}
+    if kind == "ARRAY":
+        return [sample_from_schema(schema["items"])] if schema.get("items") else []
+    if kind in ("NUMBER", "INTEGER"):
+        return 0
+    if kind == "BOOLEAN":
+        return False
+    return (schema.get("enum") or ["fake"])[0]
+
+def make_response(text=None, function_call=None, tokens=None):
+    """A GenerateContentResponse with one candidate holding text or a function call."""
+    if function_call is not None:
+        part = types.Part(function_call=types.FunctionCall(name=function_call["name"], args=function_call.get("args") or {}))
+    else:
+        part = types.Part(text=text)
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=[part]), finish_reason="STOP")],
+        usage_metadata=types.GenerateContentResponseUsageMetadata(total_token_count=tokens),
+    )
+
+
+class FakeBackend:
+    """
+    Scripted responses with simulated latency. Rules are tried in order against
+    the text of the newest message; the first match answers:
+
+        {"match": "samsung", "function_call": {"name": "search_inventory", "args": {"query": "samsung"}}}
+        {"match": "report", "json": {"categories": []}}
+        {"error": "429 RESOURCE_EXHAUSTED. Please retry in 1s.", "times": 2}
+        {"text": "Sure."}
+
+    "match" is a case-insensitive substring (every message matches without it),
+    "model" limits a rule to one model and "times" retires it after that many uses.
+    With no matching rule, structured-output calls get a value built from their
+    schema and everything else gets "Fake response.". error_rate fails that share
+    of calls with a 429 before the rules are looked at. `calls` keeps the last
+    FAKE_CALL_HISTORY calls (model and text) for tests to inspect.
+    """
+
+    def __init__(self, rules=None, latency=FAKE_LATENCY, error_rate=FAKE_ERROR_RATE, seed=FAKE_SEED):
+        self.rules = [dict(rule) for rule in (rules or [])]
+        self.latency = parse_latency(latency) if isinstance(latency, str) else latency
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = collections.deque(maxlen=FAKE_CALL_HISTORY)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        with open(path) as f:
+            return cls(json.load(f), **kwargs)
+
+    def _delay(self):
+        with self._lock:
+            return max(0.0, self.latency(self._rng))
+
+    def _answer(self, model, contents, config):
+        """Picks the rule for this call; returns (text, function_call) or raises FakeAPIError."""
+        text = last_turn_text(contents)
+        with self._lock:
+            self.calls.append({"model": model, "text": text})
+            if self.error_rate and self._rng.random() < self.error_rate:
+                raise FakeAPIError("429 RESOURCE_EXHAUSTED. Please retry in 1s.")
+            rule = None
+            for candidate in self.rules:
+                if candidate.get("times") == 0:
+                    continue
+                if candidate.get("model") not in (None, model):
+                    continue
+                if candidate.get("match") and candidate["match"].lower() not in text.lower():
+                    continue
+                rule = candidate
+                if "times" in rule:
+                    rule["times"] -= 1
+                break
+
+        if rule is not None:
+            if "error" in rule:
+                raise FakeAPIError(rule["error"])
+            if "function_call" in rule:
+                return None, rule["function_call"]
+            if "json" in rule:
+                return json.dumps(rule["json"]), None
+            return rule.get("text", ""), None
+        schema = getattr(config, "response_schema", None)
+        if schema is not None:
+            return json.dumps(sample_from_schema(schema)), None
+        return "Fake response.", None
+
+    def _tokens(self, contents, text):
+        return len(json.dumps(singleflight._canonical(contents))) // 4 + len(text or "") // 4
+
+    def generate(self, model, contents, config=None):
+        delay = self._delay()
+        time.sleep(delay)
+        text, function_call = self._answer(model, contents, config)
+        return make_response(text, function_call, self._tokens(contents, text))
+
+    def generate_stream(self, model, contents, config=None):
+        delay = self._delay()
+        text, function_call = self._answer(model, contents, config)
+        if function_call is not None or not text:
+            time.sleep(delay)
+            yield make_response(text, function_call, self._tokens(contents, text))
+            return
+        # The answer arrives in a few chunks spread over the sampled latency
+        words = text.split(" ")
+        step = max(1, -(-len(words) // FAKE_STREAM_CHUNKS))
+        pieces = [" ".join(words[i:i + step]) + (" " if i + step < len(words) else "")
+                  for i in range(0, len(words), step)]
+        for i, piece in enumerate(pieces):
+            time.sleep(delay / len(pieces))
+            last = i == len(pieces) - 1
+            yield make_response(piece, tokens=self._tokens(contents, text) if last else None)
+
+    async def agenerate(self, model, contents, config=None):
+        await asyncio.sleep(self._delay())
+        text, function_call = self._answer(model, contents, config)
+        return make_response(text, function_call, self._tokens(contents, text))
+
+
+# --- Record / replay ---
+class RecordingBackend:
+    """Passes calls to `inner` and appends each exchange to a JSONL file for ReplayBackend."""
+
+    def __init__(self, inner=None, path=RECORD_PATH):
+        self.inner = inner or GeminiBackend()
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _write(self, model, contents, config, kind, responses):
+        entry = {"key": singleflight.request_key(model, contents, config), "kind": kind, "model": model,
+                 "responses": [r.model_dump(mode="json", exclude_none=True) for r in responses]}
+        with self._lock, open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def generate(self, model, contents, config=None):
+        response = self.inner.generate(model, contents, config)
+        self._write(model, contents, config, "generate", [response])
+        return response
+
+    def generate_stream(self, model, contents, config=None):
+        chunks = []
+        for chunk in self.inner.generate_stream(model, contents, config):
+            chunks.append(chunk)
+            yield chunk
+        self._write(model, contents, config, "stream", chunks)
+
+    async def agenerate(self, model, contents, config=None):
+        response = await self.inner.agenerate(model, contents, config)
+        self._write(model, contents, config, "generate", [response])
+        return response
+
+
+class ReplayBackend:
+    """
+    Answers from a RecordingBackend file, matched on model, prompt and config.
+    A request recorded several times replays its responses in order, then cycles.
+    Raises LookupError for a request that was never recorded.
+    """
+
+    def __init__(self, path=RECORD_PATH):
+        self.path = path
+        self._recordings = {}
+        self._next = {}
+        self._lock = threading.Lock()
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._recordings.setdefault((entry["kind"], entry["key"]), []).append(entry["responses"])
+
+    def _responses(self, kind, model, contents, config):
+        key = (kind, singleflight.request_key(model, contents, config))
+        with self._lock:
+            recorded = self._recordings.get(key)
+            if not recorded:
+                raise LookupError(f"No recorded {kind} response for this {model} request "
+                                  f"(key {key[1][:12]}); record it with LLM_BACKEND=record")
+            i = self._next.get(key, 0)
+            self._next[key] = i + 1
+        return [types.GenerateContentResponse.model_validate(r) for r in recorded[i % len(recorded)]]
+
+    def generate(self, model, contents, config=None):
+        return self._responses("generate", model, contents, config)[0]
+
+    def generate_stream(self, model, contents, config=None):
+        yield from self._responses("stream", model, contents, config)
+
+    async def agenerate(self, model, contents, config=None):
+        return self.generate(model, contents, config)
+
+
+def create_backend(name=BACKEND):
+    if name == "gemini":
+        return GeminiBackend()
+    if name == "fake":
+        return FakeBackend.from_file(FAKE_SCRIPT) if FAKE_SCRIPT else FakeBackend()
+    if name == "record":
+        return RecordingBackend()
+    if name == "replay":
+        return ReplayBackend()
+    raise ValueError(f"Unknown LLM_BACKEND '{name}' (use gemini, fake, record or replay)")
+
+backend = create_backend()
+
+
+# --- Rate-limited calls with 429 retries ---
+MAX_RETRIES = 3
+BASE_DELAY = 5
+
+def acquire_quota(model_limiter, estimated, priority, model, purpose, attempt):
+    """model_limiter.acquire, with the wait recorded as queueing (first attempt) or 429 backoff (retries)."""
+    started = time.perf_counter()
+    try:
+        model_limiter.acquire(estimated, priority)
+    except rate_limiter.RateLimitExceeded:
+        metrics.llm_requests.inc(model=model, purpose=purpose, outcome="shed")
+        raise
+    finally:
+        waited = time.perf_counter() - started
+        (metrics.llm_backoff_seconds if attempt else metrics.llm_queue_seconds).inc(waited, model=model, purpose=purpose)
+
+def observe_call(model, purpose, started, response=None, error=None):
+    metrics.llm_request_duration.observe(time.perf_counter() - started, model=model, purpose=purpose)
+    if error is None:
+        outcome = "ok"
+        metrics.record_usage(response, model, purpose)
+    elif "429" in str(error) or "RESOURCE_EXHAUSTED" in str(error):
+        outcome = "rate_limited"
+        metrics.llm_rate_limited.inc(model=model, purpose=purpose)
+    else:
+        outcome = "error"
+    metrics.llm_requests.inc(model=model, purpose=purpose, outcome=outcome)
+
+def total_tokens(response):
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None) if usage else None
+
+def retry_wait(error_str, attempt, max_retries=MAX_RETRIES, base_delay=BASE_DELAY):
+    """Seconds to wait before retrying a 429 (the API's own hint wins), or None to give up."""
+    if "429" not in error_str and "RESOURCE_EXHAUSTED" not in error_str:
+        return None
+    if attempt >= max_retries:
+        return None
+    wait_time = base_delay * (2 ** attempt)
+    match_delay = re.search(r"retryDelay['\"]?:\s*['\"]?([\d\.]+)s", error_str)
+    match_msg = re.search(r"retry in ([\d\.]+)s", error_str)
+
+    if match_delay:
+        wait_time = float(match_delay.group(1)) + 1.0
+    if match_msg:
+        wait_time = float(match_msg.group(1)) + 1.0
+    return wait_time
+
+def generate_with_retries(model, contents, config=None, priority=rate_limiter.INTERACTIVE, purpose="chat"):
+    """
+    One model call through `backend`, paced by the shared rate limiter and recorded
+    in /metrics. A 429 pauses every caller of the model and is retried with backoff
+    (the API's own hint wins), up to MAX_RETRIES times.
+    """
+    model_limiter = rate_limiter.limiter.model(model)
+    estimated = rate_limiter.estimate_tokens(contents)
+    for attempt in range(MAX_RETRIES + 1):
+        acquire_quota(model_limiter, estimated, priority, model, purpose, attempt)
+        started = time.perf_counter()
+        try:
+            response = backend.generate(model, contents, config)
+        except Exception as e:
+            _failed(model_limiter, model, purpose, started, e, attempt)
+            continue
+        model_limiter.record(estimated, total_tokens(response))
+        observe_call(model, purpose, started, response)
+        return response
+
+async def agenerate_with_retries(model, contents, config=None, priority=rate_limiter.INTERACTIVE, purpose="chat"):
+    """generate_with_retries on the async client; limiter waits happen off the event loop."""
+    model_limiter = rate_limiter.limiter.model(model)
+    estimated = rate_limiter.estimate_tokens(contents)
+    for attempt in range(MAX_RETRIES + 1):
+        await asyncio.to_thread(acquire_quota, model_limiter, estimated, priority, model, purpose, attempt)
+        started = time.perf_counter()
+        try:
+            response = await backend.agenerate(model, contents, config)
+        except Exception as e:
+            _failed(model_limiter, model, purpose, started, e, attempt)
+            continue
+        model_limiter.record(estimated, total_tokens(response))
+        observe_call(model, purpose, started, response)
+        return response
+
+def _failed(model_limiter, model, purpose, started, error, attempt):
+    """Records a failed call. Re-raises unless it was a 429 worth retrying, in which case the model is paused."""
+    observe_call(model, purpose, started, error=error)
+    wait_time = retry_wait(str(error), attempt)
+    if wait_time is None:
+        raise error
+    metrics.llm_retries.inc(model=model, purpose=purpose)
+    # Pause every caller of this model; the retry waits its turn in acquire_quota()
+    print(f"429 Hit. API asked to wait {wait_time}s. Pausing {model} calls...")
+    model_limiter.throttle(wait_time, str(error))
@@ -1,13 +1,25 @@
-from flask import Flask, jsonify, request, render_template, session
+from flask import Flask, Response, g, jsonify, request, render_template, session
 from database import get_db_connection, get_all_inventory_text
-from google import genai
+import database
 from google.genai import types
 import os
 import time
 from dotenv import load_dotenv
 import tools 
+import vector_store
+import reports
+import bulk_import
+import router
+import rate_limiter
+import singleflight
+import llm_backend
+import metrics
+import agent_supervisor
+import chat_memory
 import uuid
 import json 
+import hashlib
+import math
 
 load_dotenv()
 
@@ -15,8 +27,15 @@ app = Flask(__name__)
 app.secret_key = os.urandom(24)
 
 
-# Initialize the modern Client
-client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+# Keep the semantic index in step with product writes (embeds only what changed)
+if os.environ.get("VECTOR_INDEX_WORKER", "1") == "1":
+    vector_store.start_index_worker()
+
+# The embedding model loads on the first semantic search; optionally start loading it now
+# in the background so non-search routes are served immediately either way.
+if os.environ.get("EMBEDDING_WARMUP", "0") == "1":
+    vector_store.warm_up_embedding_model()
+
 
 # Create a tool dictionary for easy lookup
 available_tools = {
@@ -27,15 +46,21 @@ available_tools = {
     'delete_products_by_name': tools.delete_products_by_name
 }
 
-def generate_response_safe(prompt, model="gemini-2.5-flash", tools_list=None, response_schema=None, response_mime_type=None):
+llm_flight = singleflight.SingleFlight(
+    encode=lambda response: response.model_dump_json(),
+    decode=types.GenerateContentResponse.model_validate_json
+)
+
+def generate_response_safe(prompt, model="gemini-2.5-flash", tools_list=None, response_schema=None, response_mime_type=None,
+                           priority=rate_limiter.INTERACTIVE, purpose="chat"):
     """
     Generates content with robust 429 handling. Returns full response object.
     Supports optional tools list and structured output schema.
+    Calls are paced by the shared rate limiter; background work (priority=BACKGROUND)
+    queues behind chat and is shed with RateLimitExceeded when the model is saturated.
+    Concurrent identical calls are coalesced into one (see singleflight.py).
+    `purpose` labels the call in /metrics (router, extraction, chat, describe, report, summary).
     """
-    import re
-    max_retries = 3
-    base_delay = 5
-    
     config = None
     if tools_list or response_schema or response_mime_type:
         config = types.GenerateContentConfig(
@@ -44,43 +69,152 @@ def generate_response_safe(prompt, model="gemini-2.5-flash", tools_list=None, re
             response_mime_type=response_mime_type
         )
 
-    for attempt in range(max_retries + 1):
+    def call():
+        return llm_backend.generate_with_retries(model, prompt, config, priority, purpose)
+
+    # Identical requests already in flight share one upstream call
+    return llm_flight.do(singleflight.request_key(model, prompt, config), call)
+
+def generate_stream_safe(prompt, model="gemini-2.5-flash", tools_list=None, priority=rate_limiter.INTERACTIVE,
+                         purpose="chat"):
+    """
+    Streaming counterpart of generate_response_safe: yields response chunks as they
+    arrive. 429s are retried the same way, as long as nothing has been yielded yet.
+    """
+    config = types.GenerateContentConfig(tools=tools_list) if tools_list else None
+
+    model_limiter = rate_limiter.limiter.model(model)
+    estimated = rate_limiter.estimate_tokens(prompt)
+    for attempt in range(llm_backend.MAX_RETRIES + 1):
+        llm_backend.acquire_quota(model_limiter, estimated, priority, model, purpose, attempt)
+        call_started = time.perf_counter()
+        started = False
         try:
-            response = client.models.generate_content(
-                model=model,
-                contents=prompt,
-                config=config
-            )
-            return response
+            total_tokens = None
+            last_chunk = None
+            for chunk in llm_backend.backend.generate_stream(model, prompt, config):
+                started = True
+                total_tokens = llm_backend.total_tokens(chunk) or total_tokens
+                last_chunk = chunk if getattr(chunk, "usage_metadata", None) else last_chunk
+                yield chunk
+            model_limiter.record(estimated, total_tokens)
+            llm_backend.observe_call(model, purpose, call_started, last_chunk)
+            return
         except Exception as e:
-            error_str = str(e)
-            if "429" in error_str or "RESOURCE_EXHAUSTED" in error_str:
-                if attempt < max_retries:
-                    wait_time = base_delay * (2 ** attempt)
-                    match_delay = re.search(r"retryDelay['\"]?:\s*['\"]?([\d\.]+)s", error_str)
-                    match_msg = re.search(r"retry in ([\d\.]+)s", error_str)
-                    
-                    if match_delay:
-                        wait_time = float(match_delay.group(1)) + 1.0
-                    if match_msg:
-                        wait_time = float(match_msg.group(1)) + 1.0
-
-                    print(f"429 Hit. API asked to wait {wait_time}s. Sleeping...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    raise e
-            else:
+            llm_backend.observe_call(model, purpose, call_started, error=e)
+            wait_time = None if started else llm_backend.retry_wait(str(e), attempt)
+            if wait_time is None:
                 raise e
-
-
+            metrics.llm_retries.inc(model=model, purpose=purpose)
+            print(f"429 Hit. API asked to wait {wait_time}s. Pausing {model} calls...")
+            model_limiter.throttle(wait_time, str(e))
+
+def rate_limited(e):
+    """429 response for a call the rate limiter shed, with Retry-After when known."""
+    response = jsonify({"error": f"The AI service is busy: {str(e)}"})
+    response.status_code = 429
+    if e.retry_after:
+        response.headers['Retry-After'] = str(int(math.ceil(e.retry_after)))
+    return response
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # The route pattern rather than the path keeps the label set small
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        metrics.http_request_duration.observe(time.perf_counter() - started, route=route,
+                                              method=request.method, status=response.status_code)
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Request, model call, tool and database metrics in the Prometheus text format."""
+    return Response(metrics.registry.render(), mimetype=metrics.CONTENT_TYPE)
+
+
+PRODUCTS_PAGE_DEFAULT = 100
+PRODUCTS_PAGE_MAX = 1000
+PRODUCTS_FETCH_BATCH = 500
+
+def iter_product_batches(after_id=0, limit=None, batch_size=PRODUCTS_FETCH_BATCH):
+    """
+    Yields lists of product dicts in id order, one keyset page at a time.
+    The connection is re-acquired per batch, so a slow client reading a long
+    stream never holds a pooled connection between batches.
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        conn = get_db_connection()
+        try:
+            rows = conn.execute('SELECT * FROM products WHERE id > ? ORDER BY id LIMIT ?',
+                                (after_id, size)).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            break
+        yield [dict(r) for r in rows]
+        if len(rows) < size:
+            break
+        after_id = rows[-1]['id']
+        if remaining is not None:
+            remaining -= len(rows)
+
+def _int_arg(name, minimum=0):
+    """Reads an optional integer query parameter. Raises ValueError on bad input."""
+    raw = request.args.get(name)
+    if raw is None or raw == '':
+        return None
+    value = int(raw)
+    if value < minimum:
+        raise ValueError(f"'{name}' must be >= {minimum}")
+    return value
 
 @app.route('/products', methods=['GET'])
 def get_products():
-    conn = get_db_connection()
-    products = conn.execute('SELECT * FROM products').fetchall()
-    conn.close()
-    return jsonify([dict(ix) for ix in products])
+    """
+    Lists products ordered by id.
+    - ?limit=N&after_id=M returns one keyset page: {"products": [...], "next_after_id": ...}
+    - ?format=ndjson (or Accept: application/x-ndjson) streams one product per line
+    - With no parameters the whole table is streamed as a JSON array.
+    """
+    try:
+        limit = _int_arg('limit', minimum=1)
+        after_id = _int_arg('after_id') or 0
+    except ValueError as e:
+        return jsonify({"error": f"Invalid pagination parameter: {e}"}), 400
+
+    wants_ndjson = (request.args.get('format') == 'ndjson'
+                    or 'application/x-ndjson' in request.headers.get('Accept', ''))
+
+    if wants_ndjson:
+        def generate_ndjson():
+            for batch in iter_product_batches(after_id, limit):
+                yield ''.join(json.dumps(p) + '\n' for p in batch)
+        return Response(generate_ndjson(), mimetype='application/x-ndjson')
+
+    if limit is not None or 'after_id' in request.args:
+        # Keyset page: WHERE id > after_id uses the primary key, so deep pages cost the same as the first.
+        limit = min(limit or PRODUCTS_PAGE_DEFAULT, PRODUCTS_PAGE_MAX)
+        products = [p for batch in iter_product_batches(after_id, limit) for p in batch]
+        next_after_id = products[-1]['id'] if len(products) == limit else None
+        return jsonify({"products": products, "next_after_id": next_after_id})
+
+    def generate_array():
+        yield '['
+        first = True
+        for batch in iter_product_batches(after_id):
+            chunk = ','.join(json.dumps(p) for p in batch)
+            yield chunk if first else ',' + chunk
+            first = False
+        yield ']'
+    return Response(generate_array(), mimetype='application/json')
 
 @app.route('/products', methods=['POST'])
 def add_product():
@@ -102,89 +236,195 @@ def add_product():
     
     return jsonify(new_product), 201
 
+@app.route('/products/bulk', methods=['POST'])
+def add_products_bulk():
+    """
+    Streams a CSV (name,price header) or NDJSON body of products into the table.
+    The body is parsed as it arrives and inserted in transactions of
+    BULK_BATCH_SIZE rows; invalid rows are skipped and reported by line number.
+    """
+    content_type = request.mimetype
+    fmt = request.args.get('format') or ('csv' if content_type in ('text/csv', 'application/csv') else
+                                          'ndjson' if content_type in ('application/x-ndjson', 'application/jsonl') else None)
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({"error": "Send text/csv or application/x-ndjson (or ?format=csv|ndjson)"}), 415
+
+    try:
+        batch_size = min(_int_arg('batch_size', minimum=1) or bulk_import.BULK_BATCH_SIZE, 50000)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid batch_size: {e}"}), 400
+
+    records = bulk_import.iter_csv(request.stream) if fmt == 'csv' else bulk_import.iter_ndjson(request.stream)
+    try:
+        summary = bulk_import.ingest(records, batch_size=batch_size)
+    except UnicodeDecodeError as e:
+        return jsonify({"error": f"Body is not valid UTF-8: {e}"}), 400
+    except Exception as e:
+        # Batches committed before the failure stay in the table
+        return jsonify({"error": str(e)}), 500
+    return jsonify(summary), 201 if summary['inserted'] else 200
+
+SEARCH_LIMIT_DEFAULT = 50
+SEARCH_LIMIT_MAX = 500
+
 @app.route('/search', methods=['GET'])
 def search_products():
-    query = request.args.get('q', '').lower()
+    query = request.args.get('q', '')
     if not query:
         return jsonify([])
-    
-    conn = get_db_connection()
-    # SQL LIKE for simple search
-    results = conn.execute('SELECT * FROM products WHERE lower(name) LIKE ?', ('%' + query + '%',)).fetchall()
-    conn.close()
-    
+
+    try:
+        limit = min(_int_arg('limit', minimum=1) or SEARCH_LIMIT_DEFAULT, SEARCH_LIMIT_MAX)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid limit: {e}"}), 400
+
+    # FTS5 index: token and prefix matching, best (BM25) matches first
+    results = database.search_products(query, limit=limit)
     return jsonify([dict(ix) for ix in results])
 
+SEMANTIC_BATCH_MAX = 1000
+
+@app.route('/search/semantic', methods=['POST'])
+def semantic_search_batch():
+    """
+    Batched semantic search. Body: {"queries": ["...", ...], "k": 3}.
+    All queries are encoded together and scored with one matrix product.
+    """
+    body = request.get_json(silent=True) or {}
+    queries = body.get('queries')
+    if not isinstance(queries, list) or not queries or not all(isinstance(q, str) and q.strip() for q in queries):
+        return jsonify({"error": "'queries' must be a non-empty list of strings"}), 400
+    if len(queries) > SEMANTIC_BATCH_MAX:
+        return jsonify({"error": f"At most {SEMANTIC_BATCH_MAX} queries per request"}), 400
+    k = body.get('k', 3)
+    if not isinstance(k, int) or k < 1:
+        return jsonify({"error": "'k' must be a positive integer"}), 400
+
+    try:
+        results = tools.search_inventory_batch(queries, k)
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 503
+    return jsonify({"results": [{"query": q, "matches": m} for q, m in zip(queries, results)]})
+
+DESCRIBE_MODEL = "gemini-2.5-flash"
+
+def description_prompt(name):
+    return (
+        f"You are an elite e-commerce copywriter. Write a description for: '{name}'."
+        f"Strictly limit your response to maximum 30 words. Do not use Markdown formatting like bold or headers."
+        f"Keep it one single sophisticated sentence."
+    )
+
+def description_cache_key(name, prompt, model=DESCRIBE_MODEL):
+    """Changes whenever the product name, the prompt wording or the model changes."""
+    return hashlib.sha256(f"{model}\n{name}\n{prompt}".encode("utf-8")).hexdigest()
+
 @app.route('/describe/<int:id>', methods=['POST'])
 def describe_product(id):
-    conn = get_db_connection()
-    product = conn.execute('SELECT * FROM products WHERE id = ?', (id,)).fetchone()
-    conn.close()
+    with get_db_connection() as conn:
+        product = conn.execute('SELECT * FROM products WHERE id = ?', (id,)).fetchone()
 
     if product is None:
         return jsonify({"error": "Product not found"}), 404
 
+    PROMPT = description_prompt(product['name'])
+    cache_key = description_cache_key(product['name'], PROMPT)
+
+    # Serve repeat clicks from the cache unless ?refresh=1 asks for a new one
+    if request.args.get('refresh') != '1':
+        cached = database.get_cached_description(id, cache_key)
+        if cached is not None:
+            return jsonify({"description": cached, "cached": True})
+
     try:
         # Use simple generation for description (no tools needed)
-        PROMPT = (
-            f"You are an elite e-commerce copywriter. Write a description for: '{product['name']}'."
-            f"Strictly limit your response to maximum 30 words. Do not use Markdown formatting like bold or headers."
-            f"Keep it one single sophisticated sentence."
-        )
-        response = generate_response_safe(PROMPT)
-        return jsonify({"description": response.text.strip()})
+        response = generate_response_safe(PROMPT, model=DESCRIBE_MODEL, priority=rate_limiter.BACKGROUND, purpose="describe")
+        description = response.text.strip()
+    except rate_limiter.RateLimitExceeded as e:
+        return rate_limited(e)
     except Exception as e:
         return jsonify({"error": f"AI generation failed: {str(e)}"}), 500
 
+    database.save_description(id, cache_key, description)
+    return jsonify({"description": description, "cached": False})
+
 @app.route('/inventory-report', methods=['GET'])
 def inventory_report():
-    inventory_text = get_all_inventory_text()
-    
-    # Define the schema for the report
-    # Schema: Array<Object {name: str, price: float, is_luxury: bool}>
-    report_schema = {
-        "type": "ARRAY",
-        "items": {
-            "type": "OBJECT",
-            "properties": {
-                "name": {"type": "STRING"},
-                "price": {"type": "NUMBER"},
-                "is_luxury": {"type": "BOOLEAN"}
-            },
-            "required": ["name", "price", "is_luxury"]
-        }
-    }
-
+    """
+    Categorised inventory report, built map-reduce style by reports.py.
+    - ?stream=1 streams NDJSON rows as chunks finish (in id order)
+    - ?chunk_size=N overrides REPORT_CHUNK_SIZE
+    Chunks that fail are reported; finished chunks are kept, so re-running resumes.
+    """
     try:
-        PROMPT = (
-            f"Analyze this inventory: {inventory_text}. "
-            f"Return a JSON array categorizing each item. "
-            f"Mark as 'is_luxury' if price > 100."
-        )
-        
-        # Use safe wrapper with schema
-        response = generate_response_safe(
-            PROMPT, 
-            model="gemini-2.5-flash",
-            response_schema=report_schema,
-            response_mime_type="application/json"
-        )
-        
-        # Parse the JSON string from the response
-        import json
-        return jsonify(json.loads(response.text))
-        
-    except Exception as e:
-        return jsonify({"error": f"Report generation failed: {str(e)}"}), 500
+        chunk_size = _int_arg('chunk_size', minimum=1) or reports.REPORT_CHUNK_SIZE
+    except ValueError as e:
+        return jsonify({"error": f"Invalid parameter: {e}"}), 400
+
+    def generate(prompt, **kwargs):
+        return generate_response_safe(prompt, model="gemini-2.5-flash", priority=rate_limiter.BACKGROUND, purpose="report", **kwargs)
+
+    chunks = reports.generate_report(generate, chunk_size=chunk_size)
+
+    if request.args.get('stream') == '1':
+        def ndjson():
+            for index, items, error in chunks:
+                if error:
+                    yield json.dumps({"chunk": index, "error": error}) + "\n"
+                yield "".join(json.dumps(item) + "\n" for item in items)
+        return Response(ndjson(), mimetype='application/x-ndjson')
+
+    report, failed = [], []
+    for index, items, error in chunks:
+        report.extend(items)
+        if error:
+            failed.append({"chunk": index, "error": error})
+    if failed:
+        return jsonify({
+            "error": f"Report generation failed for {len(failed)} chunk(s); completed chunks are saved, retry to resume.",
+            "failed_chunks": failed
+        }), 500
+    return jsonify(report)
 
-@app.route('/inventory-chat', methods=['GET'])
-def inventory_chat():
-    start_time = time.time() # Start Latency Timer
+CHAT_MAX_TURNS = 5
+CHAT_TOOLS = [tools.update_product_price, tools.delete_product, tools.search_inventory, tools.delete_products_range, tools.delete_products_by_name]
 
-    question = request.args.get('q', '')
-    if not question:
-        return jsonify({"error": "Missing query parameter 'q'"}), 400
+def chat_system_instruction(question):
+    # inventory_text = get_all_inventory_text() # REMOVED for RAG
+
+    # 2. System/Context Prompt
+    system_instruction = (
+        f"You are a Senior Store Manager. You have access to a database of products and you can use tools to manage it. "
+        f"You ALSO have a memory of the conversation. You should remember user details (name, preferences) if they were mentioned previously. "
+        f"For every request, you MUST think step-by-step using this exact structure:\n\n"
+        f"1. Analysis: Restate what the user wants in your own words. If calculation is needed, show math here.\n"
+        f"2. Search: Use the `search_inventory` tool to find relevant products. DO NOT assume you know what is in stock.\n"
+        f"3. Action Plan: Decide if you need to call other tools (update/delete) or just provide info. Explain your logic. If you need to call a tool, you must call it.\n"
+        f"4. Final Answer: Provide the conclusion to the user.\n\n"
+        f"CRITICAL RULES:\n"
+        f"- You CANNOT update, delete, or modify the database with words alone.\n"
+        f"- If your Action Plan says to delete or update, you MUST emit a tool call. Do not just say you did it.\n"
+        f"- Never assume an action is complete until the tool has returned a result.\n"
+        f"- WHEN MENTIONING PRODUCTS: You MUST include the Product ID in parentheses, e.g., 'MacBook Pro (ID: 123)'.\n\n"
+        f"EXAMPLE OF CORRECT BEHAVIOR:\n"
+        f"User: 'Delete Product 1'\n"
+        f"You:\n"
+        f"1. Analysis: User wants to delete Product 1.\n"
+        f"2. Search: I need to confirm Product 1 exists. Call search_inventory('Product 1')\n"
+        f"3. Action Plan: I must call the delete tool.\n"
+        f"4. Final Answer: I am calling the tool now.\n"
+        f"(Tools: function_call('delete_product', {{'product_id': 1}}))\n\n"
+        f"User Question: {question}"
+    )
+    return system_instruction
 
+def chat_preflight(question, start_time):
+    """
+    The part of a chat turn that must finish before the response starts, because it
+    reads or writes the session cookie: confirming or cancelling a pending delete,
+    routing the question and intercepting delete requests. Returns a reply dict if
+    the turn ends here, otherwise the router category to hand to chat_events.
+    """
     # --- Day 11: Chat Persistence ---
     if 'session_id' not in session:
         session['session_id'] = str(uuid.uuid4())
@@ -215,292 +455,378 @@ def inventory_chat():
                 session.pop('pending_bulk_delete', None)
                 msg = f"Confirmed. {result['message']}"
 
-            return jsonify({
+            return {
                 "answer": msg,
                 "model": "System-Interceptor",
                 "latency": latency,
                 "category": "DELETE-CONFIRMED"
-            })
+            }
         else:
              session.pop('pending_delete', None)
              session.pop('pending_bulk_delete', None)
-             return jsonify({
+             return {
                  "answer": "Okay, I have cancelled the deletion.",
                  "model": "System-Interceptor",
                  "latency": latency,
                  "category": "DELETE-CANCELLED"
-             })
-
-    # inventory_text = get_all_inventory_text() # REMOVED for RAG
-    
-    # 2. System/Context Prompt
-    system_instruction = (
-        f"You are a Senior Store Manager. You have access to a database of products and you can use tools to manage it. "
-        f"You ALSO have a memory of the conversation. You should remember user details (name, preferences) if they were mentioned previously. "
-        f"For every request, you MUST think step-by-step using this exact structure:\n\n"
-        f"1. Analysis: Restate what the user wants in your own words. If calculation is needed, show math here.\n"
-        f"2. Search: Use the `search_inventory` tool to find relevant products. DO NOT assume you know what is in stock.\n"
-        f"3. Action Plan: Decide if you need to call other tools (update/delete) or just provide info. Explain your logic. If you need to call a tool, you must call it.\n"
-        f"4. Final Answer: Provide the conclusion to the user.\n\n"
-        f"CRITICAL RULES:\n"
-        f"- You CANNOT update, delete, or modify the database with words alone.\n"
-        f"- If your Action Plan says to delete or update, you MUST emit a tool call. Do not just say you did it.\n"
-        f"- Never assume an action is complete until the tool has returned a result.\n"
-        f"- WHEN MENTIONING PRODUCTS: You MUST include the Product ID in parentheses, e.g., 'MacBook Pro (ID: 123)'.\n\n"
-        f"EXAMPLE OF CORRECT BEHAVIOR:\n"
-        f"User: 'Delete Product 1'\n"
-        f"You:\n"
-        f"1. Analysis: User wants to delete Product 1.\n"
-        f"2. Search: I need to confirm Product 1 exists. Call search_inventory('Product 1')\n"
-        f"3. Action Plan: I must call the delete tool.\n"
-        f"4. Final Answer: I am calling the tool now.\n"
-        f"(Tools: function_call('delete_product', {{'product_id': 1}}))\n\n"
-        f"User Question: {question}"
-    )
-
-    try:
-        # --- Day 8: Multi-Model Router ---
-        def classify_query(q):
-            """Classifies query as SIMPLE, COMPLEX, DELETE_SINGLE, or DELETE_BULK."""
-            q_lower = q.lower()
-            
-            # 1. Check for BULK delete
-            if "delete" in q_lower or "remove" in q_lower:
-                if any(x in q_lower for x in ['all', 'bulk', 'range', 'greater', 'less', '>', '<']):
-                    return "DELETE_BULK"
-                return "DELETE_SINGLE"
-
-            try:
-                router_prompt = (
-                    f"Classify this query as 'SIMPLE' or 'COMPLEX'.\n"
-                    f"Query: '{q}'\n"
-                    f"Rules:\n"
-                    f"- SIMPLE: Greetings, price checks, single item updates, simple factual questions.\n"
-                    f"- COMPLEX: Math, multi-item reasoning, strategy, discounts, 'what if' scenarios.\n"
-                    f"Return ONLY the word SIMPLE or COMPLEX."
-                )
-                res = generate_response_safe(router_prompt, model="gemini-2.5-flash")
-                return (res.text or "").strip().upper()
-            except Exception:
-                return "COMPLEX"
-
-        category = classify_query(question)
-        
-        if category == "DELETE_SINGLE":
-            # EXISTING SAFETY INTERCEPTOR
-            # 1. Extract intent
-            extraction_prompt = (
-                f"Extract the specific Product Name or details the user wants to remove from: '{question}'. "
-                f"Return ONLY the extracted text. If multiple, return the most specific one."
-            )
-            target_str_res = generate_response_safe(extraction_prompt, model="gemini-2.5-flash")
-            target_str = (target_str_res.text or "").strip()
-            
-            # 2. Find it in DB manually (simple fuzzy match)
-            conn = get_db_connection()
-            # Try to match ID first if it's a number
-            product = None
-            import re
-            id_match = re.search(r'\b\d+\b', target_str)
-            if id_match:
-                 pid = int(id_match.group(0))
+             }
+
+    # --- Day 8: Multi-Model Router ---
+    def classify_query(q):
+        """Classifies query as SIMPLE, COMPLEX, DELETE_SINGLE, or DELETE_BULK."""
+        q_lower = q.lower()
+
+        # 1. Check for BULK delete
+        if "delete" in q_lower or "remove" in q_lower:
+            if any(x in q_lower for x in ['all', 'bulk', 'range', 'greater', 'less', '>', '<']):
+                return "DELETE_BULK"
+            return "DELETE_SINGLE"
+
+        # Local embedding router first; the LLM only sees queries it is unsure about
+        def generate(prompt):
+            return generate_response_safe(prompt, model="gemini-2.5-flash", purpose="router")
+        try:
+            label, confidence, source = router.get_router().classify(q, generate)
+        except Exception:
+            return "COMPLEX"
+        print(f"[ROUTER] {label} via {source} (confidence {confidence})")
+        return label
+
+    category = classify_query(question)
+
+    if category == "DELETE_SINGLE":
+        # EXISTING SAFETY INTERCEPTOR
+        # 1. Extract intent
+        extraction_prompt = (
+            f"Extract the specific Product Name or details the user wants to remove from: '{question}'. "
+            f"Return ONLY the extracted text. If multiple, return the most specific one."
+        )
+        target_str_res = generate_response_safe(extraction_prompt, model="gemini-2.5-flash", purpose="extraction")
+        target_str = (target_str_res.text or "").strip()
+
+        # 2. Find it in DB manually (simple fuzzy match)
+        # Try to match ID first if it's a number
+        product = None
+        import re
+        id_match = re.search(r'\b\d+\b', target_str)
+        if id_match:
+             pid = int(id_match.group(0))
+             with get_db_connection() as conn:
                  product = conn.execute('SELECT * FROM products WHERE id = ?', (pid,)).fetchone()
-            
-            # If no ID match, try name match
-            if not product:
-                # Safe parameterized search
-                product = conn.execute('SELECT * FROM products WHERE lower(name) LIKE ?', ('%' + target_str.lower() + '%',)).fetchone()
 
-            conn.close()
+        # If no ID match, try the full-text index (best match wins)
+        if not product:
+            matches = database.search_products(target_str, limit=1)
+            product = matches[0] if matches else None
 
-            end_time = time.time()
-            latency = round(end_time - start_time, 2)
-
-            # 3. Force Confirmation or Report Not Found
-            if product:
-                session['pending_delete'] = {'product_id': product['id']}
-                return jsonify({
-                    "answer": f"⚠️ SAFETY CHECK: I found '{product['name']}' (ID: {product['id']}). Are you sure you want to DELETE it? (Reply YES)",
-                    "model": "System-Interceptor",
-                    "latency": latency,
-                    "category": "DELETE-SAFETY"
-                })
-            else:
-                 return jsonify({
-                     "answer": f"I couldn't find a product matching '{target_str}' to delete. Please be more specific.",
-                     "model": "System-Interceptor",
-                     "latency": latency,
-                     "category": "DELETE-FAILED"
-                 })
-
-        elif category == "DELETE_BULK":
-             # 1. Extract intent (Range OR Name)
-            extraction_prompt = (
-                f"Extract the bulk delete logic from: '{question}'. "
-                f"If it's an ID range, return 'min_id'/'max_id'. "
-                f"If it's a name pattern (e.g., 'Delete all Samsung products'), return only the BRAND/KEYWORD (e.g., 'Samsung'). "
-                f"IGNORE words like 'products', 'items', 'inventory'. "
-                f"Return JSON."
-            )
-            # Use JSON schema for reliability
-            schema = {
-                "type": "OBJECT",
-                "properties": {
-                    "min_id": {"type": "INTEGER", "nullable": True},
-                    "max_id": {"type": "INTEGER", "nullable": True},
-                    "name_pattern": {"type": "STRING", "nullable": True}
-                }
-            }
-            res_json = generate_response_safe(extraction_prompt, model="gemini-2.5-flash", 
-                                            response_schema=schema, response_mime_type="application/json")
-            
-            import json
-            params = json.loads(res_json.text)
-            
-            end_time = time.time()
-            latency = round(end_time - start_time, 2)
-            
-            # Store pending action
-            session['pending_bulk_delete'] = params
-            
-            desc = ""
-            if params.get('name_pattern'):
-                desc = f"all products containing '{params['name_pattern']}'"
-            elif params.get('min_id') and params.get('max_id'):
-                desc = f"IDs between {params['min_id']} and {params['max_id']}"
-            elif params.get('min_id'):
-                desc = f"IDs greater than or equal to {params['min_id']}"
-            elif params.get('max_id'):
-                desc = f"IDs less than or equal to {params['max_id']}"
-            else:
-                 return jsonify({
-                    "answer": "I couldn't understand what range or items you want to delete. Please be more specific (e.g. 'Delete ID > 10' or 'Delete all Samsung').",
-                    "model": "System-Interceptor",
-                    "latency": latency,
-                    "category": "DELETE-FAILED"
-                })
-            
-            return jsonify({
-                "answer": f"⚠️ BULK DELETE WARNING: You are about to delete {desc}. This cannot be undone. Are you sure? (Reply YES)",
+        end_time = time.time()
+        latency = round(end_time - start_time, 2)
+
+        # 3. Force Confirmation or Report Not Found
+        if product:
+            session['pending_delete'] = {'product_id': product['id']}
+            return {
+                "answer": f"⚠️ SAFETY CHECK: I found '{product['name']}' (ID: {product['id']}). Are you sure you want to DELETE it? (Reply YES)",
                 "model": "System-Interceptor",
                 "latency": latency,
                 "category": "DELETE-SAFETY"
-            })
+            }
+        else:
+             return {
+                 "answer": f"I couldn't find a product matching '{target_str}' to delete. Please be more specific.",
+                 "model": "System-Interceptor",
+                 "latency": latency,
+                 "category": "DELETE-FAILED"
+             }
+
+    elif category == "DELETE_BULK":
+         # 1. Extract intent (Range OR Name)
+        extraction_prompt = (
+            f"Extract the bulk delete logic from: '{question}'. "
+            f"If it's an ID range, return 'min_id'/'max_id'. "
+            f"If it's a name pattern (e.g., 'Delete all Samsung products'), return only the BRAND/KEYWORD (e.g., 'Samsung'). "
+            f"IGNORE words like 'products', 'items', 'inventory'. "
+            f"Return JSON."
+        )
+        # Use JSON schema for reliability
+        schema = {
+            "type": "OBJECT",
+            "properties": {
+                "min_id": {"type": "INTEGER", "nullable": True},
+                "max_id": {"type": "INTEGER", "nullable": True},
+                "name_pattern": {"type": "STRING", "nullable": True}
+            }
+        }
+        res_json = generate_response_safe(extraction_prompt, model="gemini-2.5-flash", 
+                                        response_schema=schema, response_mime_type="application/json", purpose="extraction")
 
-        elif "SIMPLE" in category:
-            selected_model = "gemini-2.5-flash"
+        import json
+        params = json.loads(res_json.text)
+
+        end_time = time.time()
+        latency = round(end_time - start_time, 2)
+
+        # Store pending action
+        session['pending_bulk_delete'] = params
+
+        desc = ""
+        if params.get('name_pattern'):
+            desc = f"all products containing '{params['name_pattern']}'"
+        elif params.get('min_id') and params.get('max_id'):
+            desc = f"IDs between {params['min_id']} and {params['max_id']}"
+        elif params.get('min_id'):
+            desc = f"IDs greater than or equal to {params['min_id']}"
+        elif params.get('max_id'):
+            desc = f"IDs less than or equal to {params['max_id']}"
         else:
-            selected_model = "gemini-2.5-flash" # No experimental model available apparently
-            
-        print(f"[ROUTER] Routing to {selected_model} because task is {category}")
+             return {
+                "answer": "I couldn't understand what range or items you want to delete. Please be more specific (e.g. 'Delete ID > 10' or 'Delete all Samsung').",
+                "model": "System-Interceptor",
+                "latency": latency,
+                "category": "DELETE-FAILED"
+            }
 
-        # Manual Loop Implementation using Safe Generator
-        messages = [system_instruction]
-        
-        # Load History
-        history = tools.get_recent_history(session_id)
+        return {
+            "answer": f"⚠️ BULK DELETE WARNING: You are about to delete {desc}. This cannot be undone. Are you sure? (Reply YES)",
+            "model": "System-Interceptor",
+            "latency": latency,
+            "category": "DELETE-SAFETY"
+        }
+
+    return category
+
+def summarize_chat(previous_summary, messages):
+    """Summary text for chat_memory: the previous summary extended with [(role, content), ...]."""
+    transcript = "\n".join(f"{role}: {content}" for role, content in messages)
+    prompt = (
+        "Summarize this conversation between a user and an inventory assistant in under 150 words. "
+        "Keep product names, IDs, prices and any pending requests or confirmations.\n\n"
+    )
+    if previous_summary:
+        prompt += f"Earlier summary:\n{previous_summary}\n\n"
+    prompt += f"New messages:\n{transcript}"
+    res = generate_response_safe(prompt, priority=rate_limiter.BACKGROUND, purpose="summary")
+    return res.text.strip() if res.text else None
+
+def _stream_turn(messages, model):
+    """
+    Streams one model turn, yielding a token event per text chunk.
+    Returns (model content, function calls, text) once the turn is complete.
+    """
+    parts, function_calls, text = [], [], ""
+    for chunk in generate_stream_safe(messages, model=model, tools_list=CHAT_TOOLS):
+        if chunk.function_calls:
+            function_calls.extend(chunk.function_calls)
+        candidate = chunk.candidates[0] if chunk.candidates else None
+        chunk_parts = candidate.content.parts if candidate and candidate.content and candidate.content.parts else []
+        parts.extend(chunk_parts)
+        piece = "".join(p.text for p in chunk_parts if p.text and not p.thought)
+        if piece:
+            text += piece
+            yield {"type": "token", "text": piece}
+    return types.Content(role="model", parts=parts), function_calls, text
+
+def chat_events(question, session_id, category, start_time, stream=False):
+    """
+    Runs the tool loop for one routed chat turn as a sequence of events:
+    router, then tool_call / tool_result / products for every tool the model
+    uses, token events with the answer text (stream=True only), and finally
+    done with the fields /inventory-chat returns.
+    """
+    if "SIMPLE" in category:
+        selected_model = "gemini-2.5-flash"
+    else:
+        selected_model = "gemini-2.5-flash" # No experimental model available apparently
         
-        for msg in history:
-            messages.append(types.Content(role=msg['role'], parts=[types.Part.from_text(text=msg['parts'][0])]))
-            
-        turn_count = 0
+    print(f"[ROUTER] Routing to {selected_model} because task is {category}")
+    yield {"type": "router", "category": category, "model": selected_model}
+
+    # Manual Loop Implementation using Safe Generator
+    messages = [chat_system_instruction(question)]
+    
+    # Load History: the rolling summary of older turns, then the recent messages verbatim
+    summary, _ = database.get_chat_summary(session_id)
+    if summary:
+        messages.append(types.Content(role="user", parts=[types.Part.from_text(text=f"Summary of the earlier conversation: {summary}")]))
+    history = tools.get_recent_history(session_id, limit=chat_memory.KEEP_RECENT)
+    
+    for msg in history:
+        messages.append(types.Content(role=msg['role'], parts=[types.Part.from_text(text=msg['parts'][0])]))
         
-        while turn_count < 5:
-            turn_count += 1
+    # Product data to send to the frontend, from this turn's search_inventory results
+    found_products = []
+
+    for turn_count in range(CHAT_MAX_TURNS):
+        if stream:
+            content, function_calls, text = yield from _stream_turn(messages, selected_model)
+        else:
             # Generate content with robust 429 handling
             res = generate_response_safe(
                 prompt=messages,
                 model=selected_model,
-                tools_list=[tools.update_product_price, tools.delete_product, tools.search_inventory, tools.delete_products_range, tools.delete_products_by_name]
+                tools_list=CHAT_TOOLS
             )
+            content, function_calls = res.candidates[0].content, res.function_calls
+            text = None if function_calls else res.text
+
+        # Check for function calls
+        if function_calls:
+            # Add the model's request to history
+            messages.append(content)
             
-            # DEBUG: Print raw response to trace tool behavior
-            print(f"DEBUG RESPONSE: {res.candidates[0].content}")
+            calls = [(fc.name, fc.args) for fc in function_calls]
+            for fn_name, fn_args in calls:
+                print(f"Calling tool: {fn_name} with {fn_args}")
+                yield {"type": "tool_call", "name": fn_name, "args": dict(fn_args or {})}
+
+            # Read-only calls run concurrently, writes in order; results keep call order
+            results = tools.execute_tool_calls(calls, available_tools)
+            parts = []
+            for (fn_name, _), result in zip(calls, results):
+                yield {"type": "tool_result", "name": fn_name, "result": result}
+                parts.append(types.Part.from_function_response(name=fn_name, response=tools.tool_response(result)))
+                if fn_name == "search_inventory" and isinstance(result, list):
+                    products = [p for p in result if isinstance(p, dict)]
+                    if products:
+                        found_products.extend(products)
+                        yield {"type": "products", "products": products}
+            
+            # Add function response to history
+            messages.append(types.Content(role="user", parts=parts))
+            # Loop continues to send this back to model
+        else:
+            # No function call, just text response
+            latency = round(time.time() - start_time, 2)
+            answer_text = text.strip() if text else "I completed the action."
+            
+            # Save AI Context
+            tools.save_chat_message(session_id, 'model', answer_text)
+            # Fold older turns into the summary off the request path
+            chat_memory.schedule_compaction(session_id, summarize_chat)
+
+            yield {
+                "type": "done",
+                "answer": answer_text,
+                "model": selected_model,
+                "latency": latency,
+                "category": category,
+                "products": found_products[:10] # Limit to top 10
+            }
+            return
+    
+    latency = round(time.time() - start_time, 2)
+    yield {
+        "type": "done",
+        "answer": "I'm thinking too hard about this! Please try a simpler request.",
+        "model": selected_model,
+        "latency": latency,
+        "category": "TIMEOUT"
+    }
 
-            # Check for function calls
-            if res.function_calls:
-                # Add the model's request to history
-                messages.append(res.candidates[0].content)
-                
-                parts = []
-                for fc in res.function_calls:
-                    fn_name = fc.name
-                    fn_args = fc.args
-                    print(f"Calling tool: {fn_name} with {fn_args}")
-                    
-                    # --- Day 9: Human-in-the-Loop ---
-                    if fn_name == 'delete_product':
-                         # With Deterministic Flow, this code path might become redundant for initial delete, 
-                         # but keeping it as a fallback if the model decides to delete internally.
-                         pass 
-
-                    if fn_name in available_tools:
-                        result = available_tools[fn_name](**fn_args)
-                        # Create FunctionResponse part
-                        parts.append(types.Part.from_function_response(
-                            name=fn_name,
-                            response=result
-                        ))
-                
-                # Add function response to history
-                messages.append(types.Content(role="user", parts=parts))
-                # Loop continues to send this back to model
-            else:
-                # No function call, just text response
-                end_time = time.time()
-                latency = round(end_time - start_time, 2)
-                answer_text = res.text.strip() if res.text else "I completed the action."
-                
-                # Save AI Context
-                tools.save_chat_message(session_id, 'model', answer_text)
-
-                # Collect product data to send to frontend
-                found_products = []
-                # Check history for recent tool responses containing product data
-                for content in messages:
-                    if not hasattr(content, 'role'): continue
-                    if content.role == "user": # Tool responses are user role
-                        for part in content.parts:
-                            if part.function_response and part.function_response.name == "search_inventory":
-                                # Extract the payload 
-                                # Note: Actual API output format check
-                                try:
-                                    response_data = part.function_response.response
-                                    # It might be a dict with 'result' or just the raw list depending on SDK
-                                    # Based on tools.py it returns a list of dicts.
-                                    # Let's assume response_data is directly usable or nested.
-                                    # In the Google GenAI SDK, the response is usually wrapped.
-                                    # For simplicity, we trust the SDK unpacks it or we treat it carefully.
-                                    # Since we passed a native python list-of-dicts, it should be in response_data['result'] or similar.
-                                    # Printing debugging helps, but let's try to just append it if it's a list.
-                                    if isinstance(response_data, list):
-                                         found_products.extend(response_data)
-                                    elif isinstance(response_data, dict) and 'result' in response_data:
-                                         found_products.extend(response_data['result'])
-                                except:
-                                    pass
-
-                return jsonify({
-                    "answer": answer_text,
-                    "model": selected_model,
-                    "latency": latency,
-                    "category": category,
-                    "products": found_products[:10] # Limit to top 10
-                })
-        
-        end_time = time.time()
-        latency = round(end_time - start_time, 2)
-        return jsonify({
-            "answer": "I'm thinking too hard about this! Please try a simpler request.",
-            "model": selected_model,
-            "latency": latency,
-            "category": "TIMEOUT"
-        })
+@app.route('/inventory-chat', methods=['GET'])
+def inventory_chat():
+    start_time = time.time() # Start Latency Timer
+
+    question = request.args.get('q', '')
+    if not question:
+        return jsonify({"error": "Missing query parameter 'q'"}), 400
+
+    try:
+        outcome = chat_preflight(question, start_time)
+        if isinstance(outcome, dict):
+            return jsonify(outcome)
+
+        for event in chat_events(question, session['session_id'], outcome, start_time):
+            if event['type'] == 'done':
+                return jsonify({k: v for k, v in event.items() if k != 'type'})
 
+    except rate_limiter.RateLimitExceeded as e:
+        return rate_limited(e)
     except Exception as e:
         print(f"Error: {e}")
         return jsonify({"error": f"AI generation failed: {str(e)}"}), 500
 
+def sse(event):
+    """Formats an event dict as one server-sent event named after its type."""
+    return f"event: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+
+@app.route('/inventory-chat/stream', methods=['GET'])
+def inventory_chat_stream():
+    """
+    Server-sent events version of /inventory-chat. Streams router, tool_call,
+    tool_result, products and token events as they happen, then one done event
+    carrying the same fields /inventory-chat returns (or an error event).
+    """
+    start_time = time.time()
+
+    question = request.args.get('q', '')
+    if not question:
+        return jsonify({"error": "Missing query parameter 'q'"}), 400
+
+    # Anything that touches the session cookie has to happen before the first byte
+    try:
+        outcome = chat_preflight(question, start_time)
+    except Exception as e:
+        outcome = e
+    session_id = session['session_id']
+
+    def events():
+        try:
+            if isinstance(outcome, Exception):
+                raise outcome
+            if isinstance(outcome, dict):
+                yield sse({"type": "done", **outcome})
+                return
+            yield from (sse(event) for event in chat_events(question, session_id, outcome, start_time, stream=True))
+        except Exception as e:
+            print(f"Error: {e}")
+            yield sse({"type": "error", "error": f"AI generation failed: {str(e)}"})
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/supervisor', methods=['GET'])
+def supervisor():
+    """
+    Multi-agent answer (agent_supervisor.py): the supervisor plans tasks with
+    dependencies, independent tasks run concurrently, and the reports are
+    synthesized into one answer. Returns the plan, each task's output and the answer.
+    """
+    start_time = time.time()
+
+    question = request.args.get('q', '')
+    if not question:
+        return jsonify({"error": "Missing query parameter 'q'"}), 400
+
+    try:
+        result = agent_supervisor.answer_question(question)
+    except rate_limiter.RateLimitExceeded as e:
+        return rate_limited(e)
+    except Exception as e:
+        return jsonify({"error": f"Supervisor failed: {str(e)}"}), 500
+
+    result['latency'] = round(time.time() - start_time, 2)
+    return jsonify(result)
+
+@app.route('/healthz')
+def healthz():
+    """
+    Liveness plus readiness flags. With ?require=embeddings it returns 503 until
+    the embedding model has loaded (for readiness probes on search traffic).
+    """
+    model = vector_store.embedding_model_status()
+    ready = model['state'] == 'ready'
+    body = {"status": "ok", "embedding_model": model['state'], "embedding_model_ready": ready}
+    if model['error']:
+        body['embedding_model_error'] = model['error']
+    body['query_cache'] = vector_store.query_cache.stats()
+    body['llm_rate_limits'] = rate_limiter.limiter.stats()
+    body['llm_singleflight'] = llm_flight.stats()
+    body['chat_writer'] = database.chat_writer.stats()
+    if request.args.get('require') == 'embeddings' and not ready:
+        return jsonify(body), 503
+    return jsonify(body)
+
 @app.route('/')
 def home():
     return render_template('index.html')
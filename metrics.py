@@ -0,0 +1,180 @@
+import threading
+from bisect import bisect_left
+import time
+from contextlib import contextmanager
+
+# In-process metrics in the Prometheus text format, served by GET /metrics.
+# Every thread of a worker records into the same objects; updates take one
+# short per-metric lock, so recording costs about a microsecond. Each gunicorn
+# worker process keeps its own numbers (scrape each worker, or run with one
+# worker and --threads).
+
+# Seconds; covers SQLite queries up to slow model calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing value per label combination."""
+
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(str(labels.get(n, "")) for n in self.labelnames), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observations per label combination."""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        # Index of the first bucket the value falls in; the buckets are cumulated when rendered
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        series = self._series.get(tuple(str(labels.get(n, "")) for n in self.labelnames))
+        return sum(series[:-1]) if series else 0
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self._series.items())
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                yield self.name + "_bucket", _format_labels(self.labelnames, key, ("le", _format_value(float(bound)))), cumulative
+            yield self.name + "_sum", _format_labels(self.labelnames, key), series[-1]
+            yield self.name + "_count", _format_labels(self.labelnames, key), cumulative
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# --- HTTP ---
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "Time to produce a response (streamed bodies: until the first byte).",
+    ("route", "method", "status"))
+
+# --- LLM calls ---
+llm_requests = registry.counter(
+    "llm_requests_total", "Model calls by outcome: ok, error, rate_limited (429) or shed (refused by the local rate limiter).",
+    ("model", "purpose", "outcome"))
+llm_request_duration = registry.histogram(
+    "llm_request_duration_seconds", "Latency of a single upstream model call.", ("model", "purpose"))
+llm_retries = registry.counter(
+    "llm_retries_total", "Model calls retried after a 429.", ("model", "purpose"))
+llm_rate_limited = registry.counter(
+    "llm_429_total", "429 / RESOURCE_EXHAUSTED responses from the model API.", ("model", "purpose"))
+llm_backoff_seconds = registry.counter(
+    "llm_backoff_seconds_total", "Seconds spent waiting before retrying after a 429.", ("model", "purpose"))
+llm_queue_seconds = registry.counter(
+    "llm_rate_limit_wait_seconds_total", "Seconds spent waiting for rate limiter quota before a first attempt.",
+    ("model", "purpose"))
+llm_tokens = registry.counter(
+    "llm_tokens_total", "Tokens reported in response usage metadata (prompt, output, total).",
+    ("model", "purpose", "kind"))
+
+# --- Tools and database ---
+tool_call_duration = registry.histogram(
+    "tool_call_duration_seconds", "Latency of chat tool calls, by outcome (ok, error, unknown tool).", ("tool", "outcome"))
+db_query_duration = registry.histogram(
+    "db_query_duration_seconds", "Time in SQLite execute/executemany (not row fetching), by statement type.",
+    ("operation",))
+
+
+def record_usage(response, model, purpose):
+    """Adds the token counts from a response's usage metadata, when it has any."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    for kind, attr in (("prompt", "prompt_token_count"), ("output", "candidates_token_count"),
+                       ("total", "total_token_count")):
+        count = getattr(usage, attr, None)
+        if count:
+            llm_tokens.inc(count, model=model, purpose=purpose, kind=kind)
+
+def sql_operation(sql):
+    """'select', 'insert', ... from the first word of a statement; 'other' for anything unusual."""
+    words = sql[:64].split(None, 1)
+    word = words[0].lower() if words else ""
+    return word if word in ("select", "insert", "update", "delete", "with", "create", "drop", "begin", "pragma") else "other"
@@ -1,8 +1,8 @@
 import urllib.request
 import json
-import time
 
 BASE_URL = "http://127.0.0.1:8080/products"
+BULK_URL = BASE_URL + "/bulk"
 
 products = [
     {"name": "MacBook Pro M3 Max", "price": 3199.00},
@@ -34,9 +34,22 @@ def add_product(product):
     except Exception as e:
         print(f"[ERROR] Adding {product['name']}: {e}")
 
+def add_products_bulk(products):
+    """Sends every product in one NDJSON upload to /products/bulk."""
+    data = "".join(json.dumps(p) + "\n" for p in products).encode('utf-8')
+    req = urllib.request.Request(
+        BULK_URL,
+        data=data,
+        headers={'Content-Type': 'application/x-ndjson'},
+        method='POST'
+    )
+    with urllib.request.urlopen(req) as response:
+        summary = json.loads(response.read())
+    print(f"[SUCCESS] Added {summary['inserted']} products ({summary['failed']} rejected)")
+    for error in summary['errors']:
+        print(f"[FAILED] Line {error['line']}: {error['error']}")
+
 if __name__ == "__main__":
     print(f"Starting insertion of {len(products)} products...")
-    for p in products:
-        add_product(p)
-        time.sleep(0.5) # Gentle pace
+    add_products_bulk(products)
     print("Done!")
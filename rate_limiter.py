@@ -0,0 +1,215 @@
+import heapq
+import itertools
+import os
+import re
+import threading
+import time
+
+# Process-wide scheduler for Gemini calls. Every call takes one request and an
+# estimate of its tokens from per-model buckets (requests/minute, tokens/minute)
+# before it goes out. Callers that can't go yet wait in a priority queue, so chat
+# is served ahead of background work, and a 429 pauses every caller of that model
+# at once instead of each thread sleeping and retrying on its own.
+
+INTERACTIVE = 0   # chat turns, routing, delete extraction
+BACKGROUND = 1    # reports, product descriptions
+
+DEFAULT_RPM = int(os.environ.get("LLM_RPM", "60"))
+DEFAULT_TPM = int(os.environ.get("LLM_TPM", "1000000"))
+# Per-model overrides, e.g. "gemini-2.5-flash=10:250000,gemini-2.5-pro=5:250000"
+MODEL_LIMITS = os.environ.get("LLM_RATE_LIMITS", "")
+
+# Longest a call may queue before it is shed with RateLimitExceeded
+MAX_WAIT = {
+    INTERACTIVE: float(os.environ.get("LLM_MAX_WAIT", "30")),
+    BACKGROUND: float(os.environ.get("LLM_BACKGROUND_MAX_WAIT", "5")),
+}
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a call could not be scheduled within its max wait. retry_after is in seconds."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_limits(spec):
+    """'model=rpm:tpm,...' -> {model: (rpm, tpm)}"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        model, _, values = item.partition("=")
+        rpm, _, tpm = values.partition(":")
+        limits[model.strip()] = (int(rpm or DEFAULT_RPM), int(tpm or DEFAULT_TPM))
+    return limits
+
+def estimate_tokens(prompt):
+    """Rough prompt size (about 4 characters per token) for strings, Contents or lists of them."""
+    if prompt is None:
+        return 0
+    if isinstance(prompt, str):
+        return len(prompt) // 4 + 1
+    if isinstance(prompt, (list, tuple)):
+        return sum(estimate_tokens(p) for p in prompt)
+    parts = getattr(prompt, "parts", None)
+    if parts is not None:
+        return sum(len(p.text) // 4 + 1 if getattr(p, "text", None) else 16 for p in parts)
+    return len(str(prompt)) // 4 + 1
+
+def parse_quota(error_str):
+    """
+    Per-minute quotas named in a 429 body, as {"rpm": n} and/or {"tpm": n}.
+    Gemini reports them as quotaId '...RequestsPerMinute...' / '...InputTokensPerMinute...'
+    next to a quotaValue.
+    """
+    quotas = {}
+    for quota_id, value in re.findall(r"quotaId['\"]?:\s*['\"]([^'\"]+)['\"].*?quotaValue['\"]?:\s*['\"]?(\d+)", error_str):
+        if "PerMinute" not in quota_id:
+            continue
+        key = "tpm" if "Token" in quota_id else "rpm"
+        quotas[key] = int(value)
+    return quotas
+
+
+class TokenBucket:
+    """Holds up to `capacity` units and refills continuously at capacity per minute."""
+
+    def __init__(self, per_minute):
+        self.set_limit(per_minute)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def set_limit(self, per_minute):
+        self.capacity = max(1, int(per_minute))
+        self.rate = self.capacity / 60.0
+        if hasattr(self, "tokens"):
+            self.tokens = min(self.tokens, self.capacity)
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` is available (requests larger than the bucket only need a full one)."""
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+
+class ModelLimiter:
+    """Request and token buckets for one model, plus the queue of callers waiting on them."""
+
+    def __init__(self, model, rpm, tpm):
+        self.model = model
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.paused_until = 0.0
+        self._cond = threading.Condition()
+        self._queue = []  # heap of (priority, seq); only the head may take from the buckets
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.shed = 0
+        self.throttled = 0
+        self.waited_seconds = 0.0
+
+    def _wait_time(self, tokens, now):
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return max(self.paused_until - now, self.requests.wait_time(1), self.tokens.wait_time(tokens))
+
+    def acquire(self, tokens, priority=INTERACTIVE, max_wait=None):
+        """Blocks until this call may go out. Raises RateLimitExceeded after max_wait seconds."""
+        max_wait = MAX_WAIT.get(priority, MAX_WAIT[BACKGROUND]) if max_wait is None else max_wait
+        start = time.monotonic()
+        deadline = start + max_wait
+        with self._cond:
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._queue, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._wait_time(tokens, now) if self._queue[0] == entry else None
+                    if wait == 0:
+                        self.requests.tokens -= 1
+                        self.tokens.tokens -= min(tokens, self.tokens.capacity)
+                        self.admitted += 1
+                        self.waited_seconds += now - start
+                        return
+                    if now >= deadline or (wait is not None and now + wait > deadline):
+                        self.shed += 1
+                        retry_after = wait if wait is not None else max_wait
+                        raise RateLimitExceeded(
+                            f"{self.model} is over its rate limit; try again in {retry_after:.0f}s.",
+                            retry_after=retry_after)
+                    self._cond.wait(min(wait if wait is not None else max_wait, deadline - now))
+            finally:
+                if entry in self._queue:
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                self._cond.notify_all()
+
+    def record(self, estimated, actual):
+        """Corrects the token bucket once the real usage of a call is known."""
+        if actual is None:
+            return
+        with self._cond:
+            self.tokens.tokens -= actual - min(estimated, self.tokens.capacity)
+
+    def throttle(self, wait_time, error_str=""):
+        """
+        After a 429: drain the buckets, pause every caller for wait_time, and adopt
+        any per-minute quotas the error names, so later calls are paced correctly.
+        """
+        quotas = parse_quota(error_str)
+        with self._cond:
+            if "rpm" in quotas:
+                self.requests.set_limit(quotas["rpm"])
+            if "tpm" in quotas:
+                self.tokens.set_limit(quotas["tpm"])
+            self.requests.tokens = 0.0
+            self.paused_until = max(self.paused_until, time.monotonic() + wait_time)
+            self.throttled += 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            return {
+                "rpm": self.requests.capacity,
+                "tpm": self.tokens.capacity,
+                "requests_available": round(self.requests.tokens, 2),
+                "tokens_available": int(self.tokens.tokens),
+                "paused_for": round(max(0.0, self.paused_until - now), 2),
+                "queue_depth": len(self._queue),
+                "queue_interactive": sum(1 for p, _ in self._queue if p == INTERACTIVE),
+                "queue_background": sum(1 for p, _ in self._queue if p != INTERACTIVE),
+                "admitted": self.admitted,
+                "shed": self.shed,
+                "throttled": self.throttled,
+                "avg_wait_ms": round(1000 * self.waited_seconds / self.admitted, 2) if self.admitted else 0.0,
+            }
+
+
+class RateLimiter:
+    """One ModelLimiter per model name, created on first use."""
+
+    def __init__(self, limits=None):
+        self.limits = parse_limits(MODEL_LIMITS) if limits is None else limits
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def model(self, name):
+        with self._lock:
+            if name not in self._models:
+                rpm, tpm = self.limits.get(name, (DEFAULT_RPM, DEFAULT_TPM))
+                self._models[name] = ModelLimiter(name, rpm, tpm)
+            return self._models[name]
+
+    def stats(self):
+        with self._lock:
+            models = list(self._models.values())
+        return {m.model: m.stats() for m in models}
+
+
+limiter = RateLimiter()
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from database import get_db_connection
+
+# Products per model call, and model calls in flight at once
+REPORT_CHUNK_SIZE = int(os.environ.get("REPORT_CHUNK_SIZE", "200"))
+REPORT_WORKERS = int(os.environ.get("REPORT_WORKERS", "4"))
+
+# Computed locally; the model is only asked for what it alone can add (the category)
+LUXURY_PRICE = 100
+# Bump when the prompt or schema changes so cached chunks are regenerated
+PROMPT_VERSION = 1
+
+CATEGORY_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "id": {"type": "INTEGER"},
+            "category": {"type": "STRING"}
+        },
+        "required": ["id", "category"]
+    }
+}
+
+def iter_chunks(chunk_size=REPORT_CHUNK_SIZE, fetch_size=1000):
+    """
+    Yields (chunk_index, [product dicts]) in id order. Chunk i holds the products
+    with ids in [i * chunk_size + 1, (i + 1) * chunk_size], so inserting or deleting
+    a product only changes the one chunk it falls in (and its cache key).
+    """
+    after_id = 0
+    current, rows = None, []
+    while True:
+        conn = get_db_connection()
+        try:
+            batch = conn.execute('SELECT id, name, price FROM products WHERE id > ? ORDER BY id LIMIT ?',
+                                 (after_id, fetch_size)).fetchall()
+        finally:
+            conn.close()
+        if not batch:
+            break
+        for p in batch:
+            index = (p['id'] - 1) // chunk_size
+            if index != current and rows:
+                yield current, rows
+                rows = []
+            current = index
+            rows.append(dict(p))
+        after_id = batch[-1]['id']
+    if rows:
+        yield current, rows
+
+def chunk_key(rows):
+    """Identifies a chunk by its exact contents, so unchanged chunks are never regenerated."""
+    payload = json.dumps([PROMPT_VERSION, rows], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _load_chunk(key):
+    conn = get_db_connection()
+    try:
+        row = conn.execute('SELECT result FROM report_chunks WHERE chunk_key = ?', (key,)).fetchone()
+        return {int(k): v for k, v in json.loads(row['result']).items()} if row else None
+    finally:
+        conn.close()
+
+def _save_chunk(key, categories):
+    conn = get_db_connection()
+    try:
+        conn.execute('INSERT OR REPLACE INTO report_chunks (chunk_key, result) VALUES (?, ?)',
+                     (key, json.dumps(categories)))
+        conn.commit()
+    finally:
+        conn.close()
+
+def categorize_chunk(rows, generate):
+    """
+    Returns {product_id: category} for one chunk, from the chunk cache or from one
+    model call. `generate(prompt, response_schema=..., response_mime_type=...)`
+    must return a response with .text (main.generate_response_safe).
+    """
+    key = chunk_key(rows)
+    cached = _load_chunk(key)
+    if cached is not None:
+        return cached
+
+    listing = "\n".join(f"{p['id']}: {p['name']}" for p in rows)
+    prompt = (
+        f"Assign a short product category (e.g. 'Laptop', 'Camera', 'Smart Home') to each product below. "
+        f"Return a JSON array with one object per product containing its 'id' and 'category'.\n\n"
+        f"{listing}"
+    )
+    response = generate(prompt, response_schema=CATEGORY_SCHEMA, response_mime_type="application/json")
+    categories = {int(item['id']): item.get('category') for item in json.loads(response.text) if 'id' in item}
+    _save_chunk(key, categories)
+    return categories
+
+def build_items(rows, categories):
+    """Report rows: name and price straight from the database, is_luxury computed here."""
+    return [{
+        "id": p['id'],
+        "name": p['name'],
+        "price": p['price'],
+        "is_luxury": p['price'] > LUXURY_PRICE,
+        "category": categories.get(p['id'])
+    } for p in rows]
+
+def _finish(entry):
+    index, rows, future = entry
+    try:
+        return index, build_items(rows, future.result()), None
+    except Exception as e:
+        return index, build_items(rows, {}), str(e)
+
+def generate_report(generate, chunk_size=REPORT_CHUNK_SIZE, workers=REPORT_WORKERS):
+    """
+    Map-reduce report. Chunks are categorised concurrently on a bounded worker
+    pool and yielded as (chunk_index, items, error) in id order as soon as each
+    one (and everything before it) is done. Finished chunks are persisted, so a
+    failed or interrupted report resumes where it left off when re-run.
+    """
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="report") as pool:
+        pending = deque()
+        for index, rows in iter_chunks(chunk_size):
+            pending.append((index, rows, pool.submit(categorize_chunk, rows, generate)))
+            # Bound the work in flight, and hand back finished chunks early
+            while pending and (len(pending) >= workers * 2 or pending[0][2].done()):
+                yield _finish(pending.popleft())
+        while pending:
+            yield _finish(pending.popleft())
@@ -0,0 +1,258 @@
+import argparse
+import os
+import threading
+import numpy as np
+from database import get_db_connection
+
+# Local SIMPLE/COMPLEX router for /inventory-chat: nearest centroid over the MiniLM
+# query embeddings. Queries it is unsure about go to the LLM classifier, and the
+# LLM's answer is stored as a new example, so the router keeps learning.
+LABELS = ("SIMPLE", "COMPLEX")
+
+# Below this confidence the router defers to the LLM
+MIN_CONFIDENCE = float(os.environ.get("ROUTER_MIN_CONFIDENCE", "0.7"))
+# Softmax temperature over cosine similarities; lower makes confidence sharper
+TEMPERATURE = 0.05
+
+SEED_EXAMPLES = {
+    "SIMPLE": [
+        "hi", "hello there", "thanks!",
+        "how much is the Google Pixel",
+        "what is the price of the Nest Hub",
+        "do you have any Samsung monitors",
+        "is the Fitbit in stock",
+        "find wireless headphones",
+        "show me laptops",
+        "set the price of the Pixel to 699",
+        "update the Nest Hub price to 89.99",
+        "what is the cheapest item",
+    ],
+    "COMPLEX": [
+        "what would the total be if I bought two Pixels and a Nest Hub with 10% off",
+        "compare the laptops and recommend one for video editing under $1500",
+        "which products should we discount to clear old stock",
+        "what if we raised all camera prices by 5 percent, how much more revenue",
+        "plan a bundle of three accessories that costs less than 200 dollars",
+        "calculate the average price of all Samsung products",
+        "suggest a pricing strategy for the holiday season",
+        "explain the trade-offs between the two most expensive phones",
+        "how many items would I need to sell to make 10000 dollars",
+        "rank our monitors by value for money",
+    ],
+}
+
+ROUTER_PROMPT = (
+    "Classify this query as 'SIMPLE' or 'COMPLEX'.\n"
+    "Query: '{query}'\n"
+    "Rules:\n"
+    "- SIMPLE: Greetings, price checks, single item updates, simple factual questions.\n"
+    "- COMPLEX: Math, multi-item reasoning, strategy, discounts, 'what if' scenarios.\n"
+    "Return ONLY the word SIMPLE or COMPLEX."
+)
+
+
+def _default_encode(queries):
+    import vector_store
+    return vector_store.encode_queries(queries)
+
+_warm_up_started = False
+
+def _default_ready():
+    """True once the embedding model is loaded; the first call starts loading it in the background."""
+    global _warm_up_started
+    import vector_store
+    state = vector_store.embedding_model_status()["state"]
+    if state == "not_loaded" and not _warm_up_started:
+        _warm_up_started = True
+        vector_store.warm_up_embedding_model()
+    return state == "ready"
+
+
+def load_examples():
+    """Labelled examples stored in router_examples, as [(query, label)]."""
+    conn = get_db_connection()
+    try:
+        return [(r['query'], r['label']) for r in conn.execute('SELECT query, label FROM router_examples')]
+    finally:
+        conn.close()
+
+def save_example(query, label, source="llm"):
+    conn = get_db_connection()
+    try:
+        conn.execute('INSERT OR REPLACE INTO router_examples (query, label, source) VALUES (?, ?, ?)',
+                     (query, label, source))
+        conn.commit()
+    finally:
+        conn.close()
+
+def parse_label(text):
+    """Maps a free-text LLM answer onto LABELS (COMPLEX when unclear, as before)."""
+    text = (text or "").strip().upper()
+    return "SIMPLE" if "SIMPLE" in text else "COMPLEX"
+
+def llm_classify(query, generate):
+    """The original LLM round trip; the answer is kept as a training example."""
+    label = parse_label(generate(ROUTER_PROMPT.format(query=query)).text)
+    save_example(query, label)
+    return label
+
+
+class QueryRouter:
+    """
+    Nearest-centroid classifier. Centroids are kept as running sums of the
+    (unit-length) example embeddings, so adding an example is O(d).
+    `encode` maps a list of strings to normalised vectors; `ready` says whether
+    encoding is cheap right now (the model is loaded), so classify never waits
+    for a model load.
+    """
+
+    def __init__(self, encode=None, ready=None, min_confidence=MIN_CONFIDENCE):
+        self.encode = encode or _default_encode
+        self.ready = ready or _default_ready
+        self.min_confidence = min_confidence
+        self._lock = threading.Lock()
+        self._sums = None
+        self._counts = None
+
+    def fit(self, examples):
+        """(Re)trains from [(query, label)] pairs."""
+        examples = [(q, l) for q, l in examples if l in LABELS]
+        vectors = self.encode([q for q, _ in examples])
+        labels = np.array([LABELS.index(l) for _, l in examples])
+        sums = np.zeros((len(LABELS), vectors.shape[1]), dtype='float32')
+        np.add.at(sums, labels, vectors)
+        with self._lock:
+            self._sums = sums
+            self._counts = np.bincount(labels, minlength=len(LABELS))
+
+    def _ensure_fitted(self):
+        if self._sums is None:
+            seeds = [(q, label) for label, queries in SEED_EXAMPLES.items() for q in queries]
+            try:
+                stored = load_examples()
+            except Exception as e:
+                print(f"Router examples unavailable: {e}")
+                stored = []
+            self.fit(seeds + stored)
+
+    def add_example(self, query, label):
+        if label not in LABELS or self._sums is None:
+            return
+        vector = self.encode([query])[0]
+        with self._lock:
+            self._sums[LABELS.index(label)] += vector
+            self._counts[LABELS.index(label)] += 1
+
+    def predict(self, query):
+        """(label, confidence) from the centroids; confidence is a softmax over cosine similarities."""
+        self._ensure_fitted()
+        vector = self.encode([query])[0]
+        with self._lock:
+            centroids = self._sums / np.linalg.norm(self._sums, axis=1, keepdims=True)
+        similarities = centroids @ vector
+        weights = np.exp((similarities - similarities.max()) / TEMPERATURE)
+        probabilities = weights / weights.sum()
+        best = int(np.argmax(probabilities))
+        return LABELS[best], float(probabilities[best])
+
+    def classify(self, query, generate=None):
+        """
+        Returns (label, confidence, source). source is "router" when the local
+        prediction was confident enough and "llm" when `generate` was asked instead
+        (confidence is None if the router could not run at all). Without
+        `generate` the local label is returned whatever its confidence, or
+        COMPLEX with source "default" if the model is not loaded yet.
+        """
+        label, confidence = None, None
+        if self.ready():
+            try:
+                label, confidence = self.predict(query)
+            except Exception as e:
+                print(f"Router prediction failed: {e}")
+        if label is not None and (confidence >= self.min_confidence or generate is None):
+            return label, confidence, "router"
+        if generate is None:
+            return "COMPLEX", None, "default"
+
+        label = llm_classify(query, generate)
+        if self._sums is not None:
+            self.add_example(query, label)
+        return label, confidence, "llm"
+
+
+_router = QueryRouter()
+
+def get_router():
+    return _router
+
+
+def label_history(generate, limit=200):
+    """
+    Labels logged user messages from chat_history that are not examples yet,
+    using the LLM classifier. Delete requests are skipped (they never reach the router).
+    """
+    conn = get_db_connection()
+    try:
+        rows = conn.execute('''
+            SELECT DISTINCT content FROM chat_history
+            WHERE role = 'user' AND content NOT IN (SELECT query FROM router_examples)
+            ORDER BY id DESC LIMIT ?
+        ''', (limit,)).fetchall()
+    finally:
+        conn.close()
+    labelled = 0
+    for r in rows:
+        query = r['content']
+        lowered = query.lower()
+        if "delete" in lowered or "remove" in lowered or lowered.strip() in ("yes", "no"):
+            continue
+        try:
+            llm_classify(query, generate)
+            labelled += 1
+        except Exception as e:
+            print(f"Could not label '{query}': {e}")
+    return labelled
+
+def evaluate(router=None):
+    """Leave-one-out accuracy of the nearest-centroid router on all known examples."""
+    router = router or _router
+    seeds = [(q, label) for label, queries in SEED_EXAMPLES.items() for q in queries]
+    examples = [(q, l) for q, l in seeds + load_examples() if l in LABELS]
+    vectors = router.encode([q for q, _ in examples])
+    labels = np.array([LABELS.index(l) for _, l in examples])
+    sums = np.zeros((len(LABELS), vectors.shape[1]), dtype='float32')
+    np.add.at(sums, labels, vectors)
+    correct = 0
+    for vector, label in zip(vectors, labels):
+        held_out = sums.copy()
+        held_out[label] -= vector
+        centroids = held_out / np.linalg.norm(held_out, axis=1, keepdims=True)
+        correct += int(np.argmax(centroids @ vector) == label)
+    return correct / len(examples) if examples else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train and check the local chat query router.")
+    parser.add_argument("--label-history", type=int, metavar="N", default=0,
+                        help="Label up to N logged user messages with the LLM and store them as examples")
+    parser.add_argument("--eval", action="store_true", help="Print leave-one-out accuracy on all examples")
+    parser.add_argument("query", nargs="*", help="Classify these queries locally")
+    args = parser.parse_args()
+
+    if args.label_history:
+        from main import generate_response_safe
+
+        def generate(prompt):
+            return generate_response_safe(prompt, model="gemini-2.5-flash")
+        print(f"Labelled {label_history(generate, args.label_history)} messages")
+
+    if args.eval:
+        print(f"Leave-one-out accuracy: {evaluate():.1%}")
+
+    router = QueryRouter(ready=lambda: True)
+    for query in args.query:
+        label, confidence = router.predict(query)
+        print(f"{label:<8} {confidence:.2f}  {query}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from database import get_db_connection
+
+# Coalesces identical concurrent calls: the first caller for a key (the leader)
+# does the work and everyone who asks for the same key meanwhile (followers)
+# waits for it and gets the same result. Nothing is cached once the call is done.
+
+# Also coalesce across worker processes through the llm_inflight / llm_results tables
+SHARED = os.environ.get("LLM_SINGLEFLIGHT_SHARED", "0") == "1"
+# A follower in another process gives up waiting (and calls itself) after this many seconds
+SHARED_WAIT = float(os.environ.get("LLM_SINGLEFLIGHT_WAIT", "120"))
+SHARED_POLL = 0.05
+# Shared results only need to outlive the followers polling for them
+SHARED_RESULT_TTL = 300
+
+
+def _canonical(value):
+    """JSON-able form of prompts and configs: pydantic models dumped, callables by name."""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if hasattr(type(value), "model_fields"):
+        # Field by field rather than model_dump, which rejects Python functions passed as tools
+        fields = ((name, getattr(value, name)) for name in type(value).model_fields)
+        return {name: _canonical(v) for name, v in fields if v is not None}
+    if callable(value):
+        return f"{getattr(value, '__module__', '')}.{getattr(value, '__qualname__', repr(value))}"
+    return repr(value)
+
+def request_key(*parts):
+    """Stable hash of everything that determines a model's answer (model, prompt, config, schema)."""
+    payload = json.dumps(_canonical(list(parts)), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    do(key, fn) runs fn once per key at a time. With shared=True the leader in each
+    process also takes a row in llm_inflight, so leaders in other workers wait for
+    its result in llm_results instead of calling again; encode/decode turn results
+    into text for that table.
+    """
+
+    def __init__(self, shared=SHARED, encode=None, decode=None):
+        self.shared = shared
+        self.encode = encode or json.dumps
+        self.decode = decode or json.loads
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.followers = 0
+        self.shared_followers = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._shared_do(key, fn) if self.shared else fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _shared_do(self, key, fn):
+        started = time.time()
+        conn = get_db_connection()
+        try:
+            # Rows left behind by a crashed worker don't block anyone for long
+            conn.execute('DELETE FROM llm_inflight WHERE started_at < ?', (started - SHARED_WAIT,))
+            claimed = conn.execute('INSERT OR IGNORE INTO llm_inflight (key, owner, started_at) VALUES (?, ?, ?)',
+                                   (key, os.getpid(), started)).rowcount == 1
+            conn.commit()
+        finally:
+            conn.close()
+
+        if not claimed:
+            result = self._wait_shared(key, started)
+            if result is not None:
+                with self._lock:
+                    self.shared_followers += 1
+                return self.decode(result)
+            # The other worker failed or took too long: do the call here
+            return fn()
+
+        try:
+            result = fn()
+            # Sharing is best effort: the call succeeded, so a failed publish only
+            # means other workers' followers make the call themselves
+            try:
+                self._publish(key, self.encode(result))
+            except Exception as e:
+                print(f"Could not share LLM result across workers: {e}")
+            return result
+        finally:
+            self._release_claim(key)
+
+    def _release_claim(self, key):
+        try:
+            with get_db_connection() as conn:
+                conn.execute('DELETE FROM llm_inflight WHERE key = ? AND owner = ?', (key, os.getpid()))
+        except Exception as e:
+            # Expires after SHARED_WAIT like a crashed worker's claim
+            print(f"Could not release LLM in-flight claim: {e}")
+
+    def _wait_shared(self, key, started):
+        """Polls for the other worker's result; None if it disappears without one or times out."""
+        while time.time() - started < SHARED_WAIT:
+            conn = get_db_connection()
+            try:
+                row = conn.execute('SELECT response FROM llm_results WHERE key = ? AND created_at >= ?',
+                                   (key, started - 1)).fetchone()
+                if row:
+                    return row['response']
+                if conn.execute('SELECT 1 FROM llm_inflight WHERE key = ?', (key,)).fetchone() is None:
+                    # Finished between the two queries, or failed
+                    row = conn.execute('SELECT response FROM llm_results WHERE key = ? AND created_at >= ?',
+                                       (key, started - 1)).fetchone()
+                    return row['response'] if row else None
+            finally:
+                conn.close()
+            time.sleep(SHARED_POLL)
+        return None
+
+    def _publish(self, key, text):
+        now = time.time()
+        conn = get_db_connection()
+        try:
+            conn.execute('INSERT OR REPLACE INTO llm_results (key, response, created_at) VALUES (?, ?, ?)',
+                         (key, text, now))
+            conn.execute('DELETE FROM llm_results WHERE created_at < ?', (now - SHARED_RESULT_TTL,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "upstream_calls": self.leaders - self.shared_followers,
+                "coalesced": self.followers + self.shared_followers,
+                "coalesced_across_workers": self.shared_followers,
+            }
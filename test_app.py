@@ -1,6 +1,16 @@
 import unittest
 import json
-from main import app
+from types import SimpleNamespace
+from unittest import mock
+import main
+from main import app, description_prompt, description_cache_key
+import database
+import threading
+import time
+import tools
+import router
+import llm_backend
+from google.genai import types
 from database import get_all_inventory_text
 
 class StoreApiTests(unittest.TestCase):
@@ -15,6 +25,55 @@ class StoreApiTests(unittest.TestCase):
         self.assertTrue(isinstance(data, list))
         self.assertTrue(len(data) >= 2) # Should have initial data
 
+    def test_get_products_keyset_page(self):
+        response = self.app.get('/products?limit=1')
+        self.assertEqual(response.status_code, 200)
+        page = json.loads(response.data)
+        self.assertEqual(len(page['products']), 1)
+        self.assertIsNotNone(page['next_after_id'])
+
+        response = self.app.get(f"/products?limit=1&after_id={page['next_after_id']}")
+        next_page = json.loads(response.data)
+        self.assertGreater(next_page['products'][0]['id'], page['products'][0]['id'])
+
+    def test_get_products_ndjson(self):
+        response = self.app.get('/products?format=ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        ids = [json.loads(line)['id'] for line in response.data.decode().splitlines()]
+        self.assertTrue(len(ids) >= 2)
+        self.assertEqual(ids, sorted(ids))
+
+    def test_product_stream_holds_no_connection_between_batches(self):
+        batches = main.iter_product_batches(batch_size=1)
+        first = next(batches)
+        # Another thread can use every slot while the client is between batches
+        held = []
+        threads = [threading.Thread(target=lambda: held.append(database._pool.acquire()))
+                   for _ in range(database._pool.size)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        for conn in held:
+            conn.close()
+        self.assertEqual(len(held), database._pool.size)
+        rest = [p for batch in batches for p in batch]
+        ids = [p['id'] for p in first + rest]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(next(main.iter_product_batches(limit=1)), first)
+
+    def test_failed_route_does_not_hold_its_connection(self):
+        response = self.app.post('/describe/99999999999999999999999')
+        self.assertEqual(response.status_code, 500)
+        self.assertNotIn(threading.get_ident(), database._pool._held)
+        # Writes on this thread still commit
+        created = json.loads(self.app.post('/products', json={"name": "After Overflow", "price": 1.0}).data)
+        self.assertEqual(json.loads(self.app.get(f"/products?limit=1&after_id={created['id'] - 1}").data)
+                         ['products'][0]['name'], "After Overflow")
+
+    def test_get_products_invalid_limit(self):
+        response = self.app.get('/products?limit=abc')
+        self.assertEqual(response.status_code, 400)
+
     def test_add_product(self):
         new_product = {"name": "Test Item", "price": 10.50}
         response = self.app.post('/products', json=new_product)
@@ -35,17 +94,276 @@ class StoreApiTests(unittest.TestCase):
         self.assertEqual(len(data), 1)
         self.assertEqual(data[0]['name'], unique_name)
 
+    def test_search_prefix_and_limit(self):
+        import time
+        brand = f"Zorblax{int(time.time())}"
+        for model in ("Phone", "Tablet"):
+            self.app.post('/products', json={"name": f"{brand} {model}", "price": 10.0})
+
+        # Prefix of the brand matches both rows, but limit caps the result
+        response = self.app.get(f'/search?q={brand[:6]}&limit=1')
+        data = json.loads(response.data)
+        self.assertEqual(len(data), 1)
+
+        # Every word has to match
+        response = self.app.get(f'/search?q={brand} tab')
+        data = json.loads(response.data)
+        self.assertEqual([p['name'] for p in data], [f"{brand} Tablet"])
+
+    def test_bulk_import_csv(self):
+        brand = f"Bulkco{int(time.time())}"
+        body = f"name,price\n{brand} Phone,199.5\n,10\n{brand} Tablet,abc\n{brand} Watch,49\n"
+        response = self.app.post('/products/bulk?batch_size=1', data=body, content_type='text/csv')
+        self.assertEqual(response.status_code, 201)
+        summary = json.loads(response.data)
+        self.assertEqual(summary['inserted'], 2)
+        self.assertEqual(summary['failed'], 2)
+        self.assertEqual([e['line'] for e in summary['errors']], [3, 4])
+
+        # Bulk rows are in the full-text index like any other insert
+        data = json.loads(self.app.get(f'/search?q={brand}').data)
+        self.assertEqual(sorted(p['name'] for p in data), [f"{brand} Phone", f"{brand} Watch"])
+
+    def test_bulk_import_ndjson(self):
+        body = '{"name": "Bulk NDJSON Item", "price": 5}\n\nnot json\n{"name": "No Price"}\n'
+        response = self.app.post('/products/bulk', data=body, content_type='application/x-ndjson')
+        summary = json.loads(response.data)
+        self.assertEqual((summary['inserted'], summary['failed']), (1, 2))
+        self.assertEqual(summary['first_id'], summary['last_id'])
+        self.assertEqual([e['line'] for e in summary['errors']], [3, 4])
+
+    def test_bulk_import_requires_format(self):
+        response = self.app.post('/products/bulk', data='name,price\n', content_type='text/plain')
+        self.assertEqual(response.status_code, 415)
+
     def test_search_empty(self):
         response = self.app.get('/search?q=NonExistentThing')
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
         self.assertEqual(len(data), 0)
 
+    def test_semantic_search_batch_validation(self):
+        response = self.app.post('/search/semantic', json={"queries": []})
+        self.assertEqual(response.status_code, 400)
+        response = self.app.post('/search/semantic', json={"queries": ["laptop", 5]})
+        self.assertEqual(response.status_code, 400)
+        response = self.app.post('/search/semantic', json={"queries": ["laptop"], "k": 0})
+        self.assertEqual(response.status_code, 400)
+
+    def test_describe_served_from_cache(self):
+        name = "Cached Describe Widget"
+        product = json.loads(self.app.post('/products', json={"name": name, "price": 20.0}).data)
+        key = description_cache_key(name, description_prompt(name))
+        database.save_description(product['id'], key, "A cached sentence.")
+
+        response = self.app.post(f"/describe/{product['id']}")
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data, {"description": "A cached sentence.", "cached": True})
+
+        # Renaming the product invalidates its entry
+        conn = database.get_db_connection()
+        conn.execute("UPDATE products SET name = ? WHERE id = ?", (name + " v2", product['id']))
+        conn.commit()
+        conn.close()
+        self.assertIsNone(database.get_cached_description(product['id'], key))
+
+    def test_inventory_report_chunked_and_resumable(self):
+        calls = []
+        def fake_generate(prompt, **kwargs):
+            calls.append(prompt)
+            ids = [int(line.split(':')[0]) for line in prompt.splitlines() if line[:1].isdigit()]
+            return SimpleNamespace(text=json.dumps([{"id": i, "category": "Gadget"} for i in ids]))
+
+        with database.get_db_connection() as conn:
+            conn.execute('DELETE FROM report_chunks')
+        with mock.patch.object(main, 'generate_response_safe', side_effect=fake_generate):
+            response = self.app.get('/inventory-report?chunk_size=2')
+            self.assertEqual(response.status_code, 200)
+            report = json.loads(response.data)
+            first_calls = len(calls)
+
+            ids = [item['id'] for item in report]
+            self.assertEqual(ids, sorted(ids))
+            self.assertGreaterEqual(first_calls, 1)
+            for item in report:
+                self.assertEqual(item['is_luxury'], item['price'] > 100)
+                self.assertEqual(item['category'], "Gadget")
+
+            # Unchanged chunks come from the chunk cache
+            streamed = self.app.get('/inventory-report?chunk_size=2&stream=1')
+            rows = [json.loads(line) for line in streamed.data.decode().splitlines()]
+            self.assertEqual([r['id'] for r in rows], ids)
+            self.assertEqual(len(calls), first_calls)
+
+    def test_inventory_report_failed_chunk(self):
+        with database.get_db_connection() as conn:
+            conn.execute('DELETE FROM report_chunks')
+        with mock.patch.object(main, 'generate_response_safe', side_effect=RuntimeError("quota")):
+            response = self.app.get('/inventory-report')
+        self.assertEqual(response.status_code, 500)
+        self.assertIn("quota", response.data.decode())
+
+    def test_describe_returns_429_when_rate_limited(self):
+        import rate_limiter
+        model_limiter = rate_limiter.limiter.model(main.DESCRIBE_MODEL)
+        model_limiter.paused_until = time.monotonic() + 60
+        self.addCleanup(setattr, model_limiter, 'paused_until', 0.0)
+        with mock.patch.object(main.llm_backend.backend, 'generate') as generate:
+            response = self.app.post('/describe/1?refresh=1')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+        generate.assert_not_called()
+
+    def test_metrics_endpoint(self):
+        self.app.get('/products?limit=1')
+        self.app.get('/search?q=pixel')
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        body = response.data.decode()
+        self.assertIn('# TYPE http_request_duration_seconds histogram', body)
+        self.assertIn('http_request_duration_seconds_count{route="/products",method="GET",status="200"}', body)
+        self.assertIn('http_request_duration_seconds_bucket{route="/search",method="GET",status="200",le="+Inf"}', body)
+        self.assertIn('db_query_duration_seconds_count{operation="select"}', body)
+
+    def test_healthz(self):
+        response = self.app.get('/healthz')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data['status'], 'ok')
+        self.assertIn(data['embedding_model'], ('not_loaded', 'loading', 'ready', 'failed'))
+
     def test_context_dumper(self):
         """Test that the context dumper returns a string containing seed data."""
         text = get_all_inventory_text()
         self.assertIsInstance(text, str)
         self.assertIn("Google Pixel", text)
 
+def text_chunk(text):
+    return types.GenerateContentResponse(candidates=[types.Candidate(
+        content=types.Content(role='model', parts=[types.Part.from_text(text=text)]))])
+
+def call_chunk(name, args):
+    return types.GenerateContentResponse(candidates=[types.Candidate(
+        content=types.Content(role='model', parts=[types.Part.from_function_call(name=name, args=args)]))])
+
+def parse_sse(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+class ChatStreamTests(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        self.app.testing = True
+        self.turns = []
+        patches = [
+            mock.patch.object(router.get_router(), 'classify', return_value=("SIMPLE", 0.9, "router")),
+            mock.patch.object(main, 'generate_stream_safe', side_effect=lambda *a, **kw: iter(self.turns.pop(0))),
+            mock.patch.dict(main.available_tools, {'search_inventory': lambda query, k=3: [
+                {"id": 1, "name": "Google Pixel", "price": 799.0, "score": 0.9}]}),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_stream_tokens_then_done(self):
+        self.turns = [[text_chunk("Hello "), text_chunk("there")]]
+        response = self.app.get('/inventory-chat/stream?q=hi')
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = parse_sse(response.data.decode())
+        self.assertEqual([name for name, _ in events], ['router', 'token', 'token', 'done'])
+        self.assertEqual(events[-1][1]['answer'], "Hello there")
+        self.assertEqual(events[-1][1]['category'], "SIMPLE")
+
+    def test_stream_tool_events(self):
+        self.turns = [[call_chunk('search_inventory', {'query': 'pixel'})], [text_chunk("We have the Pixel (ID: 1).")]]
+        events = parse_sse(self.app.get('/inventory-chat/stream?q=show+me+pixels').data.decode())
+        names = [name for name, _ in events]
+        self.assertEqual(names, ['router', 'tool_call', 'tool_result', 'products', 'token', 'done'])
+        self.assertEqual(events[1][1]['args'], {'query': 'pixel'})
+        self.assertEqual(events[-1][1]['products'][0]['id'], 1)
+
+    def test_non_streaming_route_returns_done_payload(self):
+        response = SimpleNamespace(
+            candidates=[SimpleNamespace(content=types.Content(role='model', parts=[types.Part.from_text(text="Hi!")]))],
+            function_calls=None, text="Hi!")
+        with mock.patch.object(main, 'generate_response_safe', return_value=response):
+            data = json.loads(self.app.get('/inventory-chat?q=hello').data)
+        self.assertEqual(data['answer'], "Hi!")
+        self.assertEqual(data['products'], [])
+        self.assertNotIn('type', data)
+
+    def test_non_streaming_tool_loop_on_fake_backend(self):
+        fake = llm_backend.FakeBackend([
+            {"match": "pixel", "function_call": {"name": "search_inventory", "args": {"query": "pixel"}}},
+            {"text": "The Google Pixel is $799."},
+        ])
+        with mock.patch.object(llm_backend, 'backend', fake):
+            data = json.loads(self.app.get('/inventory-chat?q=any+pixel+phones').data)
+        self.assertEqual(data['answer'], "The Google Pixel is $799.")
+        self.assertEqual([p['name'] for p in data['products']], ["Google Pixel"])
+        self.assertEqual(len(fake.calls), 2)
+
+class ToolExecutorTests(unittest.TestCase):
+    def setUp(self):
+        self.log = []
+        self.lock = threading.Lock()
+
+        def search_inventory(query, k=3):
+            time.sleep(0.2)
+            with self.lock:
+                self.log.append(('search', query))
+            return [query]
+
+        def update_product_price(product_id, new_price):
+            with self.lock:
+                self.log.append(('update', product_id))
+            return {"status": "success"}
+
+        def slow_search(query):
+            time.sleep(1)
+            return [query]
+
+        self.registry = {'search_inventory': search_inventory, 'update_product_price': update_product_price}
+        self.slow_registry = {'search_inventory': slow_search}
+
+    def test_reads_run_concurrently_in_order(self):
+        calls = [('search_inventory', {'query': q}) for q in ('a', 'b', 'c', 'd')]
+        start = time.monotonic()
+        results = tools.execute_tool_calls(calls, self.registry)
+        self.assertLess(time.monotonic() - start, 0.6)
+        self.assertEqual(results, [['a'], ['b'], ['c'], ['d']])
+
+    def test_writes_are_barriers(self):
+        calls = [('search_inventory', {'query': 'a'}),
+                 ('update_product_price', {'product_id': 1, 'new_price': 5}),
+                 ('search_inventory', {'query': 'b'})]
+        tools.execute_tool_calls(calls, self.registry)
+        self.assertEqual(self.log, [('search', 'a'), ('update', 1), ('search', 'b')])
+
+    def test_timeout_and_errors(self):
+        results = tools.execute_tool_calls(
+            [('search_inventory', {'query': 'x'}), ('unknown_tool', {}), ('search_inventory', {'nope': 1})],
+            self.slow_registry, timeout=0.1)
+        self.assertIn("timed out", results[0]['message'])
+        self.assertIn("Unknown tool", results[1]['message'])
+        self.assertEqual(results[2]['status'], 'error')
+
+    def test_tool_response_wraps_non_dict_results(self):
+        self.assertEqual(tools.tool_response([{"id": 1}]), {"result": [{"id": 1}]})
+        self.assertEqual(tools.tool_response({"status": "success"}), {"status": "success"})
+
+    def test_writes_are_not_cut_off_by_the_timeout(self):
+        def slow_update(product_id, new_price):
+            time.sleep(0.3)
+            return {"status": "success"}
+        results = tools.execute_tool_calls([('update_product_price', {'product_id': 1, 'new_price': 5})],
+                                           {'update_product_price': slow_update}, timeout=0.1)
+        self.assertEqual(results, [{"status": "success"}])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,348 @@
+import unittest
+import os
+import tempfile
+import threading
+import time
+import database
+import tools
+import chat_memory
+import generate_fake_data
+import numpy
+from database import ConnectionPool, PoolTimeout
+
+class TempDatabaseTestCase(unittest.TestCase):
+    """Runs each test against a fresh database in a temporary directory."""
+    pool_size = 2
+    with_tables = True
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.original_pool = database._pool
+        database._pool = ConnectionPool(os.path.join(self.tmp.name, 'test.db'), size=self.pool_size)
+        if self.with_tables:
+            database.create_tables()
+
+    def tearDown(self):
+        database._pool.close_all()
+        database._pool = self.original_pool
+        self.tmp.cleanup()
+
+class ConnectionPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.pool = ConnectionPool(os.path.join(self.tmp.name, 'test.db'), size=2, timeout=0.2)
+        conn = self.pool.acquire()
+        conn.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)')
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.pool.close_all()
+        self.tmp.cleanup()
+
+    def test_pragmas_applied(self):
+        conn = self.pool.acquire()
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()[0], 1)  # NORMAL
+        self.assertEqual(conn.execute('PRAGMA busy_timeout').fetchone()[0], 5000)
+        conn.close()
+
+    def test_connection_is_reused(self):
+        first = self.pool.acquire()
+        raw = first._raw
+        first.close()
+        second = self.pool.acquire()
+        self.assertIs(second._raw, raw)
+        second.close()
+
+    def test_nested_acquire_in_same_thread_shares_connection(self):
+        outer = self.pool.acquire()
+        inner = self.pool.acquire()
+        self.assertIs(outer._raw, inner._raw)
+        inner.close()
+        # Outer is still usable after the nested close
+        self.assertEqual(outer.execute('SELECT 1').fetchone()[0], 1)
+        outer.close()
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+    def test_nested_checkout_leaves_the_transaction_to_the_outer_holder(self):
+        outer = self.pool.acquire()
+        outer.execute("INSERT INTO items (name) VALUES ('outer')")
+        with self.pool.acquire() as inner:
+            inner.execute("INSERT INTO items (name) VALUES ('inner')")
+            inner.commit()
+        self.assertTrue(outer.in_transaction)
+        outer.rollback()
+        self.assertEqual(outer.execute('SELECT count(*) FROM items').fetchone()[0], 0)
+        outer.close()
+
+    def test_checkout_abandoned_by_an_exception_is_reclaimed(self):
+        def leaky():
+            conn = self.pool.acquire()
+            conn.execute("INSERT INTO items (name) VALUES ('half-done')")
+            raise OverflowError("Python int too large to convert to SQLite INTEGER")
+        with self.assertRaises(OverflowError):
+            leaky()
+
+        # The next checkout is a fresh outermost one, so its commit takes effect
+        conn = self.pool.acquire()
+        self.assertTrue(conn._outermost)
+        conn.execute("INSERT INTO items (name) VALUES ('kept')")
+        conn.commit()
+        # ...and the slot came back: another thread can check out the second connection meanwhile
+        def read():
+            with self.pool.acquire() as reader:
+                other.append([r['name'] for r in reader.execute('SELECT name FROM items')])
+        other = []
+        t = threading.Thread(target=read)
+        t.start()
+        t.join()
+        conn.close()
+        self.assertEqual(other, [['kept']])
+
+    def test_release_from_another_thread_clears_the_owner(self):
+        conn = self.pool.acquire()
+        t = threading.Thread(target=conn.close)
+        t.start()
+        t.join()
+        self.assertEqual(self.pool.stats()['idle'], 1)
+        # The owner gets a fresh checkout, not a reference to the returned connection
+        again = self.pool.acquire()
+        other = []
+        t = threading.Thread(target=lambda: other.append(self.pool.acquire()))
+        t.start()
+        t.join()
+        self.assertIsNot(again._raw, other[0]._raw)
+        other[0].close()
+        again.close()
+
+    def test_pool_size_is_bounded(self):
+        held = []
+        def hold():
+            held.append(self.pool.acquire())
+        threads = [threading.Thread(target=hold) for _ in range(2)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+
+        with self.assertRaises(PoolTimeout):
+            self.pool.acquire()
+
+        held[0].close()
+        conn = self.pool.acquire()
+        self.assertIs(conn._raw, held[0]._raw)
+        conn.close()
+        held[1].close()
+
+    def test_context_manager_commits_and_rolls_back(self):
+        with self.pool.acquire() as conn:
+            conn.execute("INSERT INTO items (name) VALUES ('kept')")
+
+        with self.assertRaises(RuntimeError):
+            with self.pool.acquire() as conn:
+                conn.execute("INSERT INTO items (name) VALUES ('dropped')")
+                raise RuntimeError("boom")
+
+        conn = self.pool.acquire()
+        names = [r['name'] for r in conn.execute('SELECT name FROM items')]
+        conn.close()
+        self.assertEqual(names, ['kept'])
+
+    def test_uncommitted_work_is_rolled_back_on_close(self):
+        conn = self.pool.acquire()
+        conn.execute("INSERT INTO items (name) VALUES ('forgotten')")
+        conn.close()
+
+        conn = self.pool.acquire()
+        self.assertEqual(conn.execute('SELECT count(*) FROM items').fetchone()[0], 0)
+        conn.close()
+
+    def test_unhealthy_connection_is_replaced(self):
+        conn = self.pool.acquire()
+        raw = conn._raw
+        conn.close()
+        raw.close()  # simulate a dead connection sitting in the pool
+
+        original = database.HEALTH_CHECK_INTERVAL
+        database.HEALTH_CHECK_INTERVAL = -1
+        try:
+            conn = self.pool.acquire()
+            self.assertIsNot(conn._raw, raw)
+            self.assertEqual(conn.execute('SELECT 1').fetchone()[0], 1)
+            conn.close()
+        finally:
+            database.HEALTH_CHECK_INTERVAL = original
+
+class SearchIndexTests(TempDatabaseTestCase):
+    # test_migration_indexes_existing_rows starts from a pre-search-index schema
+    with_tables = False
+
+    def names(self, query, limit=20):
+        return [r['name'] for r in database.search_products(query, limit)]
+
+    def test_index_follows_writes(self):
+        database.create_tables()
+        conn = database.get_db_connection()
+        conn.execute("INSERT INTO products (name, price) VALUES ('Google Pixel 8', 699)")
+        conn.execute("INSERT INTO products (name, price) VALUES ('Pixel Buds', 99)")
+        conn.commit()
+        conn.close()
+        self.assertEqual(sorted(self.names('pix')), ['Google Pixel 8', 'Pixel Buds'])
+
+        conn = database.get_db_connection()
+        conn.execute("UPDATE products SET name = 'Nest Hub' WHERE name = 'Pixel Buds'")
+        conn.execute("DELETE FROM products WHERE name = 'Google Pixel 8'")
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.names('pixel'), [])
+        self.assertEqual(self.names('nest'), ['Nest Hub'])
+
+    def test_migration_indexes_existing_rows(self):
+        # A database created before the search index existed
+        conn = database.get_db_connection()
+        conn.execute('CREATE TABLE products (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, price REAL NOT NULL)')
+        conn.execute("INSERT INTO products (name, price) VALUES ('Fitbit Charge 5', 149.95)")
+        conn.commit()
+        conn.close()
+
+        database.create_tables()
+        self.assertEqual(self.names('fitbit charge'), ['Fitbit Charge 5'])
+
+    def test_bulk_insert_updates_indexes_and_restores_triggers(self):
+        database.create_tables()
+        conn = database.get_db_connection()
+        conn.execute("INSERT INTO products (name, price) VALUES ('Nest Hub', 99)")
+        conn.commit()
+        conn.close()
+
+        ids = database.insert_products_bulk([('Pixel Fold', 1799.0), ('Pixel Tablet', 499.0)])
+        self.assertEqual(ids, (2, 3))
+        self.assertEqual(sorted(self.names('pixel')), ['Pixel Fold', 'Pixel Tablet'])
+        with database.get_db_connection() as conn:
+            changed = [r[0] for r in conn.execute('SELECT product_id FROM product_changes ORDER BY id')]
+            triggers = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+        self.assertEqual(changed, [1, 2, 3])
+        self.assertTrue(set(database.BULK_SUSPENDED_TRIGGERS) <= triggers)
+
+        # A failed batch leaves no rows behind and the triggers in place
+        with self.assertRaises(Exception):
+            database.insert_products_bulk([('Pixel Watch', 349.0), (None, 1.0)])
+        self.assertEqual(self.names('watch'), [])
+        conn = database.get_db_connection()
+        conn.execute("INSERT INTO products (name, price) VALUES ('Pixel Watch', 349)")
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.names('watch'), ['Pixel Watch'])
+
+    def test_query_building(self):
+        self.assertEqual(database.to_fts_query('Nest Cam (battery)'), '"nest"* "cam"* "battery"*')
+        self.assertEqual(database.to_fts_query('"; DROP TABLE--'), '"drop"* "table"*')
+        self.assertEqual(database.to_fts_query('***'), '')
+
+class FakeDataTests(TempDatabaseTestCase):
+    def catalog(self):
+        with database.get_db_connection() as conn:
+            return [tuple(r) for r in conn.execute('SELECT name, price FROM products ORDER BY id')]
+
+    def test_same_seed_same_catalog(self):
+        generate_fake_data.generate_fake_data(500, seed=3, batch_size=200)
+        first = self.catalog()
+        generate_fake_data.reset()
+        generate_fake_data.generate_fake_data(500, seed=3, batch_size=200)
+        self.assertEqual(self.catalog(), first)
+        self.assertEqual(len(first), 500)
+        self.assertTrue(all(generate_fake_data.MIN_PRICE <= price <= generate_fake_data.MAX_PRICE for _, price in first))
+        self.assertTrue(database.search_products(first[0][0], limit=500))
+
+    def test_brand_skew(self):
+        names, _, (brands, _, _) = generate_fake_data.sample_batch(numpy.random.default_rng(0), 20000, brand_skew=1.5)
+        counts = numpy.bincount(brands, minlength=len(generate_fake_data.BRANDS))
+        self.assertGreater(counts[0], 10 * counts[-1])
+        self.assertTrue(str(names[0]).startswith(generate_fake_data.BRANDS[brands[0]]))
+
+class ChatMemoryTests(TempDatabaseTestCase):
+    def add_messages(self, session_id, count):
+        for i in range(count):
+            tools.save_chat_message(session_id, 'user' if i % 2 == 0 else 'model', f'message {i}')
+
+    def test_history_query_uses_session_index(self):
+        with database.get_db_connection() as conn:
+            plan = ' '.join(row[3] for row in conn.execute(
+                'EXPLAIN QUERY PLAN SELECT role, content FROM chat_history '
+                'WHERE session_id = ? AND id > 0 ORDER BY id DESC LIMIT 10', ('s',)))
+        self.assertIn('idx_chat_history_session', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_history_is_recent_and_chronological(self):
+        self.add_messages('a', 5)
+        self.add_messages('b', 3)
+        history = tools.get_recent_history('a', limit=3)
+        self.assertEqual([m['parts'][0] for m in history], ['message 2', 'message 3', 'message 4'])
+
+    def test_compaction_summarizes_older_messages(self):
+        total = chat_memory.KEEP_RECENT + chat_memory.COMPACT_BATCH + 3
+        self.add_messages('s', total)
+        seen = []
+
+        def summarize(previous, messages):
+            seen.append((previous, messages))
+            return f'summary of {len(messages)}'
+
+        self.assertTrue(chat_memory.compact_session('s', summarize))
+        summarized = total - chat_memory.KEEP_RECENT
+        self.assertEqual(len(seen[0][1]), summarized)
+        self.assertIsNone(seen[0][0])
+        summary, last_id = database.get_chat_summary('s')
+        self.assertEqual(summary, f'summary of {summarized}')
+
+        # History now starts right after the summarized messages
+        history = tools.get_recent_history('s', limit=total)
+        self.assertEqual(len(history), chat_memory.KEEP_RECENT)
+        self.assertEqual(history[0]['parts'][0], f'message {summarized}')
+
+        # Nothing more to do until another batch builds up
+        self.assertFalse(chat_memory.compact_session('s', summarize))
+        self.add_messages('s', chat_memory.COMPACT_BATCH - 1)
+        self.assertFalse(chat_memory.compact_session('s', summarize))
+        self.add_messages('s', 1)
+        self.assertTrue(chat_memory.compact_session('s', summarize))
+        self.assertEqual(len(seen[1][1]), chat_memory.COMPACT_BATCH)
+        self.assertEqual(seen[1][0], f'summary of {summarized}')
+
+    def test_write_behind_batches_and_reads_own_writes(self):
+        writer = database.ChatWriter(interval=60, batch_size=1000)
+        original = database.chat_writer
+        database.chat_writer = writer
+        try:
+            for i in range(5):
+                tools.save_chat_message('w', 'user', f'message {i}')
+            writer.append('other', 'user', 'queued')
+            self.assertEqual(writer.stats()['queued'], 6)
+
+            # Reading the session flushes everything queued so far in one batch, in order
+            history = tools.get_recent_history('w', limit=10)
+            self.assertEqual([m['parts'][0] for m in history], [f'message {i}' for i in range(5)])
+            self.assertEqual(writer.stats(), {"queued": 0, "batches": 1, "rows": 6})
+
+            # A session with nothing queued doesn't force a write
+            writer.append('other', 'model', 'later')
+            tools.get_recent_history('w', limit=10)
+            self.assertEqual(writer.stats()['queued'], 1)
+            writer.flush()
+            self.assertEqual(len(tools.get_recent_history('other')), 2)
+        finally:
+            database.chat_writer = original
+
+    def test_write_behind_flushes_full_batches_in_background(self):
+        writer = database.ChatWriter(interval=60, batch_size=3)
+        for i in range(3):
+            writer.append('bg', 'user', f'message {i}')
+        deadline = time.monotonic() + 5
+        while writer.stats()['rows'] < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(writer.stats()['batches'], 1)
+        with database.get_db_connection() as conn:
+            count = conn.execute("SELECT count(*) FROM chat_history WHERE session_id = 'bg'").fetchone()[0]
+        self.assertEqual(count, 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,433 @@
+import unittest
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from google.genai import types
+import database
+import rate_limiter
+import singleflight
+import llm_backend
+import metrics
+from test_database import TempDatabaseTestCase
+import agent_supervisor
+import agent_handshake
+from unittest import mock
+from rate_limiter import ModelLimiter, RateLimitExceeded, INTERACTIVE, BACKGROUND
+
+QUOTA_429 = (
+    "429 RESOURCE_EXHAUSTED. {'error': {'code': 429, 'details': [{'@type': 'type.googleapis.com/google.rpc.QuotaFailure', "
+    "'violations': [{'quotaMetric': 'generativelanguage.googleapis.com/generate_content_free_tier_requests', "
+    "'quotaId': 'GenerateRequestsPerMinutePerProjectPerModel-FreeTier', 'quotaValue': '10'}]}, "
+    "{'@type': 'type.googleapis.com/google.rpc.RetryInfo', 'retryDelay': '7s'}]}}"
+)
+
+class RateLimiterTests(unittest.TestCase):
+    def test_request_bucket_sheds_when_empty(self):
+        limiter = ModelLimiter('m', rpm=2, tpm=100000)
+        limiter.acquire(10)
+        limiter.acquire(10)
+        with self.assertRaises(RateLimitExceeded) as ctx:
+            limiter.acquire(10, max_wait=0.05)
+        self.assertGreater(ctx.exception.retry_after, 20)
+        stats = limiter.stats()
+        self.assertEqual((stats['admitted'], stats['shed'], stats['queue_depth']), (2, 1, 0))
+
+    def test_token_bucket_limits_large_prompts(self):
+        limiter = ModelLimiter('m', rpm=100, tpm=1000)
+        limiter.acquire(900)
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire(900, max_wait=0.05)
+        # Actual usage below the estimate gives tokens back
+        limiter.record(900, 100)
+        limiter.acquire(800, max_wait=0.05)
+
+    def test_interactive_calls_jump_the_queue(self):
+        limiter = ModelLimiter('m', rpm=600, tpm=100000)  # one request per 0.1s
+        limiter.requests.tokens = 0.0
+        order = []
+
+        def call(name, priority):
+            limiter.acquire(1, priority, max_wait=2)
+            order.append(name)
+
+        background = threading.Thread(target=call, args=('report', BACKGROUND))
+        background.start()
+        time.sleep(0.02)
+        self.assertEqual(limiter.stats()['queue_background'], 1)
+        interactive = threading.Thread(target=call, args=('chat', INTERACTIVE))
+        interactive.start()
+        background.join()
+        interactive.join()
+        self.assertEqual(order, ['chat', 'report'])
+
+    def test_429_pauses_callers_and_adopts_quota(self):
+        limiter = ModelLimiter('m', rpm=1000, tpm=100000)
+        limiter.throttle(7, QUOTA_429)
+        self.assertEqual(limiter.requests.capacity, 10)
+        with self.assertRaises(RateLimitExceeded) as ctx:
+            limiter.acquire(1, max_wait=1)
+        self.assertGreater(ctx.exception.retry_after, 5)
+
+    def test_helpers(self):
+        self.assertEqual(rate_limiter.parse_quota(QUOTA_429), {"rpm": 10})
+        self.assertEqual(rate_limiter.parse_limits("a=10:5000, b=3"), {"a": (10, 5000), "b": (3, rate_limiter.DEFAULT_TPM)})
+        self.assertEqual(rate_limiter.estimate_tokens(["abcd" * 10, "x"]), 12)
+
+class SingleFlightTests(TempDatabaseTestCase):
+    pool_size = 4
+
+    def setUp(self):
+        super().setUp()
+        self.calls = 0
+
+    def slow_call(self, value="answer", error=None):
+        def fn():
+            self.calls += 1
+            time.sleep(0.2)
+            if error:
+                raise error
+            return value
+        return fn
+
+    def run_concurrently(self, flight, n, fn):
+        results = [None] * n
+        def worker(i):
+            try:
+                results[i] = flight.do('k', fn)
+            except Exception as e:
+                results[i] = e
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+        for t in threads:
+            t.start()
+            time.sleep(0.01)
+        for t in threads:
+            t.join()
+        return results
+
+    def test_concurrent_identical_calls_share_one_upstream_call(self):
+        flight = singleflight.SingleFlight(shared=False)
+        self.assertEqual(self.run_concurrently(flight, 5, self.slow_call()), ["answer"] * 5)
+        self.assertEqual(self.calls, 1)
+        stats = flight.stats()
+        self.assertEqual((stats['upstream_calls'], stats['coalesced'], stats['in_flight']), (1, 4, 0))
+        # Nothing is cached afterwards
+        flight.do('k', self.slow_call())
+        self.assertEqual(self.calls, 2)
+
+    def test_errors_reach_every_waiter(self):
+        flight = singleflight.SingleFlight(shared=False)
+        results = self.run_concurrently(flight, 3, self.slow_call(error=RuntimeError("quota")))
+        self.assertTrue(all(isinstance(r, RuntimeError) for r in results))
+        self.assertEqual(self.calls, 1)
+
+    def test_shared_mode_coalesces_across_workers(self):
+        # Two instances stand in for two worker processes sharing the database
+        worker_a = singleflight.SingleFlight(shared=True)
+        worker_b = singleflight.SingleFlight(shared=True)
+        results = {}
+        leader = threading.Thread(target=lambda: results.update(a=worker_a.do('k', self.slow_call({"text": "hi"}))))
+        leader.start()
+        time.sleep(0.05)
+        results['b'] = worker_b.do('k', self.slow_call({"text": "other"}))
+        leader.join()
+        self.assertEqual(results, {'a': {"text": "hi"}, 'b': {"text": "hi"}})
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(worker_b.stats()['coalesced_across_workers'], 1)
+
+    def test_failed_publish_still_returns_the_result(self):
+        def unencodable(result):
+            raise TypeError("not serialisable")
+        flight = singleflight.SingleFlight(shared=True, encode=unencodable)
+        self.assertEqual(flight.do('k', self.slow_call()), "answer")
+        with database.get_db_connection() as conn:
+            self.assertIsNone(conn.execute('SELECT 1 FROM llm_inflight').fetchone())
+
+    def test_request_key(self):
+        prompt = [types.Content(role='user', parts=[types.Part.from_text(text='hi')])]
+        same = [types.Content(role='user', parts=[types.Part.from_text(text='hi')])]
+        schema = {"type": "OBJECT", "properties": {"a": {"type": "STRING"}}}
+        self.assertEqual(singleflight.request_key('m', prompt, None), singleflight.request_key('m', same, None))
+        self.assertNotEqual(singleflight.request_key('m', prompt, None), singleflight.request_key('m', prompt, schema))
+        self.assertNotEqual(singleflight.request_key('m', 'hi'), singleflight.request_key('n', 'hi'))
+
+class MetricsTests(unittest.TestCase):
+    def test_histogram_and_counter_render(self):
+        registry = metrics.Registry()
+        h = registry.histogram("op_seconds", "Op latency.", ("op",), buckets=(0.1, 1))
+        c = registry.counter("ops_total", "Ops.", ("op",))
+        for value in (0.05, 0.1, 0.5, 3):
+            h.observe(value, op='a"b')
+        c.inc(op="x")
+        c.inc(2, op="x")
+        lines = registry.render().splitlines()
+        self.assertIn('op_seconds_bucket{op="a\\"b",le="0.1"} 2', lines)
+        self.assertIn('op_seconds_bucket{op="a\\"b",le="1.0"} 3', lines)
+        self.assertIn('op_seconds_bucket{op="a\\"b",le="+Inf"} 4', lines)
+        self.assertIn('op_seconds_count{op="a\\"b"} 4', lines)
+        self.assertIn('op_seconds_sum{op="a\\"b"} 3.65', lines)
+        self.assertIn('ops_total{op="x"} 3', lines)
+        self.assertEqual(lines[:2], ["# HELP op_seconds Op latency.", "# TYPE op_seconds histogram"])
+
+    def test_llm_call_metrics(self):
+        import main
+        model = "metrics-test-model"
+        fake = llm_backend.FakeBackend([{"error": "429 RESOURCE_EXHAUSTED. Please retry in 0s.", "times": 1},
+                                        {"text": "done"}])
+        with mock.patch.object(llm_backend, 'backend', fake):
+            self.assertEqual(main.generate_response_safe("metrics prompt", model=model, purpose="describe").text, "done")
+        labels = dict(model=model, purpose="describe")
+        self.assertEqual(metrics.llm_requests.value(outcome="rate_limited", **labels), 1)
+        self.assertEqual(metrics.llm_requests.value(outcome="ok", **labels), 1)
+        self.assertEqual(metrics.llm_rate_limited.value(**labels), 1)
+        self.assertEqual(metrics.llm_retries.value(**labels), 1)
+        self.assertEqual(metrics.llm_request_duration.count(**labels), 2)
+        self.assertGreater(metrics.llm_backoff_seconds.value(**labels), 0.5)
+        self.assertGreater(metrics.llm_tokens.value(kind="total", **labels), 0)
+
+    def test_supervisor_call_retries_429(self):
+        model = "supervisor-metrics-model"
+        fake = llm_backend.FakeBackend([{"error": "429 RESOURCE_EXHAUSTED. Please retry in 0s.", "times": 1},
+                                        {"text": "planned"}])
+        with mock.patch.object(llm_backend, 'backend', fake):
+            res = agent_supervisor.run_sync(agent_supervisor.generate_async("plan this", model=model))
+        self.assertEqual(res.text, "planned")
+        labels = dict(model=model, purpose="supervisor")
+        self.assertEqual(metrics.llm_requests.value(outcome="rate_limited", **labels), 1)
+        self.assertEqual(metrics.llm_requests.value(outcome="error", **labels), 0)
+        self.assertEqual(metrics.llm_requests.value(outcome="ok", **labels), 1)
+        self.assertEqual(metrics.llm_retries.value(**labels), 1)
+        self.assertGreater(metrics.llm_backoff_seconds.value(**labels), 0.5)
+
+    def test_handshake_agent_calls_retry_429(self):
+        fake = llm_backend.FakeBackend([{"error": "429 RESOURCE_EXHAUSTED. Please retry in 0s.", "times": 1},
+                                        {"json": {"target": "USER", "message": "hello"}}])
+        with mock.patch.object(llm_backend, 'backend', fake):
+            self.assertEqual(agent_handshake.support_agent("hi"), {"target": "USER", "message": "hello"})
+        labels = dict(model=agent_handshake.AGENT_MODEL, purpose="handshake")
+        self.assertEqual(metrics.llm_requests.value(outcome="rate_limited", **labels), 1)
+        self.assertEqual(metrics.llm_requests.value(outcome="ok", **labels), 1)
+        self.assertEqual(metrics.llm_retries.value(**labels), 1)
+
+    def test_tool_metrics(self):
+        import tools
+        registry = {'ok_tool': lambda: {"status": "success"}, 'bad_tool': lambda: {"status": "error", "message": "x"}}
+        unknown_before = metrics.tool_call_duration.count(tool='unknown', outcome='unknown')
+        tools.execute_tool_calls([('ok_tool', {}), ('bad_tool', {}), ('missing_tool', {})], registry)
+        self.assertEqual(metrics.tool_call_duration.count(tool='ok_tool', outcome='ok'), 1)
+        self.assertEqual(metrics.tool_call_duration.count(tool='bad_tool', outcome='error'), 1)
+        self.assertEqual(metrics.tool_call_duration.count(tool='unknown', outcome='unknown'), unknown_before + 1)
+        self.assertEqual(metrics.tool_call_duration.count(tool='missing_tool', outcome='unknown'), 0)
+
+class RequestKeyTests(unittest.TestCase):
+    def test_config_with_function_tools(self):
+        def search_inventory(query: str):
+            return []
+        config = types.GenerateContentConfig(tools=[search_inventory], system_instruction="x")
+        key = singleflight.request_key('m', 'q', config)
+        self.assertEqual(key, singleflight.request_key('m', 'q', types.GenerateContentConfig(
+            tools=[search_inventory], system_instruction="x")))
+        self.assertNotEqual(key, singleflight.request_key('m', 'q', types.GenerateContentConfig(system_instruction="x")))
+
+class SupervisorPlanTests(unittest.TestCase):
+    def test_normalize_plan_orders_prerequisites_first(self):
+        plan = agent_supervisor.normalize_plan([
+            {"id": "ship", "agent": "SHIPPING", "instruction": "shipping", "depends_on": ["inv"]},
+            {"id": "inv", "agent": "INVENTORY", "instruction": "price", "depends_on": ["missing"]},
+        ])
+        self.assertEqual([t['id'] for t in plan], ["inv", "ship"])
+        self.assertEqual(plan[0]['depends_on'], [])
+
+    def test_normalize_plan_without_dependencies_keeps_old_order_rule(self):
+        plan = agent_supervisor.normalize_plan([
+            {"agent": "INVENTORY", "instruction": "a"},
+            {"agent": "INVENTORY", "instruction": "b"},
+            {"agent": "SHIPPING", "instruction": "c"},
+        ])
+        self.assertEqual([(t['id'], t['depends_on']) for t in plan], [("t1", []), ("t2", []), ("t3", ["t1", "t2"])])
+
+    def test_normalize_plan_breaks_cycles(self):
+        plan = agent_supervisor.normalize_plan([
+            {"id": "a", "agent": "INVENTORY", "instruction": "a", "depends_on": ["b"]},
+            {"id": "b", "agent": "INVENTORY", "instruction": "b", "depends_on": ["a"]},
+        ])
+        self.assertEqual([(t['id'], t['depends_on']) for t in plan], [("a", []), ("b", ["a"])])
+
+    def test_independent_tasks_run_concurrently(self):
+        contexts = {}
+
+        async def inventory(instruction):
+            await asyncio.sleep(0.2)
+            return f"{instruction} costs $120"
+
+        async def shipping(instruction, context=""):
+            contexts[instruction] = context
+            await asyncio.sleep(0.2)
+            return "free shipping"
+
+        plan = agent_supervisor.normalize_plan([
+            {"id": "t1", "agent": "INVENTORY", "instruction": "Pixel", "depends_on": []},
+            {"id": "t2", "agent": "INVENTORY", "instruction": "Nest Hub", "depends_on": []},
+            {"id": "t3", "agent": "SHIPPING", "instruction": "ship Pixel", "depends_on": ["t1"]},
+        ])
+        with mock.patch.object(agent_supervisor, 'inventory_expert_async', inventory), \
+             mock.patch.object(agent_supervisor, 'shipping_specialist_async', shipping):
+            start = time.perf_counter()
+            results = agent_supervisor.run_sync(agent_supervisor.execute_plan(plan))
+            elapsed = time.perf_counter() - start
+
+        # Critical path (inventory -> shipping) rather than the sum of all three tasks
+        self.assertLess(elapsed, 0.55)
+        self.assertEqual([r['output'] for r in results], ["Pixel costs $120", "Nest Hub costs $120", "free shipping"])
+        self.assertEqual(contexts["ship Pixel"], "[INVENTORY Report]: Pixel costs $120\n")
+        self.assertLess(results[0]['finished_after'], results[2]['finished_after'])
+
+class SpeculativeHandshakeTests(unittest.TestCase):
+    def setUp(self):
+        self.expert_calls = []
+        self.contexts = []
+        self.stats = agent_handshake.SpeculationStats()
+        self.search_results = [{"id": 1, "name": "Google Pixel", "price": 799.0, "quantity": 10, "score": 0.8}]
+        self.search_seconds = 0.1
+        patches = [
+            mock.patch.object(agent_handshake, 'speculation_stats', self.stats),
+            mock.patch.object(agent_handshake, 'inventory_expert', side_effect=lambda req: self.expert_calls.append(req) or "expert says"),
+            mock.patch.object(agent_handshake.tools, 'search_inventory', side_effect=self.search),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def search(self, query, k=3):
+        time.sleep(self.search_seconds)
+        return self.search_results
+
+    def support_agent(self, target):
+        def agent(user_query, expert_response=None):
+            time.sleep(0.1)
+            if expert_response:
+                self.contexts.append(expert_response)
+                return {"target": "USER", "message": "final"}
+            return {"target": target, "request": "find pixel", "message": "hello"}
+        return mock.patch.object(agent_handshake, 'support_agent', side_effect=agent)
+
+    def test_good_local_match_skips_the_expert(self):
+        with self.support_agent("EXPERT"):
+            start = time.perf_counter()
+            reply, route = agent_handshake.handle_query("pixel price")
+            elapsed = time.perf_counter() - start
+        self.assertEqual((reply, route), ("final", "speculative"))
+        self.assertEqual(self.expert_calls, [])
+        self.assertIn("Google Pixel (ID: 1): $799.0", self.contexts[0])
+        # The search overlapped the first Support Agent call
+        self.assertLess(elapsed, 0.28)
+        self.assertEqual(self.stats.summary()['used'], 1)
+
+    def test_weak_match_falls_back_to_the_expert(self):
+        self.search_results = [{"id": 2, "name": "Cable", "price": 9.0, "score": 0.1}]
+        with self.support_agent("EXPERT"):
+            self.assertEqual(agent_handshake.handle_query("pixel price"), ("final", "expert"))
+        self.assertEqual(self.expert_calls, ["find pixel"])
+        self.assertEqual(self.contexts, ["expert says"])
+        self.assertEqual(self.stats.summary()['insufficient'], 1)
+
+    def test_slow_search_counts_as_insufficient(self):
+        self.search_seconds = 0.6
+        with self.support_agent("EXPERT"):
+            start = time.perf_counter()
+            self.assertEqual(agent_handshake.handle_query("pixel price"), ("final", "expert"))
+            elapsed = time.perf_counter() - start
+        self.assertEqual(self.expert_calls, ["find pixel"])
+        self.assertEqual(self.stats.summary()['insufficient'], 1)
+        # Two agent calls plus at most one agent call's worth of waiting, not the whole search
+        self.assertLess(elapsed, 0.5)
+
+    def test_direct_reply_wastes_the_speculation(self):
+        with self.support_agent("USER"):
+            self.assertEqual(agent_handshake.handle_query("hi"), ("hello", "direct"))
+        summary = self.stats.summary()
+        self.assertEqual((summary['wasted'], summary['hit_rate']), (1, 0.0))
+
+class LLMBackendTests(unittest.TestCase):
+    def test_fake_rules_tool_call_then_text(self):
+        backend = llm_backend.FakeBackend([
+            {"match": "pixel", "function_call": {"name": "search_inventory", "args": {"query": "pixel"}}},
+            {"match": "hours", "text": "We open at 9."},
+        ])
+        res = backend.generate('m', [types.Content(role='user', parts=[types.Part(text='Any Pixel phones?')])])
+        self.assertEqual(res.function_calls[0].name, 'search_inventory')
+        self.assertEqual(res.function_calls[0].args, {"query": "pixel"})
+        # The tool result turn has no text, so it gets the default answer
+        res = backend.generate('m', [types.Content(role='user', parts=[
+            types.Part.from_function_response(name='search_inventory', response={"result": []})])])
+        self.assertEqual(res.text, "Fake response.")
+        self.assertEqual(backend.generate('m', 'Opening hours?').text, "We open at 9.")
+        self.assertGreater(res.usage_metadata.total_token_count, 0)
+
+    def test_fake_scripted_429_is_retried(self):
+        backend = llm_backend.FakeBackend([{"error": "429 RESOURCE_EXHAUSTED", "times": 1}, {"text": "ok"}])
+        with self.assertRaises(llm_backend.FakeAPIError):
+            backend.generate('m', 'hi')
+        self.assertEqual(backend.generate('m', 'hi').text, "ok")
+
+    def test_fake_call_history_is_bounded(self):
+        backend = llm_backend.FakeBackend()
+        for i in range(llm_backend.FAKE_CALL_HISTORY + 5):
+            backend.generate('m', f'question {i}')
+        self.assertEqual(len(backend.calls), llm_backend.FAKE_CALL_HISTORY)
+        self.assertEqual(backend.calls[0], {"model": "m", "text": "question 5"})
+        self.assertEqual(backend.calls[-1]["text"], f"question {llm_backend.FAKE_CALL_HISTORY + 4}")
+
+    def test_fake_structured_output_follows_schema(self):
+        schema = {"type": "OBJECT", "properties": {
+            "target": {"type": "STRING", "enum": ["USER", "EXPERT"]},
+            "items": {"type": "ARRAY", "items": {"type": "OBJECT", "properties": {"id": {"type": "INTEGER"}}}}}}
+        res = llm_backend.FakeBackend().generate('m', 'q', types.GenerateContentConfig(
+            response_schema=schema, response_mime_type="application/json"))
+        self.assertEqual(json.loads(res.text), {"target": "USER", "items": [{"id": 0}]})
+
+    def test_fake_latency_and_stream(self):
+        backend = llm_backend.FakeBackend([{"text": "one two three four five six seven eight"}], latency="fixed:40")
+        start = time.monotonic()
+        chunks = list(backend.generate_stream('m', 'q'))
+        self.assertGreaterEqual(time.monotonic() - start, 0.035)
+        self.assertEqual(len(chunks), llm_backend.FAKE_STREAM_CHUNKS)
+        self.assertEqual("".join(c.text for c in chunks), "one two three four five six seven eight")
+        sampler = llm_backend.parse_latency("lognormal:100:0.5")
+        self.assertGreater(sampler(__import__('random').Random(0)), 0)
+        with self.assertRaises(ValueError):
+            llm_backend.parse_latency("normal:1")
+
+    def test_record_then_replay(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'rec.jsonl')
+            recorder = llm_backend.RecordingBackend(llm_backend.FakeBackend([
+                {"match": "first", "text": "A", "times": 1}, {"text": "B"}]), path=path)
+            config = types.GenerateContentConfig(system_instruction="be brief")
+            self.assertEqual(recorder.generate('m', 'first question', config).text, "A")
+            self.assertEqual(recorder.generate('m', 'first question', config).text, "B")
+            self.assertEqual("".join(c.text for c in recorder.generate_stream('m', 'stream me')), "B")
+
+            replay = llm_backend.ReplayBackend(path)
+            self.assertEqual(replay.generate('m', 'first question', config).text, "A")
+            self.assertEqual(replay.generate('m', 'first question', config).text, "B")
+            self.assertEqual(asyncio.run(replay.agenerate('m', 'first question', config)).text, "A")
+            self.assertEqual("".join(c.text for c in replay.generate_stream('m', 'stream me')), "B")
+            with self.assertRaises(LookupError):
+                replay.generate('m', 'first question')  # different config
+
+    def test_supervisor_runs_on_fake_backend(self):
+        fake = llm_backend.FakeBackend([
+            {"match": "User Request", "json": {"plan": [
+                {"id": "t1", "agent": "GENERAL", "instruction": "Say hello", "depends_on": []}]}},
+            {"text": "Hello from the fake."},
+        ])
+        with mock.patch.object(llm_backend, 'backend', fake):
+            answer = agent_supervisor.answer_question("hi there")
+        self.assertIn("Hello from the fake.", json.dumps(answer))
+        self.assertGreaterEqual(len(fake.calls), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,358 @@
+import unittest
+import os
+import tempfile
+import hashlib
+import numpy as np
+import database
+import vector_store
+import ann_index
+from test_database import TempDatabaseTestCase
+from embedding_cache import QueryEmbeddingCache, cache_key
+from types import SimpleNamespace
+from unittest import mock
+import router
+
+class HashEncoder:
+    """Deterministic stand-in for the sentence transformer: one vector per distinct text."""
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, texts, **kwargs):
+        self.encoded.extend(texts)
+        vectors = []
+        for t in texts:
+            seed = int(hashlib.sha256(t.encode()).hexdigest()[:8], 16)
+            vectors.append(np.random.default_rng(seed).normal(size=8))
+        return np.array(vectors, dtype='float32')
+
+class IncrementalIndexTests(TempDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.original = (vector_store.EMBEDDINGS_PATH, vector_store.METADATA_PATH, ann_index.ANN_PATH)
+        vector_store.EMBEDDINGS_PATH = os.path.join(self.tmp.name, 'emb.npy')
+        vector_store.METADATA_PATH = os.path.join(self.tmp.name, 'meta.json')
+        ann_index.ANN_PATH = os.path.join(self.tmp.name, 'ivf.npz')
+
+        self.encoder = HashEncoder()
+        self.execute("INSERT INTO products (name, price) VALUES ('Google Pixel', 799)")
+        self.execute("INSERT INTO products (name, price) VALUES ('Nest Hub', 99.99)")
+        self.execute("INSERT INTO products (name, price) VALUES ('Fitbit Charge 5', 149.95)")
+        # Seed the index as a full ingest would
+        vector_store._model = self.encoder
+        vector_store.ingest_inventory()
+        self.encoder.encoded.clear()
+
+    def tearDown(self):
+        vector_store._model = None
+        vector_store.EMBEDDINGS_PATH, vector_store.METADATA_PATH, ann_index.ANN_PATH = self.original
+        super().tearDown()
+
+    def execute(self, sql, params=()):
+        conn = database.get_db_connection()
+        conn.execute(sql, params)
+        conn.commit()
+        conn.close()
+
+    def load(self):
+        return np.load(vector_store.EMBEDDINGS_PATH), vector_store._load_metadata()
+
+    def test_only_changed_products_are_embedded(self):
+        self.execute("INSERT INTO products (name, price) VALUES ('Chromecast', 49.99)")
+        self.execute("UPDATE products SET price = 699 WHERE name = 'Google Pixel'")
+
+        result = vector_store.apply_pending_changes(self.encoder)
+
+        self.assertEqual(result, {"upserted": 2, "deleted": 0})
+        self.assertEqual(len(self.encoder.encoded), 2)
+        embeddings, metadata = self.load()
+        self.assertEqual(embeddings.shape, (4, 8))
+        self.assertEqual(len(metadata), 4)
+        self.assertEqual(metadata[0]['price'], 699.0)
+        self.assertEqual(metadata[3]['name'], 'Chromecast')
+        expected = vector_store.normalize(self.encoder.encode([metadata[3]['text']]))[0]
+        np.testing.assert_array_equal(embeddings[3], expected)
+
+    def test_deletes_are_tombstoned(self):
+        self.execute("DELETE FROM products WHERE name = 'Nest Hub'")
+        vector_store.COMPACT_THRESHOLD, original = 1.0, vector_store.COMPACT_THRESHOLD
+        try:
+            result = vector_store.apply_pending_changes(self.encoder)
+        finally:
+            vector_store.COMPACT_THRESHOLD = original
+
+        self.assertEqual(result, {"upserted": 0, "deleted": 1})
+        self.assertEqual(self.encoder.encoded, [])
+        embeddings, metadata = self.load()
+        self.assertTrue(metadata[1]['deleted'])
+        self.assertFalse(embeddings[1].any())
+
+    def test_compaction_drops_tombstones(self):
+        self.execute("DELETE FROM products WHERE name IN ('Nest Hub', 'Fitbit Charge 5')")
+        vector_store.apply_pending_changes(self.encoder)
+
+        embeddings, metadata = self.load()
+        self.assertEqual(embeddings.shape[0], 1)
+        self.assertEqual([m['name'] for m in metadata], ['Google Pixel'])
+
+    def test_change_log_is_trimmed(self):
+        self.execute("UPDATE products SET name = 'Pixel 9' WHERE name = 'Google Pixel'")
+        vector_store.apply_pending_changes(self.encoder)
+        self.assertEqual(vector_store.apply_pending_changes(self.encoder), {"upserted": 0, "deleted": 0})
+
+    def test_change_log_is_applied_in_batches(self):
+        self.execute("INSERT INTO products (name, price) VALUES ('Chromecast', 49.99)")
+        self.execute("INSERT INTO products (name, price) VALUES ('Nest Mini', 29.99)")
+        self.execute("DELETE FROM products WHERE name = 'Nest Hub'")
+        batches = []
+        embed = vector_store.embed_products
+        def embed_products(products, model=None):
+            batches.append(len(products))
+            return embed(products, model)
+        with mock.patch.object(vector_store, 'embed_products', embed_products), \
+                mock.patch.object(vector_store, 'COMPACT_THRESHOLD', 1.0):
+            result = vector_store.apply_pending_changes(self.encoder, batch_size=1)
+
+        self.assertEqual(result, {"upserted": 2, "deleted": 1})
+        self.assertEqual(batches, [1, 1])
+        _, metadata = self.load()
+        self.assertEqual([m['name'] for m in metadata if not m.get('deleted')],
+                         ['Google Pixel', 'Fitbit Charge 5', 'Chromecast', 'Nest Mini'])
+        with database.get_db_connection() as conn:
+            self.assertEqual(conn.execute('SELECT count(*) FROM product_changes').fetchone()[0], 0)
+
+    def test_append_rows_in_place(self):
+        path = os.path.join(self.tmp.name, 'grow.npy')
+        np.save(path, np.ones((2, 3), dtype='float32'))
+        self.assertTrue(vector_store._append_rows(path, np.full((1, 3), 2, dtype='float32')))
+        np.testing.assert_array_equal(np.load(path), [[1, 1, 1], [1, 1, 1], [2, 2, 2]])
+
+class ResidentIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.original = (vector_store.EMBEDDINGS_PATH, vector_store.METADATA_PATH, ann_index.ANN_PATH)
+        vector_store.EMBEDDINGS_PATH = os.path.join(self.tmp.name, 'emb.npy')
+        vector_store.METADATA_PATH = os.path.join(self.tmp.name, 'meta.json')
+        ann_index.ANN_PATH = os.path.join(self.tmp.name, 'ivf.npz')
+        self.index = vector_store.ResidentIndex()
+
+    def tearDown(self):
+        vector_store.EMBEDDINGS_PATH, vector_store.METADATA_PATH, ann_index.ANN_PATH = self.original
+        self.tmp.cleanup()
+
+    def write(self, embeddings, names, deleted=()):
+        metadata = [{"id": i + 1, "name": n, "price": 1.0, "text": n, **({"deleted": True} if n in deleted else {})}
+                    for i, n in enumerate(names)]
+        vector_store._save_metadata(metadata)
+        vector_store._save_embeddings(np.array(embeddings, dtype='float32'))
+        vector_store._bump_version()
+
+    def test_missing_index(self):
+        self.assertIsNone(self.index.get())
+
+    def test_legacy_unnormalised_file_is_normalised_once(self):
+        self.write([[3, 0], [0, 10], [1, 1]], ['a', 'b', 'c'])
+        snapshot = self.index.get()
+        np.testing.assert_allclose(np.linalg.norm(snapshot.embeddings, axis=1), 1.0, rtol=1e-6)
+        results = snapshot.search(np.array([0, 1], dtype='float32'), k=2)
+        self.assertEqual([m['name'] for m, _ in results], ['b', 'c'])
+        self.assertAlmostEqual(results[0][1], 1.0, places=5)
+
+    def test_normalised_file_stays_memory_mapped(self):
+        self.write([[1, 0], [0, 1]], ['a', 'b'])
+        self.assertIsInstance(self.index.get().embeddings, np.memmap)
+
+    def test_snapshot_is_reused_until_files_change(self):
+        self.write([[1, 0], [0, 1]], ['a', 'b'])
+        first = self.index.get()
+        self.assertIs(self.index.get(), first)
+
+        self.write([[1, 0], [0, 1], [0.6, 0.8]], ['a', 'b', 'c'])
+        second = self.index.get()
+        self.assertIsNot(second, first)
+        self.assertEqual(len(second.metadata), 3)
+
+    def test_tombstones_never_match(self):
+        self.write([[1, 0], [0.9, 0.1], [0, 1]], ['a', 'b', 'c'], deleted={'a'})
+        snapshot = self.index.get()
+        # k is larger than the number of live rows
+        results = snapshot.search(np.array([1, 0], dtype='float32'), k=3)
+        self.assertEqual([m['name'] for m, _ in results], ['b', 'c'])
+        batch = snapshot.search_batch(np.array([[1, 0], [0, 1]], dtype='float32'), k=3)
+        self.assertEqual([[m['name'] for m, _ in matches] for matches in batch], [['b', 'c'], ['c', 'b']])
+        self.assertTrue(all(np.isfinite(s) for matches in batch for _, s in matches))
+
+    def test_batch_search_matches_single_queries(self):
+        rng = np.random.default_rng(0)
+        self.write(rng.normal(size=(50, 4)), [f"p{i}" for i in range(50)], deleted={'p3'})
+        snapshot = self.index.get()
+        queries = vector_store.normalize(rng.normal(size=(7, 4)))
+
+        batch = snapshot.search_batch(queries, k=5, block_size=3)
+        self.assertEqual(len(batch), 7)
+        for q, matches in zip(queries, batch):
+            single = snapshot.search(q, k=5)
+            self.assertEqual([m['id'] for m, _ in matches], [m['id'] for m, _ in single])
+            np.testing.assert_allclose([s for _, s in matches], [s for _, s in single], rtol=1e-5)
+
+    def test_snapshot_uses_ivf_index_when_built(self):
+        rng = np.random.default_rng(2)
+        embeddings = vector_store.normalize(rng.normal(size=(200, 8)))
+        self.write(embeddings, [f"p{i}" for i in range(200)])
+        ann_index.IVFIndex.build(embeddings, n_lists=4).save()
+
+        snapshot = self.index.get()
+        self.assertIsNotNone(snapshot.ann)
+        results = snapshot.search(embeddings[7], k=1, nprobe=4)
+        self.assertEqual(results[0][0]['name'], 'p7')
+
+    def test_top_k(self):
+        scores = np.array([0.1, 0.9, 0.5, 0.7])
+        self.assertEqual(list(vector_store.top_k(scores, 2)), [1, 3])
+        self.assertEqual(list(vector_store.top_k(scores, 10)), [1, 3, 2, 0])
+        block = np.array([[0.1, 0.9, 0.5], [0.8, 0.2, 0.3]])
+        self.assertEqual(vector_store.top_k(block, 2).tolist(), [[1, 2], [0, 2]])
+
+class IVFIndexTests(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        # 20 well separated clusters of 100 rows each
+        centers = vector_store.normalize(rng.normal(size=(20, 16)))
+        self.embeddings = vector_store.normalize(
+            np.repeat(centers, 100, axis=0) + rng.normal(scale=0.05, size=(2000, 16)))
+        self.queries = vector_store.normalize(centers + rng.normal(scale=0.05, size=centers.shape))
+        self.index = ann_index.IVFIndex.build(self.embeddings, n_lists=20)
+        self.original_path = ann_index.ANN_PATH
+        ann_index.ANN_PATH = os.path.join(tempfile.gettempdir(), 'missing-ivf.npz')
+
+    def tearDown(self):
+        ann_index.ANN_PATH = self.original_path
+
+    def exact(self, q, k):
+        return set(vector_store.top_k(self.embeddings @ q, k).tolist())
+
+    def test_all_lists_probed_equals_exact(self):
+        for q in self.queries:
+            rows, scores = self.index.search(self.embeddings, q, 10, nprobe=20)
+            self.assertEqual(set(rows.tolist()), self.exact(q, 10))
+            self.assertTrue(np.all(np.diff(scores) <= 0))
+
+    def test_few_probes_keep_high_recall(self):
+        hits = sum(len(set(self.index.search(self.embeddings, q, 10, nprobe=2)[0].tolist()) & self.exact(q, 10))
+                   for q in self.queries)
+        self.assertGreaterEqual(hits / (10 * len(self.queries)), 0.9)
+
+    def test_rows_beyond_assignments_are_scanned(self):
+        extra = self.queries[:1]
+        embeddings = np.vstack([self.embeddings, extra])
+        rows, _ = self.index.search(embeddings, extra[0], 1, nprobe=1)
+        self.assertEqual(rows.tolist(), [2000])
+
+    def test_tombstones_are_skipped(self):
+        q = self.queries[0]
+        best = next(iter(vector_store.top_k(self.embeddings @ q, 1)))
+        live = np.ones(len(self.embeddings), dtype=bool)
+        live[best] = False
+        rows, _ = self.index.search(self.embeddings, q, 5, nprobe=20, live=live)
+        self.assertNotIn(best, rows.tolist())
+
+    def test_save_load_and_update_assignments(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'ivf.npz')
+            self.index.save(path)
+            ann_index.update_assignments([2000], self.queries[3:4], 2001, path=path)
+            loaded = ann_index.IVFIndex.load(path)
+            self.assertEqual(len(loaded.assignments), 2001)
+            self.assertEqual(loaded.assignments[2000], ann_index.assign(self.queries[3:4], loaded.centroids)[0])
+
+    def test_recall_report(self):
+        report = ann_index.recall_report(self.embeddings, nprobes=(1, 20), n_queries=20, k=5)
+        self.assertEqual([r['nprobe'] for r in report], [None, 1, 20])
+        self.assertEqual(report[-1]['recall'], 1.0)
+
+class QueryEmbeddingCacheTests(TempDatabaseTestCase):
+    def tearDown(self):
+        vector_store.query_cache.clear()
+        super().tearDown()
+
+    def test_lru_eviction_and_counters(self):
+        cache = QueryEmbeddingCache('m', max_size=2, persist=False)
+        cache.put_many({'a': np.ones(2), 'b': np.zeros(2)})
+        cache.get_many(['a'])            # 'a' is now most recent
+        cache.put_many({'c': np.ones(2)})  # evicts 'b'
+        self.assertEqual(set(cache.get_many(['a', 'b', 'c'])), {'a', 'c'})
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (3, 1, 2))
+
+    def test_disk_tier_survives_restart(self):
+        QueryEmbeddingCache('m', persist=True).put_many({'cheap laptop': np.array([0.6, 0.8], dtype='float32')})
+
+        restarted = QueryEmbeddingCache('m', persist=True)
+        found = restarted.get_many(['cheap laptop'])
+        np.testing.assert_allclose(found['cheap laptop'], [0.6, 0.8], rtol=1e-6)
+        self.assertEqual(restarted.stats()['disk_hits'], 1)
+        # Promoted to memory: the next lookup doesn't touch the disk
+        restarted.get_many(['cheap laptop'])
+        self.assertEqual(restarted.stats()['hits'], 1)
+        # Entries are per model
+        self.assertEqual(QueryEmbeddingCache('other', persist=True).get_many(['cheap laptop']), {})
+
+    def test_encode_queries_only_encodes_misses(self):
+        encoder = HashEncoder()
+        first = vector_store.encode_queries(['Samsung', 'cheap laptop'], model=encoder)
+        again = vector_store.encode_queries(['  samsung ', 'Cheap Laptop', 'Samsung', 'dock'], model=encoder)
+
+        self.assertEqual(encoder.encoded, ['samsung', 'cheap laptop', 'dock'])
+        np.testing.assert_array_equal(again[0], first[0])
+        np.testing.assert_array_equal(again[1], first[1])
+        np.testing.assert_allclose(np.linalg.norm(again, axis=1), 1.0, rtol=1e-6)
+
+    def test_cache_key(self):
+        self.assertEqual(cache_key('  Cheap   LAPTOP\n'), 'cheap laptop')
+
+def keyword_encode(texts):
+    """Two-feature stand-in for MiniLM: 'price-check' words vs 'reasoning' words."""
+    simple_words = ('price', 'how much', 'hi', 'hello', 'show', 'find', 'stock', 'set', 'update', 'cheapest', 'thanks', 'have')
+    complex_words = ('if', 'compare', 'total', 'discount', 'strategy', 'average', 'recommend', 'rank', 'plan', 'explain', 'calculate', 'many')
+    vectors = [[sum(w in t.lower() for w in simple_words) + 0.01,
+                sum(w in t.lower() for w in complex_words) + 0.01] for t in texts]
+    return vector_store.normalize(np.array(vectors, dtype='float32'))
+
+class QueryRouterTests(TempDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.router = router.QueryRouter(encode=keyword_encode, ready=lambda: True)
+        self.llm_calls = []
+
+    def generate(self, prompt):
+        self.llm_calls.append(prompt)
+        return SimpleNamespace(text="COMPLEX\n")
+
+    def test_confident_queries_skip_the_llm(self):
+        self.assertEqual(self.router.classify("what is the price of the Pixel", self.generate)[::2], ("SIMPLE", "router"))
+        self.assertEqual(self.router.classify("compare phones and recommend a discount strategy", self.generate)[::2],
+                         ("COMPLEX", "router"))
+        self.assertEqual(self.llm_calls, [])
+
+    def test_uncertain_query_falls_back_and_is_learned(self):
+        self.router.min_confidence = 0.999
+        label, confidence, source = self.router.classify("warranty terms", self.generate)
+        self.assertEqual((label, source), ("COMPLEX", "llm"))
+        self.assertLess(confidence, 0.999)
+        self.assertEqual(len(self.llm_calls), 1)
+        self.assertIn(("warranty terms", "COMPLEX"), router.load_examples())
+
+    def test_model_not_loaded_uses_llm(self):
+        cold = router.QueryRouter(encode=keyword_encode, ready=lambda: False)
+        self.assertEqual(cold.classify("price of the Pixel", self.generate), ("COMPLEX", None, "llm"))
+        self.assertEqual(cold.classify("price of the Pixel"), ("COMPLEX", None, "default"))
+
+    def test_label_history_skips_deletes_and_known_queries(self):
+        rows = [('s', 'user', 'rank the monitors'), ('s', 'model', 'ok'),
+                      ('s', 'user', 'delete the pixel'), ('s', 'user', 'rank the monitors')]
+        with database.get_db_connection() as conn:
+            conn.executemany('INSERT INTO chat_history (session_id, role, content) VALUES (?, ?, ?)', rows)
+        self.assertEqual(router.label_history(self.generate), 1)
+        self.assertEqual(router.label_history(self.generate), 0)
+
+if __name__ == '__main__':
+    unittest.main()
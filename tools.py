@@ -1,24 +1,21 @@
-from database import get_db_connection
-import numpy as np
-import json
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 import os
-from sentence_transformers import SentenceTransformer
-from numpy.linalg import norm
+import time
+import database
+from database import get_db_connection
+import vector_store
+import metrics
 
-# Initialize models globally for the tool
-print("Loading Search Models...")
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2', device="mps") # Use MPS or CPU
-print("Search Models Loaded.")
+# The embedding model is loaded lazily by vector_store on the first semantic search
+
+SEARCH_MAX_K = 50
 
 def get_inventory_data():
-    """Loads embeddings and metadata from disk."""
-    if not os.path.exists("inventory_embeddings.npy") or not os.path.exists("inventory_metadata.json"):
+    """Returns the resident (normalised embeddings, metadata), or (None, None) if no index exists."""
+    index = vector_store.get_resident_index()
+    if index is None:
         return None, None
-    
-    embeddings = np.load("inventory_embeddings.npy")
-    with open("inventory_metadata.json", "r") as f:
-        metadata = json.load(f)
-    return embeddings, metadata
+    return index.embeddings, index.metadata
 
 def update_product_price(product_id: int, new_price: float):
     """Updates the price of a product in the database."""
@@ -92,7 +89,10 @@ def delete_products_by_name(pattern: str):
         conn.close()
 
 def save_chat_message(session_id: str, role: str, content: str):
-    """Saves a chat message to the history."""
+    """Queues a chat message for the history; it is written in the next batch (see database.ChatWriter)."""
+    if database.CHAT_WRITE_BEHIND:
+        database.chat_writer.append(session_id, role, content)
+        return
     conn = get_db_connection()
     try:
         conn.execute('INSERT INTO chat_history (session_id, role, content) VALUES (?, ?, ?)', 
@@ -104,16 +104,23 @@ def save_chat_message(session_id: str, role: str, content: str):
         conn.close()
 
 def get_recent_history(session_id: str, limit: int = 10):
-    """Retrieves the most recent chat history for a session."""
+    """
+    Retrieves the most recent chat history for a session, leaving out messages
+    already folded into the session's summary (see chat_memory.py).
+    """
+    # Read-your-writes: messages this session still has queued are written first
+    database.chat_writer.flush(session_id)
     conn = get_db_connection()
     try:
+        # A range scan on idx_chat_history_session, however large the table grows
         messages = conn.execute('''
-            SELECT role, content 
-            FROM chat_history 
-            WHERE session_id = ? 
-            ORDER BY timestamp DESC 
+            SELECT role, content
+            FROM chat_history
+            WHERE session_id = ?
+              AND id > COALESCE((SELECT last_message_id FROM chat_summaries WHERE session_id = ?), 0)
+            ORDER BY id DESC
             LIMIT ?
-        ''', (session_id, limit)).fetchall()
+        ''', (session_id, session_id, limit)).fetchall()
         
         # Reverse to return in chronological order (oldest -> newest)
         return [{"role": m["role"], "parts": [m["content"]]} for m in reversed(messages)]
@@ -123,39 +130,118 @@ def get_recent_history(session_id: str, limit: int = 10):
     finally:
         conn.close()
 
-def search_inventory(query: str):
+def _format_match(item, score):
+    # Construct rich object
+    return {
+        "id": item['id'],
+        "name": item['name'],
+        "price": item['price'],
+        "description": item['text'], # Keep text for AI context
+        "image_url": "https://placehold.co/300x200/png?text=Product", # Placeholder
+        "quantity": 10, # Mock quantity
+        "score": round(score, 4)
+    }
+
+def search_inventory(query: str, k: int = 3):
     """
     Performs a semantic search on the inventory to find relevant products.
-    Returns the top 3 matches.
+    Returns the top k matches (default 3).
     """
     try:
-        embeddings, metadata = get_inventory_data()
-        if embeddings is None or metadata is None:
+        # Held in memory and only reloaded when the index files change
+        index = vector_store.get_resident_index()
+        if index is None:
             return ["Error: Inventory index not found. Please run vector_store.py first."]
 
-        # Generate embedding for the query
-        query_embedding = embedding_model.encode([query])[0]
-        
-        # Calculate Cosine Similarity
-        # Cosine Sim(A, B) = (A . B) / (||A|| * ||B||)
-        scores = np.dot(embeddings, query_embedding) / (norm(embeddings, axis=1) * norm(query_embedding))
-        
-        # Get top 3 indices
-        top_k_indices = np.argsort(scores)[-3:][::-1]
-        
-        matches = []
-        for idx in top_k_indices:
-            item = metadata[idx]
-            # Construct rich object
-            matches.append({
-                "id": item['id'],
-                "name": item['name'],
-                "price": item['price'],
-                "description": item['text'], # Keep text for AI context
-                "image_url": "https://placehold.co/300x200/png?text=Product", # Placeholder
-                "quantity": 10 # Mock quantity
-            })
-            
-        return matches
+        # Generate embedding for the query (cached for repeated queries)
+        query_embedding = vector_store.encode_queries([query])[0]
+
+        # Rows are unit length, so cosine similarity is one mat-vec
+        k = max(1, min(int(k), SEARCH_MAX_K))
+        return [_format_match(item, score) for item, score in index.search(query_embedding, k)]
     except Exception as e:
         return [f"Error searching inventory: {str(e)}"]
+
+def search_inventory_batch(queries, k=3):
+    """
+    Semantic search for many queries at once: one encoder call for all uncached
+    queries and one matrix-matrix product per block. Returns one match list per query.
+    Not exposed to the model as a tool; used by bulk jobs and POST /search/semantic.
+    Raises LookupError if the index has not been built.
+    """
+    index = vector_store.get_resident_index()
+    if index is None:
+        raise LookupError("Inventory index not found. Please run vector_store.py first.")
+    if not queries:
+        return []
+
+    query_embeddings = vector_store.encode_queries(list(queries))
+    k = max(1, min(int(k), SEARCH_MAX_K))
+    return [[_format_match(item, score) for item, score in matches]
+            for matches in index.search_batch(query_embeddings, k)]
+
+# --- Tool execution ---
+# Tools that only read. Consecutive read-only calls in one model turn run in
+# parallel; any other tool is a barrier, so writes run one at a time, in order,
+# and reads never overtake a write that the model asked for first.
+READ_ONLY_TOOLS = {'search_inventory'}
+TOOL_TIMEOUT = float(os.environ.get("TOOL_TIMEOUT", "20"))
+TOOL_WORKERS = int(os.environ.get("TOOL_WORKERS", "8"))
+
+_tool_pool = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+
+def _run_tool(registry, name, args):
+    if name not in registry:
+        # The name comes from the model; a fixed label keeps /metrics from growing per made-up tool
+        metrics.tool_call_duration.observe(0.0, tool="unknown", outcome="unknown")
+        return {"status": "error", "message": f"Unknown tool '{name}'."}
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        result = registry[name](**(args or {}))
+        if not (isinstance(result, dict) and result.get("status") == "error"):
+            outcome = "ok"
+        return result
+    except Exception as e:
+        return {"status": "error", "message": f"Tool '{name}' failed: {str(e)}"}
+    finally:
+        metrics.tool_call_duration.observe(time.perf_counter() - start, tool=name, outcome=outcome)
+
+def tool_response(result):
+    """The response dict for a tool result; FunctionResponse only takes a dict, so anything else is wrapped."""
+    return result if isinstance(result, dict) else {"result": result}
+
+def _collect(future, name, deadline):
+    try:
+        return future.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FutureTimeout:
+        future.cancel()
+        return {"status": "error", "message": f"Tool '{name}' timed out after {TOOL_TIMEOUT:g}s."}
+
+def execute_tool_calls(calls, registry, timeout=None):
+    """
+    Runs [(name, args), ...] from one model turn and returns their results in the
+    same order. Read-only tools run concurrently on the tool pool, bounded by
+    `timeout` seconds (TOOL_TIMEOUT). Other tools run sequentially on the calling
+    thread with no timeout, so the model never sees a write reported as failed
+    while it is still being applied.
+    """
+    timeout = TOOL_TIMEOUT if timeout is None else timeout
+    results = [None] * len(calls)
+    i = 0
+    while i < len(calls):
+        if calls[i][0] in READ_ONLY_TOOLS:
+            # Fan out the whole run of consecutive reads, then wait for all of it
+            j = i
+            while j < len(calls) and calls[j][0] in READ_ONLY_TOOLS:
+                j += 1
+            deadline = time.monotonic() + timeout
+            futures = [(k, _tool_pool.submit(_run_tool, registry, *calls[k])) for k in range(i, j)]
+            for k, future in futures:
+                results[k] = _collect(future, calls[k][0], deadline)
+            i = j
+        else:
+            results[i] = _run_tool(registry, *calls[i])
+            i += 1
+    return results
+
@@ -1,63 +1,528 @@
-import sqlite3
 import numpy as np
 import json
-from sentence_transformers import SentenceTransformer
 import os
+import threading
+import ann_index
 from database import get_db_connection
+from embedding_cache import QueryEmbeddingCache, cache_key
+
+EMBEDDINGS_PATH = "inventory_embeddings.npy"
+METADATA_PATH = "inventory_metadata.json"
+
+MODEL_NAME = 'all-MiniLM-L6-v2'
+# 'cuda', 'mps' or 'cpu'; autodetected when unset
+DEVICE = os.environ.get("EMBEDDING_DEVICE")
+
+# Compact the files once this fraction of rows are tombstones
+COMPACT_THRESHOLD = 0.2
+# How often the background worker looks for product changes (seconds)
+INDEX_WORKER_INTERVAL = float(os.environ.get("VECTOR_INDEX_INTERVAL", "2"))
+# Change log entries embedded and applied per pass, so a bulk import is indexed
+# with bounded memory and the index lock is released in between
+INDEX_APPLY_BATCH = int(os.environ.get("VECTOR_INDEX_BATCH", "5000"))
+
+_model = None
+_model_lock = threading.Lock()
+_model_state = "not_loaded"  # -> "loading" -> "ready" | "failed"
+_model_error = None
+# Serialises writers (full ingest, incremental apply, compaction) in this process
+_index_lock = threading.Lock()
+
+def detect_device():
+    """CUDA if available, then Apple Silicon (MPS), else CPU."""
+    try:
+        import torch
+    except ImportError:
+        return "cpu"
+    if torch.cuda.is_available():
+        return "cuda"
+    mps = getattr(torch.backends, "mps", None)
+    if mps is not None and mps.is_available():
+        return "mps"
+    return "cpu"
+
+def get_embedding_model():
+    """
+    Loads the sentence transformer once, on first use. torch and the model are
+    only imported here, so importing this module (or tools/main) stays fast.
+    """
+    global _model, _model_state, _model_error
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model_state = "loading"
+                try:
+                    from sentence_transformers import SentenceTransformer
+                    device = DEVICE or detect_device()
+                    print(f"Loading embedding model {MODEL_NAME} on {device}...")
+                    _model = SentenceTransformer(MODEL_NAME, device=device)
+                except Exception as e:
+                    _model_state, _model_error = "failed", str(e)
+                    raise
+                _model_state, _model_error = "ready", None
+                print("Embedding model loaded.")
+    return _model
+
+def embedding_model_status():
+    """One of not_loaded / loading / ready / failed, plus the load error if any."""
+    return {"state": _model_state, "error": _model_error}
+
+def warm_up_embedding_model():
+    """Loads the model on a background thread so the first search doesn't pay for it."""
+    def load():
+        try:
+            get_embedding_model()
+        except Exception as e:
+            print(f"Embedding model warm-up failed: {e}")
+    thread = threading.Thread(target=load, name="embedding-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+query_cache = QueryEmbeddingCache(MODEL_NAME)
+
+# Queries encoded per forward pass
+QUERY_BATCH_SIZE = 256
+
+def encode_queries(queries, model=None):
+    """
+    Normalised embeddings for a list of query strings, shape (len(queries), d).
+    Repeated queries come from the LRU cache; only new ones reach the encoder,
+    all in one call.
+    """
+    keys = [cache_key(q) for q in queries]
+    found = query_cache.get_many(keys)
+    missing = [k for k in dict.fromkeys(keys) if k not in found]
+    if missing:
+        model = model or get_embedding_model()
+        vectors = normalize(model.encode(missing, batch_size=min(len(missing), QUERY_BATCH_SIZE)))
+        new = dict(zip(missing, vectors))
+        query_cache.put_many(new)
+        found.update(new)
+    return np.stack([found[k] for k in keys])
+
+def product_text(p):
+    """The rich text representation that gets embedded for a product."""
+    return f"Product ID: {p['id']}. Name: {p['name']}. Price: ${p['price']}."
+
+def product_metadata(p):
+    return {
+        "id": p['id'],
+        "name": p['name'],
+        "price": float(p['price']),
+        "text": product_text(p)
+    }
+
+def normalize(vectors):
+    """L2-normalises rows so cosine similarity becomes a plain dot product."""
+    vectors = np.asarray(vectors, dtype='float32')
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def embed_products(products, model=None):
+    """Returns L2-normalised float32 embeddings for a list of product rows."""
+    model = model or get_embedding_model()
+    return normalize(model.encode([product_text(p) for p in products]))
+
+def _save_metadata(metadata):
+    """Writes metadata atomically so readers never see a half-written file."""
+    tmp_path = METADATA_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(metadata, f)
+    os.replace(tmp_path, METADATA_PATH)
+
+def _save_embeddings(embeddings):
+    """
+    Writes a new embeddings file and swaps it in. Never truncates the old file in
+    place, because readers may still have it memory-mapped.
+    """
+    tmp_path = EMBEDDINGS_PATH + ".tmp.npy"
+    np.save(tmp_path, embeddings)
+    os.replace(tmp_path, EMBEDDINGS_PATH)
+
+def _load_metadata():
+    with open(METADATA_PATH, "r") as f:
+        return json.load(f)
+
+def _append_rows(path, rows):
+    """
+    Appends rows to a 2-D float32 .npy file in place: the new rows are written at
+    the end and only the header's shape is rewritten. Returns False if the header
+    has no room for the new shape, in which case the caller must rewrite the file.
+    """
+    with open(path, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            prefix_len = 10  # magic (6) + version (2) + uint16 header length
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            prefix_len = 12  # magic (6) + version (2) + uint32 header length
+        data_offset = f.tell()
+
+        if fortran_order or dtype != rows.dtype or len(shape) != 2 or shape[1] != rows.shape[1]:
+            return False
+
+        new_shape = (shape[0] + rows.shape[0], shape[1])
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+            np.lib.format.dtype_to_descr(dtype), new_shape)
+        header_room = data_offset - prefix_len
+        if len(header) + 1 > header_room:
+            return False
+
+        # Data first, header last: a concurrent reader sees either the old shape or the new one
+        f.seek(data_offset + shape[0] * shape[1] * dtype.itemsize)
+        f.write(np.ascontiguousarray(rows).tobytes())
+        f.flush()
+        f.seek(prefix_len)
+        f.write((header.ljust(header_room - 1) + "\n").encode("latin1"))
+    return True
+
+def _pending_changes(conn, limit=None):
+    """
+    Returns (high-water mark, distinct product ids) from the change log, or only
+    from its oldest `limit` entries.
+    """
+    if limit is None:
+        hi = conn.execute('SELECT max(id) FROM product_changes').fetchone()[0]
+    else:
+        hi = conn.execute('SELECT max(id) FROM (SELECT id FROM product_changes ORDER BY id LIMIT ?)',
+                          (limit,)).fetchone()[0]
+    if hi is None:
+        return None, []
+    ids = [r[0] for r in conn.execute(
+        'SELECT DISTINCT product_id FROM product_changes WHERE id <= ?', (hi,))]
+    return hi, ids
+
+def _trim_change_log(conn, hi):
+    conn.execute('DELETE FROM product_changes WHERE id <= ?', (hi,))
+    conn.commit()
 
 def ingest_inventory():
-    print("Connecting to database...")
-    conn = get_db_connection()
-    products = conn.execute('SELECT * FROM products').fetchall()
-    conn.close()
-    
-    if not products:
-        print("No products found in database.")
-        return
-
-    print(f"Found {len(products)} products. Loading model...")
-    # Initialize Sentence Transformer model
-    # Use 'mps' for Apple Silicon acceleration if available, else cpu
-    device = "mps"
-    print(f"Using device: {device}")
-    
-    model = SentenceTransformer('all-MiniLM-L6-v2', device=device)
-    
-    # Prepare data
-    documents = []
-    metadata = []
-    
-    print("Generating embeddings...")
-    for p in products:
-        # Create a rich text representation for embedding
-        text_rep = f"Product ID: {p['id']}. Name: {p['name']}. Price: ${p['price']}."
-        documents.append(text_rep)
-        
+    """Full rebuild: re-embeds every product and rewrites both index files."""
+    with _index_lock:
+        print("Connecting to database...")
+        conn = get_db_connection()
+        try:
+            # Everything logged up to here is covered by this rebuild
+            hi, _ = _pending_changes(conn)
+            products = conn.execute('SELECT * FROM products ORDER BY id').fetchall()
+        finally:
+            conn.close()
+
+        if not products:
+            print("No products found in database.")
+            return
+
+        print(f"Found {len(products)} products. Loading model...")
+        model = get_embedding_model()
+
+        print("Generating embeddings...")
         # Store metadata including the original text for retrieval
-        metadata.append({
-            "id": p['id'],
-            "name": p['name'],
-            "price": float(p['price']),
-            "text": text_rep
-        })
-
-    # Generate embeddings (returns numpy array)
-    embeddings = model.encode(documents)
-    
-    # Convert to standard float32 for consistency
-    embeddings = embeddings.astype('float32')
-    
-    print(f"Embeddings shape: {embeddings.shape}")
-    
-    # Save to disk
-    print("Saving to disk...")
-    np.save("inventory_embeddings.npy", embeddings)
-    
-    with open("inventory_metadata.json", "w") as f:
-        json.dump(metadata, f, indent=2)
-    
-    print(f"Successfully ingested {len(products)} items.")
-    print("Saved 'inventory_embeddings.npy' and 'inventory_metadata.json'")
+        metadata = [product_metadata(p) for p in products]
+        embeddings = embed_products(products, model)
+
+        print(f"Embeddings shape: {embeddings.shape}")
+
+        # Save to disk
+        print("Saving to disk...")
+        _save_metadata(metadata)
+        _save_embeddings(embeddings)
+        _build_ann(embeddings)
+        _bump_version()
+
+        if hi is not None:
+            conn = get_db_connection()
+            try:
+                _trim_change_log(conn, hi)
+            finally:
+                conn.close()
+
+        print(f"Successfully ingested {len(products)} items.")
+        print(f"Saved '{EMBEDDINGS_PATH}' and '{METADATA_PATH}'")
+
+def apply_pending_changes(model=None, batch_size=None):
+    """
+    Incremental update: embeds only products that were added or changed since the
+    last run, tombstones deleted ones, and trims the change log. Works through the
+    log batch_size (INDEX_APPLY_BATCH) entries at a time.
+    Returns {"upserted": n, "deleted": n}.
+    """
+    batch_size = batch_size or INDEX_APPLY_BATCH
+    totals = {"upserted": 0, "deleted": 0}
+    while True:
+        result = _apply_change_batch(model, batch_size)
+        if result is None:
+            return totals
+        totals["upserted"] += result["upserted"]
+        totals["deleted"] += result["deleted"]
+
+def _apply_change_batch(model, batch_size):
+    """Applies the oldest batch_size change log entries; None once the log is empty."""
+    with _index_lock:
+        conn = get_db_connection()
+        try:
+            hi, changed_ids = _pending_changes(conn, batch_size)
+            if hi is None:
+                return None
+
+            if not os.path.exists(EMBEDDINGS_PATH) or not os.path.exists(METADATA_PATH):
+                # No index yet; the first full ingest will pick everything up.
+                hi, _ = _pending_changes(conn)
+                _trim_change_log(conn, hi)
+                return None
+
+            current = {}
+            for start in range(0, len(changed_ids), 500):
+                chunk = changed_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for p in conn.execute(f'SELECT * FROM products WHERE id IN ({placeholders})', chunk):
+                    current[p['id']] = p
+        finally:
+            conn.close()
+
+        embeddings = np.load(EMBEDDINGS_PATH, mmap_mode='r+')
+        # A previous run may have died between writing metadata and appending
+        # embeddings; its change log entries were not trimmed, so they are redone here.
+        metadata = _load_metadata()[:len(embeddings)]
+        row_of = {m['id']: i for i, m in enumerate(metadata) if not m.get('deleted')}
+
+        upserts = [current[pid] for pid in changed_ids if pid in current]
+        deletes = [pid for pid in changed_ids if pid not in current and pid in row_of]
+
+        vectors = embed_products(upserts, model) if upserts else None
+
+        appended = []
+        touched_rows = []
+        for p, vec in zip(upserts, vectors if vectors is not None else []):
+            row = row_of.get(p['id'])
+            if row is None:
+                appended.append(vec)
+                row = row_of[p['id']] = len(metadata)
+                metadata.append(product_metadata(p))
+            else:
+                embeddings[row] = vec
+                metadata[row] = product_metadata(p)
+            touched_rows.append(row)
+        for pid in deletes:
+            row = row_of.pop(pid)
+            embeddings[row] = 0.0
+            metadata[row]['deleted'] = True
+        embeddings.flush()
+        del embeddings
+
+        # Metadata first: it may briefly list rows the embeddings file doesn't have yet,
+        # never the other way round.
+        _save_metadata(metadata)
+        if appended:
+            rows = np.vstack(appended).astype('float32')
+            if not _append_rows(EMBEDDINGS_PATH, rows):
+                full = np.vstack([np.load(EMBEDDINGS_PATH), rows])
+                _save_embeddings(full)
+        if touched_rows:
+            ann_index.update_assignments(touched_rows, vectors, len(metadata))
+        _bump_version()
+
+        conn = get_db_connection()
+        try:
+            _trim_change_log(conn, hi)
+        finally:
+            conn.close()
+
+        tombstones = sum(1 for m in metadata if m.get('deleted'))
+        if metadata and tombstones / len(metadata) > COMPACT_THRESHOLD:
+            _compact()
+
+        return {"upserted": len(upserts), "deleted": len(deletes)}
+
+def _compact():
+    """Drops tombstoned rows from both files. No re-embedding needed. Caller holds _index_lock."""
+    metadata = _load_metadata()
+    keep = [i for i, m in enumerate(metadata) if not m.get('deleted')]
+    full = np.load(EMBEDDINGS_PATH)
+    _save_metadata([metadata[i] for i in keep])
+    _save_embeddings(full[keep])
+    ann_index.compact(keep, full)
+    _bump_version()
+    print(f"Compacted vector index: {len(metadata) - len(keep)} tombstones removed")
+
+def _build_ann(embeddings):
+    """Builds the IVF index for big catalogs; removes a stale one for small catalogs."""
+    if ann_index.BACKEND != "exact" and len(embeddings) >= ann_index.MIN_ROWS:
+        print(f"Building IVF index ({ann_index.default_n_lists(len(embeddings))} lists)...")
+        ann_index.IVFIndex.build(embeddings).save()
+        print(f"Saved '{ann_index.ANN_PATH}'")
+    elif os.path.exists(ann_index.ANN_PATH):
+        os.remove(ann_index.ANN_PATH)
+
+
+# --- Resident index for queries ---
+_version = 0
+
+def _bump_version():
+    """Tells the in-process resident index to reload (other processes notice via mtime)."""
+    global _version
+    _version += 1
+
+# Live rows whose norms are checked when the index is loaded
+NORM_CHECK_SAMPLE = 1024
+
+def top_k(scores, k):
+    """
+    Indices of the k highest scores along the last axis, best first.
+    O(n) selection instead of a full sort; works for one row or a (q, n) block.
+    """
+    k = min(k, scores.shape[-1])
+    if k <= 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=int)
+    idx = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(scores, idx, axis=-1), axis=-1)
+    return np.take_along_axis(idx, order, axis=-1)
+
+
+class IndexSnapshot:
+    """One consistent, loaded version of the index: normalised embeddings plus metadata."""
+
+    def __init__(self, embeddings, metadata, live, ann=None):
+        self.embeddings = embeddings
+        self.metadata = metadata
+        self.live = live  # None, or a bool mask that is False for tombstoned rows
+        self.ann = ann    # IVFIndex, or None for exact search
+
+    def scores(self, query_vectors):
+        """Cosine scores for one (d,) or many (q, d) normalised query vectors."""
+        scores = np.dot(self.embeddings, np.asarray(query_vectors, dtype='float32').T)
+        if self.live is not None:
+            scores[~self.live] = -np.inf
+        return scores
+
+    def search(self, query_vector, k=3, nprobe=None):
+        """Returns [(metadata, score)] for the k best matches (approximate if an IVF index is loaded)."""
+        if self.ann is not None:
+            rows, scores = self.ann.search(self.embeddings, np.asarray(query_vector, dtype='float32'),
+                                           k, nprobe=nprobe, live=self.live)
+            return [(self.metadata[i], float(s)) for i, s in zip(rows, scores)]
+        scores = self.scores(query_vector)
+        return self._matches(scores, top_k(scores, k))
+
+    def _matches(self, scores, best):
+        # Tombstones score -inf, but still fill the top k when k exceeds the live rows
+        if self.live is not None:
+            best = best[self.live[best]]
+        return [(self.metadata[i], float(scores[i])) for i in best]
+
+    def search_batch(self, query_vectors, k=3, block_size=256):
+        """
+        Returns one [(metadata, score)] list per query. Each block of queries is
+        scored with a single matrix-matrix product; blocking bounds the score
+        matrix to rows x block_size floats.
+        """
+        if self.ann is not None:
+            return [self.search(q, k) for q in query_vectors]
+        results = []
+        for start in range(0, len(query_vectors), block_size):
+            scores = self.scores(query_vectors[start:start + block_size]).T  # (q, rows)
+            for row, best in zip(scores, top_k(scores, k)):
+                results.append(self._matches(row, best))
+        return results
+
+
+class ResidentIndex:
+    """
+    Keeps the index in memory between queries.
+
+    The embeddings file is memory-mapped and used as-is when its rows are already
+    unit length (everything written by this module is); older files are normalised
+    once at load. A query is then a single mat-vec. The files are re-read only
+    when their mtime/size or the in-process version changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._signature = None
+        self._snapshot = None
+
+    def _current_signature(self):
+        try:
+            e, m = os.stat(EMBEDDINGS_PATH), os.stat(METADATA_PATH)
+        except FileNotFoundError:
+            return None
+        try:
+            a = os.stat(ann_index.ANN_PATH).st_mtime_ns
+        except FileNotFoundError:
+            a = None
+        return (_version, e.st_mtime_ns, e.st_size, m.st_mtime_ns, m.st_size, a)
+
+    def _load(self):
+        embeddings = np.load(EMBEDDINGS_PATH, mmap_mode='r')
+        metadata = _load_metadata()
+        rows = min(len(embeddings), len(metadata))
+        embeddings, metadata = embeddings[:rows], metadata[:rows]
+
+        live = np.array([not m.get('deleted') for m in metadata], dtype=bool)
+        # Files are normalised as a whole or not at all, so a spread of live rows
+        # tells which; indexing the whole memmap would copy it into RAM.
+        live_rows = np.flatnonzero(live)
+        sample = live_rows[::max(1, len(live_rows) // NORM_CHECK_SAMPLE)]
+        norms = np.linalg.norm(embeddings[sample], axis=1)
+        if not np.allclose(norms, 1.0, atol=1e-3):
+            embeddings = normalize(embeddings)
+
+        ann = None
+        if ann_index.BACKEND != "exact" and os.path.exists(ann_index.ANN_PATH):
+            ann = ann_index.IVFIndex.load()
+            if len(ann.assignments) > rows:
+                ann = None  # built for a different version of the files
+        return IndexSnapshot(embeddings, metadata, None if live.all() else live, ann)
+
+    def get(self):
+        """Returns the current snapshot, reloading if the files changed. None if no index exists."""
+        signature = self._current_signature()
+        if signature is None:
+            return None
+        if signature != self._signature:
+            with self._lock:
+                if signature != self._signature:
+                    self._snapshot = self._load()
+                    self._signature = signature
+        return self._snapshot
+
+_resident = ResidentIndex()
+
+def get_resident_index():
+    """Returns the up-to-date IndexSnapshot, or None if no index has been built."""
+    return _resident.get()
+
+
+class IndexWorker(threading.Thread):
+    """Background thread that applies product changes to the vector index every few seconds."""
+
+    def __init__(self, interval=INDEX_WORKER_INTERVAL):
+        super().__init__(name="vector-index-worker", daemon=True)
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                result = apply_pending_changes()
+                if result["upserted"] or result["deleted"]:
+                    print(f"[INDEX] Applied {result['upserted']} upserts, {result['deleted']} deletes")
+            except Exception as e:
+                print(f"[INDEX] Incremental update failed: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+
+_worker = None
+
+def start_index_worker(interval=INDEX_WORKER_INTERVAL):
+    """Starts the background index worker once per process."""
+    global _worker
+    if _worker is None or not _worker.is_alive():
+        _worker = IndexWorker(interval)
+        _worker.start()
+    return _worker
 
 if __name__ == "__main__":
     ingest_inventory()